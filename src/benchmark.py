@@ -0,0 +1,293 @@
+"""Benchmark of all pipeline stages on synthetic room scans"""
+import copy
+import json
+import shutil
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pyransac3d as pyrsc
+
+import system_setup as setup
+from processors.plane_detection import IterativeRANSAC, PyramidRANSAC, RegionGrowing
+from processors.geometry import BatchedPlane
+from processors.plane_removal import PlaneRemovalAll
+from processors.outlier_removal import (
+    Context,
+    StatisticalOutlierRemoval,
+    RadiusOutlierRemoval,
+    VoxelDensityOutlierRemoval,
+    ChunkedStatisticalOutlierRemoval,
+)
+from utils import metrics
+from utils.dataloader import DataLoaderDS, DataLoaderSTD
+from utils.pointcache import PointCache
+from utils.planestore import PlaneStore
+from utils.pointstream import count_points
+from utils.pointwriter import PointWriter
+from utils.synthetic import SyntheticRoom
+from utils.utils import load_dict_from_yaml
+from utils.runner import Runner, PCFormats
+
+DETECTORS = (IterativeRANSAC, PyramidRANSAC, RegionGrowing)
+
+STRATEGIES = (
+    StatisticalOutlierRemoval,
+    RadiusOutlierRemoval,
+    VoxelDensityOutlierRemoval,
+    ChunkedStatisticalOutlierRemoval,
+)
+
+
+def build_runner(configs: Dict[str, Any], scene_dir: Path, out_dir: Path) -> Runner:
+    """Fused pipeline as in main.py, which keeps all results in memory
+
+    Args:
+        configs (Dict[str, Any]): benchmark configs
+        scene_dir (Path): directory of the synthetic scenes
+        out_dir (Path): directory of the final point clouds
+
+    Returns:
+        Runner: runner of the fused pipeline
+    """
+
+    cache = None
+    if configs["CACHE"]["USE"]:
+        cache = PointCache(setup.BENCHMARK_DIR / "cache")
+
+    compact = configs["PIPELINE"].get("COMPACT", False)
+    int_writer = PointWriter(
+        configs["OUTPUT"]["INTERMEDIATE"], configs["OUTPUT"]["DROP"]
+    )
+    final_writer = PointWriter(configs["OUTPUT"]["FINAL"], configs["OUTPUT"]["DROP"])
+    dataloader = DataLoaderDS(scene_dir, configs["DOWN"], cache=cache, compact=compact)
+    detector = {cls.__name__: cls for cls in DETECTORS}[
+        configs["PLANE_DETECTION"]["METHOD"]
+    ]
+    engine = {}
+    if issubclass(detector, IterativeRANSAC):
+        if configs["RANSAC"].get("ENGINE", "BatchedPlane") == "pyransac3d":
+            engine["geometry"] = pyrsc.Plane()
+        else:
+            engine["geometry"] = BatchedPlane(configs["RANSAC"])
+    plane_detector = detector(
+        dataloader=dataloader,
+        **engine,
+        out_dir=out_dir,
+        ransac_params=configs["RANSAC"],
+        store_eqs=False,
+        detect_params=configs["PLANE_DETECTION"],
+        writer=int_writer,
+    )
+    plane_remover = PlaneRemovalAll(
+        dataloader=DataLoaderSTD(scene_dir, cache=cache, compact=compact),
+        out_dir=out_dir,
+        plane_store=PlaneStore(out_dir / "planes.sqlite"),
+        remove_params=configs["PLANE_REMOVAL"],
+        store=False,
+        writer=int_writer,
+    )
+    strategy = {cls.__name__: cls for cls in STRATEGIES}[
+        configs["OUT_REMOVAL"]["METHOD"]
+    ]
+    context = Context(
+        strategy(out_dir, DataLoaderSTD(out_dir), configs["OUT_REMOVAL"], final_writer),
+        display=False,
+    )
+    return Runner(
+        plane_detector=plane_detector,
+        plane_remover=plane_remover,
+        out_remover=context,
+        pc_formats=PCFormats,
+        configs=configs,
+        dataloader=dataloader,
+    )
+
+
+def run_scale(configs: Dict[str, Any], scene: str) -> Dict[str, Any]:
+    """Run the full pipeline and every outlier strategy on a single scene. Runs
+    in a fresh process, so the peak memory belongs to this scene only.
+
+    Args:
+        configs (Dict[str, Any]): benchmark configs
+        scene (str): filename of the synthetic scene
+
+    Returns:
+        Dict[str, Any]: throughput and peak memory per stage and the results
+    """
+    scene_dir = setup.BENCHMARK_DIR / "scenes"
+    out_dir = setup.BENCHMARK_DIR / "output"
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+
+    runner = build_runner(configs, scene_dir, out_dir)
+    metrics.drain()
+    points_out = None
+    with metrics.track_file(scene):
+        with metrics.stage("runner", points_in=count_points(scene_dir / scene)):
+            runner.process_file(scene)
+
+        # Every outlier strategy on the same point cloud without planes
+        cloud = runner.plane_remover.pcd_out
+        for cls in STRATEGIES:
+            try:
+                strategy = cls(out_dir, None, configs["OUT_REMOVAL"])
+            except KeyError:
+                continue
+            with metrics.stage(
+                f"outlier_removal[{cls.__name__}]", points_in=len(cloud.points)
+            ) as record:
+                _, ind = strategy.filter_outliers(cloud)
+                record["points_out"] = len(ind)
+            if cls.__name__ == configs["OUT_REMOVAL"]["METHOD"]:
+                points_out = len(ind)
+
+    stages: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for record in metrics.drain():
+        stage = stages[record["stage"]]
+        stage["runs"] += 1
+        stage["wall_s"] += record["wall_s"]
+        # Loading and saving stages only know their output size
+        stage["points"] += record.get("points_in") or record.get("points_out") or 0
+
+    return {
+        "stages": {
+            name: {
+                "runs": int(stage["runs"]),
+                "wall_s": stage["wall_s"],
+                "points_per_s": stage["points"] / max(stage["wall_s"], 1e-9),
+            }
+            for name, stage in stages.items()
+        },
+        "planes": len(runner.plane_detector.eqs),
+        "points_out": points_out,
+        "peak_rss_bytes": metrics.peak_rss(),
+    }
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Regressions of the results against a baseline
+
+    Args:
+        results (Dict[str, Any]): results per scale
+        baseline (Dict[str, Any]): baseline results per scale
+        tolerance (float): accepted relative throughput loss and memory growth
+
+    Returns:
+        List[str]: description of every regression
+    """
+    regressions = []
+    for scale, result in results.items():
+        if scale not in baseline:
+            continue
+        base = baseline[scale]
+        for name, stage in result["stages"].items():
+            if name not in base["stages"]:
+                continue
+            ratio = stage["points_per_s"] / max(
+                base["stages"][name]["points_per_s"], 1e-9
+            )
+            if ratio < 1 - tolerance:
+                regressions.append(f"{scale} points, {name}: {ratio:.2f}x throughput")
+        if base["peak_rss_bytes"] and result["peak_rss_bytes"]:
+            ratio = result["peak_rss_bytes"] / base["peak_rss_bytes"]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{scale} points: {ratio:.2f}x peak memory")
+        for key in ("planes", "points_out"):
+            if result[key] != base[key]:
+                regressions.append(
+                    f"{scale} points: {key} changed from {base[key]} to {result[key]}"
+                )
+    return regressions
+
+
+def main():
+    """Benchmark the pipeline on synthetic scenes of multiple scales."""
+    argparser = ArgumentParser(description="Plane Removal Benchmark")
+    argparser.add_argument(
+        "--config",
+        type=str,
+        default="config",
+        help="Config File with a BENCHMARK section. Supported:\n" "- config",
+    )
+    argparser.add_argument(
+        "--scales",
+        type=str,
+        default=None,
+        help="Comma separated point counts, overrides BENCHMARK.SCALES.",
+    )
+    argparser.add_argument(
+        "--baseline",
+        type=Path,
+        default=setup.BENCHMARK_DIR / "baseline.json",
+        help="Baseline results to compare against.",
+    )
+    argparser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline.",
+    )
+    args = argparser.parse_args()
+
+    configs = load_dict_from_yaml(setup.CONFIG_DIR / (args.config + ".yaml"))
+    bench_params = configs["BENCHMARK"]
+    scales = bench_params["SCALES"]
+    if args.scales:
+        scales = [int(float(scale)) for scale in args.scales.split(",")]
+
+    # The benchmark never opens windows and keeps results in memory
+    configs = copy.deepcopy(configs)
+    configs["DEBUG"] = configs["VERBOSE"] = False
+    configs["OUT_REMOVAL"]["USE"] = configs["PLANE_REMOVAL"]["USE"] = True
+
+    results = {}
+    for n_points in scales:
+        room = SyntheticRoom(n_points, bench_params)
+        scene = setup.BENCHMARK_DIR / "scenes" / room.name
+        if not scene.is_file():
+            print(f"Generating '{room.name}'...")
+            room.write(scene)
+        if configs["CACHE"]["USE"]:
+            PointCache(setup.BENCHMARK_DIR / "cache").load_arrays(scene)
+
+        with Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_scale, (configs, room.name))
+        result["true_planes"] = len(room.planes)
+        results[str(n_points)] = result
+
+        print(
+            f"{n_points} points: {result['planes']}/{len(room.planes)} planes, "
+            f"peak memory {(result['peak_rss_bytes'] or 0) / 2**20:.0f} MB"
+        )
+        for name, stage in result["stages"].items():
+            print(
+                f"  {name:<45} {stage['wall_s']:9.3f} s "
+                f"{stage['points_per_s']:14.0f} points/s"
+            )
+
+    # Outside of the logs, which main.py cleans up
+    (setup.BENCHMARK_DIR / "results.json").write_text(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Stored baseline in {args.baseline}")
+        return
+
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline, bench_params["TOLERANCE"])
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline!")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,26 @@ from argparse import ArgumentParser
 import pyransac3d as pyrsc
 
 import system_setup as setup
-from processors.plane_detection import IterativeRANSAC
+from processors.plane_detection import IterativeRANSAC, PyramidRANSAC, RegionGrowing
+from processors.geometry import BatchedPlane
 from processors.plane_removal import PlaneRemovalAll
 from processors.outlier_removal import (
     Context,
     StatisticalOutlierRemoval,
     RadiusOutlierRemoval,
+    VoxelDensityOutlierRemoval,
+    ChunkedStatisticalOutlierRemoval,
 )
 from utils.dataloader import DataLoaderDS, DataLoaderSTD
-from utils.utils import multi_processing, timer, folder_cleanup, load_dict_from_yaml
+from utils.pointcache import PointCache
+from utils.planestore import PlaneStore
+from utils.pointwriter import PointWriter
+from utils.resultcache import ResultCache
+from utils.utils import timer, folder_cleanup, load_dict_from_yaml, str_to_bool
 from utils.runner import Runner, PCFormats
+from utils.scheduler import JobScheduler
+from utils.service import WatchService
+from utils import metrics
 from utils.enums import Mode
 
 
@@ -29,10 +39,36 @@ def main():
     )
     argparser.add_argument(
         "--clean",
-        type=bool,
+        type=str_to_bool,
+        nargs="?",
+        const=True,
         default=True,
         help="Remove intermediate and final point cloud files from previous calls.",
     )
+    argparser.add_argument(
+        "--serve",
+        type=str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Keep running and process new files in the raw directory as they land.",
+    )
+    argparser.add_argument(
+        "--profile",
+        type=str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Write a timeline of all stages of all workers of a batch run to "
+        "logs/trace.json, which chrome://tracing and Perfetto open.",
+    )
+    argparser.add_argument(
+        "--profile-stages",
+        type=str,
+        default="",
+        help="Comma-separated stages, e.g. 'plane_detection,outlier_removal', "
+        "which are profiled with cProfile into logs/<stage>.<pid>.prof.",
+    )
     args = argparser.parse_args()
 
     # Setup the configs directory
@@ -55,31 +91,88 @@ def main():
     if args.clean:
         folder_cleanup([INT_DATA_DIR, FINAL_DATA_DIR, LOGS_DIR])
 
+    # cProfile of the selected stages in every process
+    stages = {stage for stage in args.profile_stages.split(",") if stage}
+    metrics.profile_stages(stages, LOGS_DIR if stages else None)
+
+    # The fused pipeline keeps intermediate results in memory
+    fused = configs["PIPELINE"]["FUSED"]
+    store_intermediate = not fused or configs["PIPELINE"]["STORE_INTERMEDIATE"]
+    # Tiles only store the final point cloud
+    tiled = configs["TILING"]["USE"]
+    if tiled:
+        store_intermediate = False
+
+    # Raw files are parsed once into memory-mappable binary columns
+    cache = PointCache(setup.POINT_CACHE_DIR) if configs["CACHE"]["USE"] else None
+    # Float32 points and uint8 colors between the stages
+    compact = configs["PIPELINE"].get("COMPACT", False)
+
+    # Output formats, which are written atomically
+    int_writer = PointWriter(
+        configs["OUTPUT"]["INTERMEDIATE"], configs["OUTPUT"]["DROP"]
+    )
+    final_writer = PointWriter(configs["OUTPUT"]["FINAL"], configs["OUTPUT"]["DROP"])
+
+    # Stage results survive the clean up and are reused for unchanged files
+    result_cache = None
+    if configs["RESULT_CACHE"]["USE"]:
+        max_mb = configs["RESULT_CACHE"]["MAX_MB"]
+        result_cache = ResultCache(
+            setup.RESULT_CACHE_DIR, max_mb * 2**20 if max_mb else None
+        )
+
+    # Plane equations of all files, shared by the detection and removal workers
+    plane_store = PlaneStore(setup.PLANE_STORE)
+
     # Instantiate relevant objects for the runner
-    plane_detector = IterativeRANSAC(
-        dataloader=DataLoaderDS(
-            dir_path=RAW_DATA_DIR,
-            down_params=configs["DOWN"],
-            verbose=configs["VERBOSE"],
-        ),
-        geometry=pyrsc.Plane(),
+    dataloader = DataLoaderDS(
+        dir_path=RAW_DATA_DIR,
+        down_params=configs["DOWN"],
+        verbose=configs["VERBOSE"],
+        cache=cache,
+        compact=compact,
+    )
+
+    # Choose the RANSAC plane engine, region growing fits its planes without one
+    detector = eval(configs["PLANE_DETECTION"]["METHOD"])
+    engine = {}
+    if issubclass(detector, IterativeRANSAC):
+        if configs["RANSAC"].get("ENGINE", "BatchedPlane") == "pyransac3d":
+            engine["geometry"] = pyrsc.Plane()
+        else:
+            engine["geometry"] = BatchedPlane(configs["RANSAC"])
+
+    plane_detector = detector(
+        dataloader=dataloader,
+        **engine,
         out_dir=INT_DATA_DIR,
         ransac_params=configs["RANSAC"],
         debug=configs["DEBUG"],
+        # The fused pipeline stores the planes itself, also on cache hits
+        store_eqs=store_intermediate and not fused,
+        detect_params=configs["PLANE_DETECTION"],
+        writer=int_writer,
+        plane_store=plane_store,
     )
 
     plane_remover = PlaneRemovalAll(
-        dataloader=DataLoaderSTD(RAW_DATA_DIR),
+        dataloader=DataLoaderSTD(RAW_DATA_DIR, cache=cache, compact=compact),
         out_dir=INT_DATA_DIR,
-        eqs_dir=LOGS_DIR,
+        plane_store=plane_store,
         remove_params=configs["PLANE_REMOVAL"],
+        store=store_intermediate,
+        writer=int_writer,
     )
 
     context = Context(
         eval(configs["OUT_REMOVAL"]["METHOD"])(
             out_dir=FINAL_DATA_DIR,
-            dataloader=DataLoaderSTD(INT_DATA_DIR),
+            dataloader=DataLoaderSTD(
+                INT_DATA_DIR, compact=compact, suffix=int_writer.suffix
+            ),
             out_params=configs["OUT_REMOVAL"],
+            writer=final_writer,
         )
     )
 
@@ -89,14 +182,84 @@ def main():
         out_remover=context,
         pc_formats=PCFormats,
         configs=configs,
+        dataloader=dataloader,
+        result_cache=result_cache,
     )
 
-    # plane detection in downsampled point cloud data
-    multi_processing(runner.detect_plane, os.listdir(DIRECTORY))
+    try:
+        # warm worker pool, which processes every new file of the raw directory
+        if args.serve:
+            if tiled:
+                raise ValueError("The service does not support tiled processing!")
+            service = WatchService(
+                JobScheduler(configs["SCHEDULER"]),
+                runner.process_file if fused else runner.process_file_staged,
+                RAW_DATA_DIR,
+                configs["SERVICE"],
+                suffixes=tuple(enum.name.lower() for enum in PCFormats),
+                prefetch=runner.prefetch,
+                metrics_path=(
+                    LOGS_DIR / "metrics.jsonl" if configs["METRICS"]["USE"] else None
+                ),
+            )
+            service.run()
+            return
+
+        # out-of-core processing, one file after another with parallel tiles
+        if tiled:
+            files = os.listdir(DIRECTORY)
+            failed = {}
+            for file in files:
+                filename = os.fsdecode(file)
+                with metrics.track_file(filename), metrics.stage("job") as record:
+                    try:
+                        runner.process_file_tiled(file)
+                    except Exception as exc:
+                        failed[filename] = f"{type(exc).__name__}: {exc}"
+                    record["error"] = failed.get(filename)
+            if failed:
+                print(f"{len(failed)} of {len(files)} file(s) failed:")
+                for filename, error in failed.items():
+                    print(f"  {filename}: {error}")
+            return
+
+        # Largest files first, within the memory budget of the machine
+        scheduler = JobScheduler(configs["SCHEDULER"])
+
+        # detection, removal and outlier removal with a single load per file
+        if fused:
+            scheduler.run(
+                runner.process_file,
+                os.listdir(DIRECTORY),
+                RAW_DATA_DIR,
+                prefetch=runner.prefetch,
+            )
+            return
+
+        # plane detection in downsampled point cloud data
+        failed = scheduler.run(
+            runner.detect_plane,
+            os.listdir(DIRECTORY),
+            RAW_DATA_DIR,
+            prefetch=runner.prefetch,
+        )
 
-    # plane removal from original point cloud data
-    if configs["PLANE_REMOVAL"]["USE"]:
-        multi_processing(runner.remove_plane, os.listdir(DIRECTORY))
+        # plane removal from original point cloud data
+        if configs["PLANE_REMOVAL"]["USE"]:
+            files = [file for file in os.listdir(RAW_DATA_DIR) if file not in failed]
+            scheduler.run(
+                runner.remove_plane, files, RAW_DATA_DIR, prefetch=runner.prefetch
+            )
+    finally:
+        # Records of all stages, including the ones of the workers, the service
+        # appends them after every job
+        records = metrics.drain()
+        if configs["METRICS"]["USE"] and not args.serve:
+            metrics.write_jsonl(LOGS_DIR / "metrics.jsonl", records)
+            metrics.write_prometheus(LOGS_DIR / "metrics.prom", records)
+        if args.profile:
+            metrics.write_chrome_trace(LOGS_DIR / "trace.json", records)
+        metrics.dump_profiles()
 
 
 if __name__ == "__main__":
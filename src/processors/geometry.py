@@ -0,0 +1,203 @@
+"""Built-in RANSAC plane engine, drop-in replacement for pyransac3d.Plane"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+
+class BatchedPlane:
+    """
+    RANSAC plane fit, which draws all hypothesis triplets up front and scores
+    them in memory-bounded blocks of vectorized NumPy operations. The blocks of
+    a single fit can be scored by several threads, which share the points.
+    """
+
+    def __init__(self, ransac_params: Dict[str, Any]):
+
+        self.max_iteration = ransac_params.get("MAX_ITERATION", 1000)
+        self.block_bytes = int(ransac_params.get("BLOCK_MB", 64) * 2**20)
+        self.seed = ransac_params.get("SEED")
+        self.workers = ransac_params.get("WORKERS", 1) or os.cpu_count() or 1
+        # Share of inliers, which an additional plane of a run may share
+        self.max_overlap = ransac_params.get("MAX_OVERLAP", 0.1)
+        self.rng = np.random.default_rng(self.seed)
+
+    def fit(
+        self, pts: np.ndarray, thresh: float = 0.05
+    ) -> Tuple[List[float], np.ndarray]:
+        """Find the best plane in a point set, same signature as pyransac3d.Plane.fit
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+            thresh (float, optional): inlier distance threshold. Defaults to 0.05.
+
+        Returns:
+            Tuple[List[float], np.ndarray]: plane equation [a, b, c, d] with unit
+            normal and the indices of its inliers
+        """
+        pts = self._as_array(pts)
+        normals, offsets = self._hypotheses(pts)
+        if not len(normals):
+            return [], np.empty(0, dtype=np.int64)
+
+        counts = self._count_inliers(pts, normals, offsets, thresh)
+        best = int(np.argmax(counts))
+
+        return self._plane(pts, normals[best], offsets[best], thresh)
+
+    def fit_many(
+        self, pts: np.ndarray, thresh: float, top_k: int, min_inliers: int
+    ) -> List[Tuple[List[float], np.ndarray]]:
+        """Find up to top_k planes in a single RANSAC run. The hypotheses are
+        visited by descending inlier count, a hypothesis is accepted, if at most
+        MAX_OVERLAP of its inliers belong to an accepted plane and its remaining
+        inliers are at least min_inliers.
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+            thresh (float): inlier distance threshold
+            top_k (int): maximal number of planes
+            min_inliers (int): minimal number of inliers of a plane
+
+        Returns:
+            List[Tuple[List[float], np.ndarray]]: plane equations and the indices
+            of their disjoint inliers, the best plane first, which is the plane of
+            fit even if it has too few inliers
+        """
+        pts = self._as_array(pts)
+        normals, offsets = self._hypotheses(pts)
+        if not len(normals):
+            return [([], np.empty(0, dtype=np.int64))]
+
+        counts = self._count_inliers(pts, normals, offsets, thresh)
+        order = np.argsort(-counts, kind="stable")
+        planes = [self._plane(pts, normals[order[0]], offsets[order[0]], thresh)]
+
+        claimed = np.zeros(len(pts), dtype=bool)
+        claimed[planes[0][1]] = True
+        for hypothesis in order[1:]:
+            # Later hypotheses can only lose inliers to the accepted planes
+            if len(planes) >= top_k or counts[hypothesis] < min_inliers:
+                break
+            eq, inliers = self._plane(
+                pts, normals[hypothesis], offsets[hypothesis], thresh
+            )
+            shared = np.count_nonzero(claimed[inliers])
+            if shared > self.max_overlap * len(inliers):
+                continue
+            inliers = inliers[~claimed[inliers]]
+            if len(inliers) < min_inliers:
+                continue
+            claimed[inliers] = True
+            planes.append((eq, inliers))
+
+        return planes
+
+    def _rng(self) -> np.random.Generator:
+        """A fixed seed restarts the generator on every fit, so every fit is
+        reproducible for the same input, independent of the fits before it.
+
+        Returns:
+            np.random.Generator: random number generator for one fit
+        """
+        if self.seed is None:
+            return self.rng
+        return np.random.default_rng(self.seed)
+
+    def _hypotheses(self, pts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Draw all hypothesis triplets at once and turn them into planes
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (H, 3) unit normals and (H,) offsets of
+            all non-degenerate hypotheses
+        """
+        if len(pts) < 3:
+            return np.empty((0, 3)), np.empty(0)
+
+        idx = self._rng().integers(0, len(pts), size=(self.max_iteration, 3))
+        p_0 = pts[idx[:, 0]].astype(np.float64)
+        normals = np.cross(pts[idx[:, 1]] - p_0, pts[idx[:, 2]] - p_0)
+        norms = np.linalg.norm(normals, axis=1)
+
+        # Drop collinear and repeated samples
+        valid = norms > np.finfo(np.float64).eps
+        normals = normals[valid] / norms[valid, None]
+        offsets = -np.einsum("ij,ij->i", normals, p_0[valid])
+
+        return normals, offsets
+
+    def _count_inliers(
+        self, pts: np.ndarray, normals: np.ndarray, offsets: np.ndarray, thresh: float
+    ) -> np.ndarray:
+        """Count the inliers of all hypotheses, processed in blocks, which keep
+        the (N, block) distance matrices of all workers within the memory bound
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+            normals (np.ndarray): (H, 3) unit normals of the hypotheses
+            offsets (np.ndarray): (H,) offsets of the hypotheses
+            thresh (float): inlier distance threshold
+
+        Returns:
+            np.ndarray: (H,) inlier count per hypothesis
+        """
+        block = max(1, self.block_bytes // (self.workers * len(pts) * pts.itemsize))
+        # Every worker gets at least one block
+        block = min(block, -(-len(normals) // self.workers))
+        counts = np.empty(len(normals), dtype=np.int64)
+
+        def score(start: int) -> None:
+            stop = start + block
+            dists = pts @ normals[start:stop].T.astype(pts.dtype)
+            dists += offsets[start:stop].astype(pts.dtype)
+            np.abs(dists, out=dists)
+            counts[start:stop] = np.count_nonzero(dists <= thresh, axis=0)
+
+        starts = range(0, len(normals), block)
+        if self.workers == 1 or len(starts) == 1:
+            for start in starts:
+                score(start)
+        else:
+            # NumPy releases the GIL, blocks write disjoint slices of the counts
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(score, starts))
+
+        return counts
+
+    @staticmethod
+    def _plane(
+        pts: np.ndarray, normal: np.ndarray, offset: float, thresh: float
+    ) -> Tuple[List[float], np.ndarray]:
+        """Plane equation and inlier indices of a single hypothesis
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+            normal (np.ndarray): unit normal of the plane
+            offset (float): offset of the plane
+            thresh (float): inlier distance threshold
+
+        Returns:
+            Tuple[List[float], np.ndarray]: plane equation and inlier indices
+        """
+        dists = np.abs(pts @ normal.astype(pts.dtype) + offset)
+        inliers = np.flatnonzero(dists <= thresh)
+        return [*normal.tolist(), float(offset)], inliers
+
+    @staticmethod
+    def _as_array(pts: np.ndarray) -> np.ndarray:
+        """Contiguous floating point view of the points, copying only if needed
+
+        Args:
+            pts (np.ndarray): (N, 3) array of points
+
+        Returns:
+            np.ndarray: (N, 3) contiguous float array
+        """
+        pts = np.asarray(pts)
+        if pts.dtype not in (np.float32, np.float64):
+            pts = pts.astype(np.float64)
+        return np.ascontiguousarray(pts)
@@ -1,14 +1,20 @@
 """Outlier Removal Stragies"""
 from __future__ import annotations
+import os
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
 
+import numpy as np
 import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
+from scipy.spatial import cKDTree
 
-from utils.utils import timer
+from utils import metrics
 from utils.dataloader import DataLoader
+from utils.pointwriter import PointWriter
+from utils.spatialindex import VoxelHashIndex
 from .pointcloud_processor import PointCloudProcessor
 
 
@@ -18,8 +24,9 @@ class Context:
     for the outlier removal.
     """
 
-    def __init__(self, strategy: OutlierRemoval):
+    def __init__(self, strategy: OutlierRemoval, display: bool = True):
         self._strategy = strategy
+        self.display = display
 
     @property
     def strategy(self):
@@ -45,10 +52,35 @@ class Context:
             ValueError: You try to display an empty point cloud!
         """
         cl, _ = self._strategy.remove_outliers(filename)
+        self._display(cl)
+
+    def run_on_cloud(self, filename: str, pcd: PointCloud) -> None:
+        """Run the outlier removal strategy on a point cloud in memory
+
+        Args:
+            filename (str): name of the raw point cloud file
+            pcd (PointCloud): point cloud without planes
+
+        Raises:
+            ValueError: You try to display an empty point cloud!
+        """
+        cl, _ = self._strategy.remove_outliers_from_cloud(filename, pcd)
+        self._display(cl)
+
+    def _display(self, cl: PointCloud) -> None:
+        """Display the final point cloud of the strategy
+
+        Args:
+            cl (PointCloud): point cloud without outliers
+
+        Raises:
+            ValueError: You try to display an empty point cloud!
+        """
         if not cl:
             raise ValueError("You try to display an empty point cloud!")
 
-        self._strategy.display_pointcloud(cl)
+        if self.display:
+            self._strategy.display_pointcloud(cl)
         # TODO: Bug in implementation (malloc() error)
         # if debug:
         #    display_in_out(cl, id)
@@ -62,20 +94,34 @@ class OutlierRemoval(PointCloudProcessor):
     def remove_outliers(self, filename: str) -> Tuple[PointCloud, List[int]]:
         """Remove Outlier from a PointCloud"""
 
+    @abstractmethod
+    def remove_outliers_from_cloud(
+        self, filename: str, pcd: PointCloud
+    ) -> Tuple[PointCloud, List[int]]:
+        """Remove Outlier from a PointCloud in memory"""
+
+    @abstractmethod
+    def filter_outliers(self, pcd: PointCloud) -> Tuple[PointCloud, List[int]]:
+        """Remove Outlier from a PointCloud without storing the result"""
+
 
 class StatisticalOutlierRemoval(OutlierRemoval):
     """Removes outliers using statistical analysis"""
 
     def __init__(
-        self, out_dir: Path, dataloader: DataLoader, out_params: Dict[str, float]
+        self,
+        out_dir: Path,
+        dataloader: DataLoader,
+        out_params: Dict[str, float],
+        writer: Optional[PointWriter] = None,
     ):
 
         self.out_dir = out_dir
         self.dataloader = dataloader
+        self.writer = writer or PointWriter()
         self.nb_neighbors = out_params["NB_NEIGHBORS"]
         self.std_ratio = out_params["STD_RATIO"]
 
-    @timer
     def remove_outliers(self, filename: str) -> Tuple[PointCloud, List[int]]:
         """Removes outliers based on statistical analysis
 
@@ -85,32 +131,64 @@ class StatisticalOutlierRemoval(OutlierRemoval):
         Returns:
             Tuple[PointCloud, List[int]]: final point cloud
         """
-        print("Statistical outlier removal...")
-
         pcd: PointCloud = self.dataloader.load_data(filename)
+        return self.remove_outliers_from_cloud(filename, pcd)
 
-        cl, ind = pcd.remove_statistical_outlier(
-            nb_neighbors=self.nb_neighbors, std_ratio=self.std_ratio
-        )
+    def remove_outliers_from_cloud(
+        self, filename: str, pcd: PointCloud
+    ) -> Tuple[PointCloud, List[int]]:
+        """Removes outliers based on statistical analysis from a point cloud
+        in memory
+
+        Args:
+            filename (str): name of the raw point cloud file
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: final point cloud
+        """
+        print("Statistical outlier removal...")
+
+        with metrics.stage("outlier_removal", points_in=len(pcd.points)) as record:
+            cl, ind = self.filter_outliers(pcd)
+            record["points_out"] = len(ind)
 
         self.save_pcs(filename, self.out_dir, cl)
 
         return (cl, ind)
 
+    def filter_outliers(self, pcd: PointCloud) -> Tuple[PointCloud, List[int]]:
+        """Removes outliers based on statistical analysis without storing them
+
+        Args:
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        return pcd.remove_statistical_outlier(
+            nb_neighbors=self.nb_neighbors, std_ratio=self.std_ratio
+        )
+
 
 class RadiusOutlierRemoval(OutlierRemoval):
     """Removes outliers within a provided radius"""
 
     def __init__(
-        self, out_dir: Path, dataloader: DataLoader, out_params: Dict[str, float]
+        self,
+        out_dir: Path,
+        dataloader: DataLoader,
+        out_params: Dict[str, float],
+        writer: Optional[PointWriter] = None,
     ):
 
         self.out_dir = out_dir
         self.dataloader = dataloader
+        self.writer = writer or PointWriter()
         self.nb_points = out_params["NB_POINTS"]
         self.radius = out_params["RADIUS"]
 
-    @timer
     def remove_outliers(self, filename: str) -> Tuple[PointCloud, List[int]]:
         """Removes outliers within a provided radius
 
@@ -120,14 +198,274 @@ class RadiusOutlierRemoval(OutlierRemoval):
         Returns:
             Tuple[PointCloud, List[int]]: final point cloud
         """
-        print("Radius outlier removal...")
-
         pcd: PointCloud = self.dataloader.load_data(filename)
+        return self.remove_outliers_from_cloud(filename, pcd)
 
-        cl, ind = pcd.remove_radius_outlier(
-            nb_points=self.nb_points, radius=self.radius
-        )
+    def remove_outliers_from_cloud(
+        self, filename: str, pcd: PointCloud
+    ) -> Tuple[PointCloud, List[int]]:
+        """Removes outliers within a provided radius from a point cloud
+        in memory
+
+        Args:
+            filename (str): name of the raw point cloud file
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: final point cloud
+        """
+        print("Radius outlier removal...")
+
+        with metrics.stage("outlier_removal", points_in=len(pcd.points)) as record:
+            cl, ind = self.filter_outliers(pcd)
+            record["points_out"] = len(ind)
 
         self.save_pcs(filename, self.out_dir, cl)
 
         return (cl, ind)
+
+    def filter_outliers(self, pcd: PointCloud) -> Tuple[PointCloud, List[int]]:
+        """Removes outliers within a provided radius without storing them
+
+        Args:
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        return pcd.remove_radius_outlier(nb_points=self.nb_points, radius=self.radius)
+
+
+class VoxelDensityOutlierRemoval(RadiusOutlierRemoval):
+    """
+    Approximates the radius outlier removal by hashing the points into voxels of
+    edge length RADIUS * VOXEL_FACTOR and counting the points in the 27 voxels
+    around each point instead of querying a KD-tree. The default factor of 0.6
+    gives the 3x3 voxels the area of the radius disc on scanned surfaces. With a
+    factor of 1 the neighbourhood contains the full radius, so no point is
+    removed, which the radius outlier removal keeps.
+    """
+
+    def __init__(
+        self,
+        out_dir: Path,
+        dataloader: DataLoader,
+        out_params: Dict[str, float],
+        writer: Optional[PointWriter] = None,
+    ):
+
+        super().__init__(out_dir, dataloader, out_params, writer)
+        self.voxel_size = self.radius * out_params.get("VOXEL_FACTOR", 0.6)
+        self.validate = out_params.get("VALIDATE", False)
+
+    def filter_outliers(self, pcd: PointCloud) -> Tuple[PointCloud, List[int]]:
+        """Removes points in sparse voxel neighbourhoods without storing them
+
+        Args:
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        keep = self.neighbourhood_counts(np.asarray(pcd.points)) >= self.nb_points
+        ind = np.flatnonzero(keep).tolist()
+
+        if self.validate:
+            rate = self.agreement(pcd, keep)
+            metrics.record_event("outlier_agreement", agreement=rate)
+            print(f"Agreement with the radius outlier removal: {rate:.4f}")
+        return pcd.select_by_index(ind), ind
+
+    def neighbourhood_counts(self, points: np.ndarray) -> np.ndarray:
+        """Number of points in the 3x3x3 voxels around the voxel of each point
+
+        Args:
+            points (np.ndarray): (N, 3) points
+
+        Returns:
+            np.ndarray: (N,) neighbourhood counts, including the point itself
+        """
+        if not len(points):
+            return np.empty(0, dtype=np.int64)
+        return VoxelHashIndex(points, self.voxel_size).neighbourhood_counts()
+
+    def agreement(self, pcd: PointCloud, keep: Optional[np.ndarray] = None) -> float:
+        """Share of points, which the radius outlier removal classifies alike
+
+        Args:
+            pcd (PointCloud): point cloud without planes
+            keep (Optional[np.ndarray], optional): kept points of this filter.
+            Defaults to None, which filters the point cloud again.
+
+        Returns:
+            float: agreement rate in [0, 1]
+        """
+        points = np.asarray(pcd.points)
+        if not len(points):
+            return 1.0
+        if keep is None:
+            keep = self.neighbourhood_counts(points) >= self.nb_points
+        _, ind = super().filter_outliers(pcd)
+        reference = np.zeros(len(points), dtype=bool)
+        reference[np.asarray(ind, dtype=np.int64)] = True
+        return float(np.mean(keep == reference))
+
+
+class ChunkedStatisticalOutlierRemoval(StatisticalOutlierRemoval):
+    """
+    Removes outliers using statistical analysis with the same result as
+    StatisticalOutlierRemoval. The cloud is split into slabs along its longest
+    axis, whose k-NN distances are computed on worker threads, cKDTree releases
+    the GIL. Threads also run inside the daemonic tile workers, which cannot
+    start processes. Each slab sees its neighbours up to a halo margin, points
+    whose k nearest neighbours might lie beyond the margin are recomputed with a
+    wide enough margin.
+    """
+
+    def __init__(
+        self,
+        out_dir: Path,
+        dataloader: DataLoader,
+        out_params: Dict[str, float],
+        writer: Optional[PointWriter] = None,
+    ):
+
+        super().__init__(out_dir, dataloader, out_params, writer)
+        self.chunk_size = out_params.get("CHUNK_SIZE", 2**20)
+        self.halo = out_params.get("HALO", 0.1)
+        self.workers = out_params.get("WORKERS") or os.cpu_count() or 1
+
+    def filter_outliers(self, pcd: PointCloud) -> Tuple[PointCloud, List[int]]:
+        """Removes outliers based on statistical analysis without storing them,
+        following Open3D's remove_statistical_outlier
+
+        Args:
+            pcd (PointCloud): point cloud without planes
+
+        Returns:
+            Tuple[PointCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        points = np.asarray(pcd.points)
+        k = min(self.nb_neighbors, len(points))
+        if not k:
+            return pcd.select_by_index([]), []
+
+        avg = self.mean_distances(points, k)
+
+        # Points without distinct neighbours count as valid, but not in the sums
+        positive = avg > 0
+        cloud_mean = avg[positive].sum() / len(avg)
+        sq_sum = np.square(avg[positive] - cloud_mean).sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std_dev = np.sqrt(np.float64(sq_sum) / (len(avg) - 1))
+        threshold = cloud_mean + self.std_ratio * std_dev
+
+        ind = np.flatnonzero(positive & (avg < threshold)).tolist()
+        return pcd.select_by_index(ind), ind
+
+    def mean_distances(self, points: np.ndarray, k: int) -> np.ndarray:
+        """Mean distance of every point to its k nearest neighbours, including
+        the point itself
+
+        Args:
+            points (np.ndarray): (N, 3) points
+            k (int): number of neighbours
+
+        Returns:
+            np.ndarray: (N,) mean distances
+        """
+        axis = int(np.ptp(points, axis=0).argmax())
+        order = np.argsort(points[:, axis], kind="stable")
+        ordered = points[order]
+        coords = ordered[:, axis]
+
+        slabs = [
+            np.arange(start, min(start + self.chunk_size, len(points)))
+            for start in range(0, len(points), self.chunk_size)
+        ]
+        means = np.empty(len(points))
+        kth = np.empty(len(points))
+        margins = [self.halo] * len(slabs)
+
+        # A second pass only recomputes points, whose neighbourhood was cut off
+        for _ in range(2):
+            tasks, bounds = [], []
+            for queries, margin in zip(slabs, margins):
+                lower = coords[queries[0]] - margin
+                upper = coords[queries[-1]] + margin
+                low = np.searchsorted(coords, lower, "left")
+                high = np.searchsorted(coords, upper, "right")
+                tasks.append((ordered[low:high], ordered[queries], k))
+                # The region holds all points within its bounds
+                bounds.append(
+                    (lower if low else -np.inf, upper if high < len(points) else np.inf)
+                )
+
+            for queries, (mean, dist) in zip(slabs, self._map(tasks)):
+                means[queries], kth[queries] = mean, dist
+
+            # All points closer than the k-th neighbour must lie inside the region
+            slabs_left, margins = [], []
+            for queries, (lower, upper) in zip(slabs, bounds):
+                cut = (coords[queries] - kth[queries] < lower) | (
+                    coords[queries] + kth[queries] > upper
+                )
+                if cut.any():
+                    slabs_left.append(queries[cut])
+                    # The k-th distance within a subset bounds the true one
+                    margins.append(kth[queries[cut]].max())
+            slabs = slabs_left
+            if not slabs:
+                break
+
+        avg = np.empty(len(points))
+        avg[order] = means
+        return avg
+
+    def _map(self, tasks: List[Tuple[np.ndarray, np.ndarray, int]]) -> List[Tuple]:
+        """Compute the k-NN distances of all slabs on parallel threads
+
+        Args:
+            tasks (List[Tuple[np.ndarray, np.ndarray, int]]): region, queries
+                and k per slab
+
+        Returns:
+            List[Tuple]: mean and k-th distances per slab
+        """
+        if self.workers == 1 or len(tasks) == 1:
+            return [_knn_distances(*task) for task in tasks]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda task: _knn_distances(*task), tasks))
+
+
+def _knn_distances(
+    region: np.ndarray, queries: np.ndarray, k: int, block_bytes: int = 2**26
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and k-th distance of the k nearest neighbours within a region
+
+    Args:
+        region (np.ndarray): (M, 3) points of the slab and its halo
+        queries (np.ndarray): (Q, 3) points of the slab
+        k (int): number of neighbours
+        block_bytes (int, optional): memory bound of the queried distances.
+            Defaults to 2**26.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (Q,) mean and (Q,) k-th distances, the
+        latter is inf if the region has less than k points
+    """
+    tree = cKDTree(region)
+    means = np.empty(len(queries))
+    kth = np.empty(len(queries))
+    block = max(1, block_bytes // (24 * k))
+    for start in range(0, len(queries), block):
+        stop = start + block
+        dists, _ = tree.query(queries[start:stop], k=k)
+        dists = dists.reshape(-1, k)
+        # Accumulate in neighbour order like Open3D, not pairwise
+        means[start:stop] = np.cumsum(dists, axis=1)[:, -1] / k
+        kth[start:stop] = dists[:, -1]
+    return means, kth
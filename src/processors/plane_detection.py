@@ -1,150 +1,646 @@
 """Plane Detection Interface and concrete RANSAC implementation"""
-import pickle
 from abc import abstractmethod
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
 import numpy as np
 import pyransac3d as pyrsc
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 import system_setup as setup
-from utils.utils import timer
-from utils.dataloader import DataLoader
+from utils import metrics
+from utils.compactcloud import to_open3d
+from utils.planestore import PlaneStore
+from utils.pointwriter import PointWriter
+from utils.tiling import merge_planes
+from utils.utils import assign_to_planes, select_points
+from utils.dataloader import DataLoader, DataLoaderDS
+from .geometry import BatchedPlane
 from .pointcloud_processor import PointCloudProcessor
 
 
 class PlaneDetection(PointCloudProcessor):
-    """Abstract Class of Plane Detection"""
-
-    @abstractmethod
-    def detect_planes(self, filename: str) -> PointCloud:
-        """Plane Detection"""
-
-    @abstractmethod
-    def _store_best_eqs(self, filename: str) -> None:
-        """Store Best Plane Equations"""
-
-
-class IterativeRANSAC(PlaneDetection):
     """
-    Iterative RANSAC algorithm to detect n planes based on minimal plane size,
-    set by the user.
+    Abstract Class of Plane Detection. A detection fills eqs and the per-point
+    plane labels, which are stored with params in plane_store. Detectors only
+    implement _detect.
     """
 
+    # Detectors, which downsample the raw point cloud themselves
+    full_resolution: bool = False
+
     def __init__(
         self,
         dataloader: DataLoader,
-        geometry: pyrsc.Plane,
         out_dir: Path,
         ransac_params: Dict[str, float],
         debug: bool = False,
         store: bool = False,
+        store_eqs: bool = True,
+        detect_params: Optional[Dict[str, Any]] = None,
+        writer: Optional[PointWriter] = None,
+        plane_store: Optional[PlaneStore] = None,
     ):
 
         self.dataloader = dataloader
+        self.writer = writer or PointWriter()
         self.out_dir = out_dir
-        self.geometry = geometry
         self.plane_size = ransac_params["PLANE_SIZE"]
         self.thresh = ransac_params["THRESH"]
         self.store = store
+        self.store_eqs = store_eqs
+        self.plane_store = plane_store or PlaneStore(setup.PLANE_STORE)
+        # Stored with the planes of every file
+        self.params = {
+            "RANSAC": dict(ransac_params),
+            "PLANE_DETECTION": dict(detect_params or {}),
+        }
         self.debug = debug
         self.pcd_out: PointCloud = None
         self.eqs: List[List[Any]] = []
+        # Plane index per point of the downsampled cloud, -1 for no plane
+        self.labels: np.ndarray = np.empty(0, dtype=np.int32)
+        # Index of each remaining point in the raw point cloud
+        self.indices: np.ndarray = np.empty(0, dtype=np.int64)
         # For debugging only!
         self.planes: List[PointCloud] = []
 
-    @timer
     def detect_planes(self, filename: str) -> PointCloud:
-        """Detect planes using an iterative RANSAC algorithm
+        """Detect planes in a raw point cloud file, which is downsampled unless
+        the detector works at full resolution
 
         Args:
             filename (str): path to raw point cloud file
 
         Returns:
-            PointCloud: downsampled point cloud without detected planes
+            PointCloud: point cloud without detected planes, the per-point plane
+            labels are kept in self.labels
+        """
+        if self.full_resolution:
+            cloud, indices = self.dataloader.read_data(filename), None
+        else:
+            cloud, indices = self.dataloader.load_data_with_indices(filename)
+        return self.detect_planes_in_cloud(filename, cloud, indices)
+
+    def detect_planes_in_cloud(
+        self,
+        filename: str,
+        cloud: PointCloud,
+        indices: Optional[np.ndarray] = None,
+        plane_size: Optional[int] = None,
+    ) -> PointCloud:
+        """Detect planes in a point cloud, which is already in memory
+
+        Args:
+            filename (str): name of the raw point cloud file
+            cloud (PointCloud): point cloud, downsampled unless full_resolution
+            indices (Optional[np.ndarray], optional): raw index of each point.
+                Defaults to None, which means the cloud was not downsampled.
+            plane_size (Optional[int], optional): minimal number of inliers,
+                e.g. scaled to a tile. Defaults to None, which means PLANE_SIZE.
+
+        Returns:
+            PointCloud: point cloud without detected planes
         """
+        with metrics.stage("plane_detection", points_in=len(cloud.points)) as record:
+            self._detect(cloud, indices, plane_size)
+            record["points_out"] = len(self.indices)
+            record["planes"] = len(self.eqs)
+
+        # Store intermediate point cloud data
+        if self.store:
+            self.save_pcs(filename, self.out_dir, self.pcd_out)
 
-        cloud: PointCloud = self.dataloader.load_data(filename)
+        # Store best plane equations
+        if self.store_eqs:
+            self._store_best_eqs(filename)
+
+        print(f"Identified {len(self.eqs)} plane(s) in point cloud '{filename}'")
+        return self.pcd_out
+
+    @abstractmethod
+    def _detect(
+        self,
+        cloud: PointCloud,
+        indices: Optional[np.ndarray],
+        plane_size: Optional[int] = None,
+    ) -> None:
+        """Plane Detection, fills eqs, labels, pcd_out and indices"""
+
+    def _store_best_eqs(self, filename: str) -> None:
+        """Saves best plane equations with their inlier counts in the plane store
+
+        Args:
+            filename (str): name of the raw point cloud file
+        """
+        self.store_planes(filename, *self.detected_planes())
+
+    def detected_planes(self) -> Tuple[List[List[float]], List[int], int]:
+        """Planes of the last detection
+
+        Returns:
+            Tuple[List[List[float]], List[int], int]: plane equations, their
+            inlier counts and the number of points, in which they were detected
+        """
+        inliers = np.bincount(self.labels[self.labels >= 0], minlength=len(self.eqs))
+        return self.eqs, inliers.tolist(), len(self.labels)
+
+    def store_planes(
+        self, filename: str, eqs: List[List[float]], inliers: List[int], points: int
+    ) -> None:
+        """Saves plane equations of a file with the parameters of this detector,
+        e.g. planes, which were restored from the result cache
+
+        Args:
+            filename (str): name of the raw point cloud file
+            eqs (List[List[float]]): plane equations
+            inliers (List[int]): inlier count of every plane
+            points (int): number of points, in which the planes were detected
+        """
+        try:
+            self.plane_store.store(
+                filename,
+                eqs,
+                inliers,
+                method=type(self).__name__,
+                points=points,
+                params=self.params,
+            )
+        except Exception as exc:
+            print(exc)
+            raise
+
+
+class IterativeRANSAC(PlaneDetection):
+    """
+    Iterative RANSAC algorithm to detect n planes based on minimal plane size,
+    set by the user.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        geometry: Union[BatchedPlane, pyrsc.Plane],
+        out_dir: Path,
+        ransac_params: Dict[str, float],
+        debug: bool = False,
+        store: bool = False,
+        store_eqs: bool = True,
+        detect_params: Optional[Dict[str, Any]] = None,
+        writer: Optional[PointWriter] = None,
+        plane_store: Optional[PlaneStore] = None,
+    ):
+
+        super().__init__(
+            dataloader,
+            out_dir,
+            ransac_params,
+            debug,
+            store,
+            store_eqs,
+            detect_params,
+            writer,
+            plane_store,
+        )
+        self.geometry = geometry
+        # Planes accepted per RANSAC run, only supported by BatchedPlane
+        self.top_k = ransac_params.get("TOP_K", 1)
+
+    def _detect(
+        self,
+        cloud: PointCloud,
+        indices: Optional[np.ndarray],
+        plane_size: Optional[int] = None,
+    ) -> None:
+        """Iterative RANSAC on a point cloud, fills eqs, labels, pcd_out and indices
+
+        Args:
+            cloud (PointCloud): downsampled point cloud
+            indices (Optional[np.ndarray]): raw index of each point
+            plane_size (Optional[int], optional): minimal number of inliers.
+                Defaults to None, which means PLANE_SIZE.
+        """
+        plane_size = plane_size or self.plane_size
         points = np.asarray(cloud.points)
+        if indices is None:
+            indices = np.arange(len(points))
+
+        # Track remaining points by index instead of rebuilding the point cloud
+        active = np.arange(len(points))
+        self.labels = np.full(len(points), -1, dtype=np.int32)
+        self.eqs = []
+        self.planes = []
 
         print("Iterative RANSAC...")
         plane_counter = 0
-        while True:
-            # Find best plane using RANSAC
-            best_eq, best_inliers = self.geometry.fit(points, self.thresh)
+        while len(active) >= plane_size:
+            # Find best plane, or the best non-overlapping planes, using RANSAC
+            with metrics.stage(
+                "ransac_plane",
+                points_in=len(active),
+                iterations=getattr(self.geometry, "max_iteration", 1000),
+            ) as record:
+                if self.top_k > 1 and hasattr(self.geometry, "fit_many"):
+                    found = self.geometry.fit_many(
+                        points[active], self.thresh, self.top_k, plane_size
+                    )
+                else:
+                    found = [self.geometry.fit(points[active], self.thresh)]
+                record["inliers"] = sum(len(inliers) for _, inliers in found)
+                record["planes"] = len(found)
 
             # Only remove planes larger than size heuristic
-            if len(best_inliers) < self.plane_size:
+            if len(found[0][1]) < plane_size:
                 break
 
-            plane_counter += 1
-            self.eqs.append(best_eq)
-            # Remove the best inliers from overall point cloud
-            pcd_points = o3d.geometry.PointCloud()
-            pcd_points.points = o3d.utility.Vector3dVector(points)
-            self.pcd_out = pcd_points.select_by_index(best_inliers, invert=True)
+            for best_eq, best_inliers in found:
+                plane_idx = active[best_inliers]
+                self.labels[plane_idx] = plane_counter
+                plane_counter += 1
+                self.eqs.append(best_eq)
 
-            if self.debug:
-                plane = pcd_points.select_by_index(best_inliers)
-                self.planes.append(plane)
+                if self.debug:
+                    self.planes.append(cloud.select_by_index(plane_idx))
 
-            points = np.asarray(self.pcd_out.points)
+            # Remove the best inliers from the remaining points
+            active = np.delete(
+                active, np.concatenate([inliers for _, inliers in found])
+            )
 
         # Display plane removals during debugging
         if self.debug and self.planes:
             print("Debugging...")
-            o3d.visualization.draw_geometries(self.planes)
+            o3d.visualization.draw_geometries(
+                [to_open3d(plane) for plane in self.planes]
+            )
 
-        # Retain color information for final point cloud
-        if not self.pcd_out:
-            raise ValueError("No point cloud was generated!")
-        self.pcd_out = self._restore_color(cloud, self.pcd_out)
+        # Gather the remaining points with their colors once
+        self.pcd_out = select_points(cloud, active)
+        self.indices = indices[active]
 
-        # Store intermediate point cloud data
-        if self.store:
-            self.save_pcs(filename, self.out_dir, self.pcd_out)
 
-        # Store best plane equations
-        self._store_best_eqs(filename)
+class PyramidRANSAC(IterativeRANSAC):
+    """
+    Coarse-to-fine plane detection. The iterative RANSAC searches planes on the
+    coarsest level of a point cloud pyramid, each plane is then refined by a
+    least-squares fit to its inliers on every finer level and finally verified
+    against its inliers at full resolution. The expensive search can thus run on
+    a far smaller point cloud than LARGE_PC without losing accuracy in the
+    plane removal.
+    """
 
-        print(f"Identified {plane_counter} plane(s) in point cloud '{filename}'")
-        return self.pcd_out
+    full_resolution = True
 
-    def _store_best_eqs(self, filename: str) -> None:
-        """Saves best plane equations in a pickle file
+    def __init__(
+        self,
+        dataloader: DataLoaderDS,
+        geometry: Union[BatchedPlane, pyrsc.Plane],
+        out_dir: Path,
+        ransac_params: Dict[str, float],
+        debug: bool = False,
+        store: bool = False,
+        store_eqs: bool = True,
+        detect_params: Optional[Dict[str, Any]] = None,
+        writer: Optional[PointWriter] = None,
+        plane_store: Optional[PlaneStore] = None,
+    ):
+
+        super().__init__(
+            dataloader,
+            geometry,
+            out_dir,
+            ransac_params,
+            debug,
+            store,
+            store_eqs,
+            detect_params,
+            writer,
+            plane_store,
+        )
+        detect_params = detect_params or {}
+        # Point counts of the levels, the coarsest level is searched
+        self.levels = sorted(detect_params.get("LEVELS", [20000, 100000, 500000]))
+        self.seed = ransac_params.get("SEED")
+
+    def _detect(
+        self,
+        cloud: PointCloud,
+        indices: Optional[np.ndarray],
+        plane_size: Optional[int] = None,
+    ) -> None:
+        """Coarse-to-fine RANSAC on a point cloud, fills eqs, labels, pcd_out and
+        indices at the resolution of the point cloud
 
         Args:
-            filename (str): filename as blueprint for pickle file
+            cloud (PointCloud): raw point cloud
+            indices (Optional[np.ndarray]): raw index of each point
+            plane_size (Optional[int], optional): minimal number of inliers at
+                the size of a large point cloud. Defaults to None, which means
+                PLANE_SIZE.
         """
-        try:
-            filename = filename.split(".")[0] + "_best_eqs"
-            file_path = setup.LOGS_DIR / filename
+        plane_size = plane_size or self.plane_size
+        points = np.asarray(cloud.points)
+        if indices is None:
+            indices = np.arange(len(points))
 
-            if file_path.is_file():
-                file_path.unlink()
+        # Every level is a random subset of the next finer one, which keeps the
+        # share of plane points, unlike a voxel grid, whose coarse levels are
+        # dominated by sparse outliers. The indices point into the point cloud.
+        rng = np.random.default_rng(self.seed)
+        pyramid = []
+        level_ids = np.arange(len(points))
+        for size in reversed(self.levels):
+            if len(level_ids) > size:
+                level_ids = np.sort(rng.choice(level_ids, size, replace=False))
+            pyramid.insert(0, level_ids)
 
-            with file_path.open("wb") as fp:
-                pickle.dump(self.eqs, fp)
-        except Exception as exc:
-            print(exc)
+        # Plane sizes refer to a point cloud of the size of a large point cloud
+        reference = min(len(points), self.dataloader.large_pc)
+        coarse = select_points(cloud, pyramid[0])
+        super()._detect(
+            coarse,
+            pyramid[0],
+            max(3, int(plane_size * len(pyramid[0]) / max(reference, 1))),
+        )
+        coarse_eqs = self.eqs
+
+        with metrics.stage(
+            "plane_refinement", levels=len(pyramid) + 1, planes=len(coarse_eqs)
+        ) as record:
+            for level_ids in pyramid[1:]:
+                coarse_eqs = self._refine(points[level_ids], coarse_eqs)[0]
+            eqs, labels = self._refine(points, coarse_eqs)
+
+            # Keep the planes, which are large enough at full resolution
+            counts = np.bincount(labels[labels >= 0], minlength=len(eqs))
+            min_size = plane_size * len(points) / max(reference, 1)
+            verified = np.flatnonzero(counts >= min_size)
+            relabel = np.full(len(eqs) + 1, -1, dtype=np.int32)
+            relabel[verified] = np.arange(len(verified))
+            self.labels = relabel[labels]
+            self.eqs = [eqs[plane] for plane in verified]
+            record["verified"] = len(self.eqs)
+
+        active = np.flatnonzero(self.labels < 0)
+        self.pcd_out = select_points(cloud, active)
+        self.indices = indices[active]
+
+    def _refine(
+        self, points: np.ndarray, plane_eqs: List[List[float]]
+    ) -> Tuple[List[List[float]], np.ndarray]:
+        """Fit every plane to its inliers by least-squares. Planes claim their
+        inliers in the order of their detection, as in the iterative RANSAC.
+
+        Args:
+            points (np.ndarray): (N, 3) points of a level
+            plane_eqs (List[List[float]]): plane equations of the coarser level
+
+        Returns:
+            Tuple[List[List[float]], np.ndarray]: refined plane equations and
+            the plane index per point, -1 for no plane
+        """
+        labels = np.full(len(points), -1, dtype=np.int32)
+        refined = []
+        for plane, eq in enumerate(plane_eqs):
+            active = np.flatnonzero(labels < 0)
+            normal, offset = np.asarray(eq[:3], dtype=np.float64), float(eq[3])
+            dists = np.abs(points[active] @ normal + offset)
+            inliers = active[dists <= self.thresh]
+
+            if len(inliers) >= 3:
+                # Normal of the least-squares plane through the inliers, in
+                # float64 also for the points of a compact cloud
+                inlier_points = points[inliers].astype(np.float64)
+                center = inlier_points.mean(axis=0)
+                centered = inlier_points - center
+                _, vectors = np.linalg.eigh(centered.T @ centered)
+                fit = vectors[:, 0] * np.sign(vectors[:, 0] @ normal or 1.0)
+                normal, offset = fit, -float(fit @ center)
+
+                # Inliers of the refined plane
+                dists = np.abs(points[active] @ normal + offset)
+                inliers = active[dists <= self.thresh]
+
+            labels[inliers] = plane
+            refined.append([*normal.tolist(), offset])
+        return refined, labels
+
+
+class RegionGrowing(PlaneDetection):
+    """
+    Plane segmentation by region growing. The normals are estimated once from the
+    neighbours of every point, planar regions are the connected components of
+    the neighbourhood graph, whose edges join points with similar normals on a
+    common plane. The neighbours of a downsampled point cloud are the adjacent
+    voxels of the downsampling grid, else its k nearest neighbours. Coplanar
+    regions are merged and every plane is kept, if it has at least PLANE_SIZE
+    inliers. The runtime does not grow with the number of planes and no RANSAC
+    engine is needed, only PLANE_SIZE and THRESH of the RANSAC parameters.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        out_dir: Path,
+        ransac_params: Dict[str, float],
+        debug: bool = False,
+        store: bool = False,
+        store_eqs: bool = True,
+        detect_params: Optional[Dict[str, Any]] = None,
+        writer: Optional[PointWriter] = None,
+        plane_store: Optional[PlaneStore] = None,
+    ):
+
+        super().__init__(
+            dataloader,
+            out_dir,
+            ransac_params,
+            debug,
+            store,
+            store_eqs,
+            detect_params,
+            writer,
+            plane_store,
+        )
+        # Only the thresholds of the RANSAC parameters apply
+        self.params["RANSAC"] = {
+            key: ransac_params[key] for key in ("PLANE_SIZE", "THRESH")
+        }
+        detect_params = detect_params or {}
+        self.neighbors = detect_params.get("NEIGHBORS", 10)
+        self.max_angle = detect_params.get("ANGLE", 10.0)
+        self.max_curvature = detect_params.get("MAX_CURVATURE", 0.05)
+        self.min_region = detect_params.get("MIN_REGION", 0.2)
+        self.workers = detect_params.get("WORKERS", 1) or -1
+
+    def _detect(
+        self,
+        cloud: PointCloud,
+        indices: Optional[np.ndarray],
+        plane_size: Optional[int] = None,
+    ) -> None:
+        """Region growing on a point cloud, fills eqs, labels, pcd_out and indices
+
+        Args:
+            cloud (PointCloud): downsampled point cloud
+            indices (Optional[np.ndarray]): raw index of each point
+            plane_size (Optional[int], optional): minimal number of inliers.
+                Defaults to None, which means PLANE_SIZE.
+        """
+        plane_size = plane_size or self.plane_size
+        points = np.asarray(cloud.points)
+        if indices is None:
+            indices = np.arange(len(points))
+        self.eqs = []
+        self.planes = []
+        self.labels = np.full(len(points), -1, dtype=np.int32)
+
+        print("Region growing...")
+        k = min(self.neighbors, len(points))
+        index = getattr(self.dataloader, "index", None)
+        if k >= 3:
+            with metrics.stage("region_growing", points_in=len(points)) as record:
+                if index is not None and len(index) == len(points):
+                    # The downsampled points are the voxels of the shared grid
+                    neighbors = index.neighbours()
+                    own = np.arange(len(points))[:, None]
+                    neighbors = np.where(neighbors >= 0, neighbors, own)
+                    # The offsets after the voxel itself join every pair once
+                    edges = neighbors[:, 14:]
+                else:
+                    _, neighbors = cKDTree(points).query(
+                        points, k, workers=self.workers
+                    )
+                    edges = neighbors
+                normals, curvature = self._normals(points, neighbors)
+                regions = self._grow(
+                    points,
+                    edges,
+                    normals,
+                    curvature,
+                    max(3, int(self.min_region * plane_size)),
+                )
+                record["regions"] = len(regions)
+
+                candidates = [
+                    (self._fit(points[region]), len(region)) for region in regions
+                ]
+                eqs, _ = merge_planes(candidates, self.max_angle, self.thresh)
+
+                # Inliers of the planes, the nearest plane wins
+                keep, labels = assign_to_planes(points, eqs, self.thresh, labels=True)
+                counts = np.bincount(labels[~keep], minlength=len(eqs))
+                accepted = np.flatnonzero(counts >= plane_size)
+                accepted = accepted[np.argsort(-counts[accepted], kind="stable")]
+                relabel = np.full(len(eqs) + 1, -1, dtype=np.int32)
+                relabel[accepted] = np.arange(len(accepted))
+                self.labels = relabel[labels]
+                self.eqs = [eqs[plane] for plane in accepted]
+                record["inliers"] = int(counts[accepted].sum())
+
+        if self.debug and self.eqs:
+            print("Debugging...")
+            self.planes = [
+                cloud.select_by_index(np.flatnonzero(self.labels == plane))
+                for plane in range(len(self.eqs))
+            ]
+            o3d.visualization.draw_geometries(
+                [to_open3d(plane) for plane in self.planes]
+            )
+
+        active = np.flatnonzero(self.labels < 0)
+        self.pcd_out = select_points(cloud, active)
+        self.indices = indices[active]
 
     @staticmethod
-    def _restore_color(color_cloud: PointCloud, raw_cloud: PointCloud) -> PointCloud:
-        """Restores color of raw point cloud
+    def _normals(
+        points: np.ndarray, neighbors: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Normals and surface variation from the covariance of the neighbours
 
         Args:
-            color_cloud (PointCloud): colorful source point cloud
-            raw_cloud (PointCloud): unicolor target point cloud
+            points (np.ndarray): (N, 3) points
+            neighbors (np.ndarray): (N, k) indices of the neighbours
 
         Returns:
-            PointCloud: colorfied target point cloud
+            Tuple[np.ndarray, np.ndarray]: (N, 3) unit normals and (N,) surface
+            variation, which is 0 on a perfect plane and 1/3 for isotropic points
         """
-        try:
-            dists = np.array(color_cloud.compute_point_cloud_distance(raw_cloud))
-            ind = np.where(dists < 0.01)[0]
-            raw_cloud = color_cloud.select_by_index(ind)
-        except Exception as exc:
-            print(exc)
-        return raw_cloud
+        normals = np.empty_like(points)
+        curvature = np.empty(len(points))
+        # Bounded memory of the (chunk, k, 3) neighbourhoods
+        chunk = max(1, 2**22 // neighbors.shape[1])
+        for start in range(0, len(points), chunk):
+            hood = points[neighbors[start : start + chunk]]
+            hood -= hood.mean(axis=1, keepdims=True)
+            values, vectors = np.linalg.eigh(hood.transpose(0, 2, 1) @ hood)
+            normals[start : start + chunk] = vectors[:, :, 0]
+            curvature[start : start + chunk] = values[:, 0] / np.maximum(
+                values.sum(axis=1), np.finfo(np.float64).tiny
+            )
+        return normals, curvature
+
+    def _grow(
+        self,
+        points: np.ndarray,
+        neighbors: np.ndarray,
+        normals: np.ndarray,
+        curvature: np.ndarray,
+        min_size: int,
+    ) -> List[np.ndarray]:
+        """Grow planar regions as connected components of the neighbourhood graph.
+        Points on edges and curved surfaces do not join any region.
+
+        Args:
+            points (np.ndarray): (N, 3) points
+            neighbors (np.ndarray): (N, k) indices of the neighbours
+            normals (np.ndarray): (N, 3) unit normals
+            curvature (np.ndarray): (N,) surface variation
+            min_size (int): minimal number of points of a region
+
+        Returns:
+            List[np.ndarray]: point indices of every region, largest first
+        """
+        flat = curvature <= self.max_curvature
+        src = np.repeat(np.arange(len(points)), neighbors.shape[1])
+        dst = neighbors.reshape(-1)
+
+        # Similar normals and the neighbour on the tangent plane of the point
+        min_cos = np.cos(np.deg2rad(self.max_angle))
+        cos = np.abs(np.einsum("ij,ij->i", normals[src], normals[dst]))
+        dist = np.abs(np.einsum("ij,ij->i", normals[src], points[dst] - points[src]))
+        edges = flat[src] & flat[dst] & (cos >= min_cos) & (dist <= self.thresh)
+
+        graph = coo_matrix(
+            (np.ones(np.count_nonzero(edges), dtype=bool), (src[edges], dst[edges])),
+            shape=(len(points), len(points)),
+        )
+        _, component = connected_components(graph, directed=False)
+
+        # Group the points by component, only the large components are split off
+        order = np.argsort(component, kind="stable")
+        counts = np.bincount(component)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        large = np.flatnonzero(counts >= min_size)
+        large = large[np.argsort(-counts[large], kind="stable")]
+        return [order[starts[c] : starts[c] + counts[c]] for c in large]
+
+    @staticmethod
+    def _fit(points: np.ndarray) -> List[float]:
+        """Least-squares plane through a set of points
+
+        Args:
+            points (np.ndarray): (N, 3) points
+
+        Returns:
+            List[float]: plane equation [a, b, c, d] with unit normal
+        """
+        center = points.mean(axis=0)
+        centered = points - center
+        _, vectors = np.linalg.eigh(centered.T @ centered)
+        normal = vectors[:, 0]
+        return [*normal.tolist(), -float(normal @ center)]
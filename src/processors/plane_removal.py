@@ -1,15 +1,16 @@
 """PlaneRemoval Interface and concrete implementation for removing all detected planes"""
-import pickle
 from abc import abstractmethod
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 import numpy as np
-import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
 
-from utils.utils import remove_by_indices, timer
+from utils import metrics
+from utils.utils import assign_to_planes, select_points
 from utils.dataloader import DataLoader
+from utils.planestore import PlaneStore
+from utils.pointwriter import PointWriter
 from .pointcloud_processor import PointCloudProcessor
 
 
@@ -20,6 +21,16 @@ class PlaneRemoval(PointCloudProcessor):
     def remove_planes(self, filename: str) -> PointCloud:
         """Remove detected planes"""
 
+    @abstractmethod
+    def remove_planes_from_cloud(
+        self,
+        filename: str,
+        cloud: PointCloud,
+        plane_eqs: List[List[Any]],
+        indices: Optional[np.ndarray] = None,
+    ) -> PointCloud:
+        """Remove given planes from a loaded point cloud"""
+
     @abstractmethod
     def _load_plane_eqs(self, filename: str) -> List[List[Any]]:
         """Load a list of detected plane equations"""
@@ -34,23 +45,30 @@ class PlaneRemovalAll(PlaneRemoval):
     def __init__(
         self,
         out_dir: Path,
-        eqs_dir: Path,
+        plane_store: PlaneStore,
         dataloader: DataLoader,
         remove_params: Dict[str, float],
         store: bool = True,
+        writer: Optional[PointWriter] = None,
         # pcd_out=o3d.geometry.PointCloud(),
     ):
 
         self.dataloader = dataloader
+        self.writer = writer or PointWriter()
         self.out_dir = out_dir
-        self.eqs_dir = eqs_dir
+        self.plane_store = plane_store
         self.thresh = remove_params["THRESH"]
+        self.chunk_size = remove_params.get("CHUNK_SIZE", 2**18)
+        self.with_labels = remove_params.get("LABELS", False)
         self.store = store
         self.pcd_out: PointCloud = None
+        # Nearest plane per raw point, -1 for no plane (only if LABELS is set)
+        self.labels: Optional[np.ndarray] = None
+        # Index of each remaining point in the raw point cloud
+        self.indices: np.ndarray = np.empty(0, dtype=np.int64)
 
-    @timer
     def remove_planes(self, filename: str) -> PointCloud:
-        """Remove all planes based on stored plane equations in pickle file
+        """Remove all planes based on the plane equations in the plane store
 
         Args:
             filename (str): path to raw point cloud file
@@ -60,27 +78,47 @@ class PlaneRemovalAll(PlaneRemoval):
         """
 
         # Load raw point cloud data and the best plane equations
-        cloud: PointCloud = self.dataloader.load_data(filename)
-        pts = np.asarray(cloud.points)
-
+        cloud, indices = self.dataloader.load_data_with_indices(filename)
         best_eqs = self._load_plane_eqs(filename)
 
+        return self.remove_planes_from_cloud(filename, cloud, best_eqs, indices)
+
+    def remove_planes_from_cloud(
+        self,
+        filename: str,
+        cloud: PointCloud,
+        plane_eqs: List[List[Any]],
+        indices: Optional[np.ndarray] = None,
+    ) -> PointCloud:
+        """Remove all planes from a point cloud, which is already in memory
+
+        Args:
+            filename (str): name of the raw point cloud file
+            cloud (PointCloud): raw point cloud
+            plane_eqs (List[List[Any]]): plane equations to remove
+            indices (Optional[np.ndarray], optional): raw index of each point.
+                Defaults to None, which means all points of the raw file.
+
+        Returns:
+            PointCloud: raw point cloud without detected planes
+        """
+        pts = np.asarray(cloud.points)
+        if indices is None:
+            indices = np.arange(len(pts))
+
         print("Remove planes from original point cloud...")
-        # Remove the planes from original point cloud
-        for plane_eq in best_eqs:
-            dist_pts = (
-                plane_eq[0] * pts[:, 0]
-                + plane_eq[1] * pts[:, 1]
-                + plane_eq[2] * pts[:, 2]
-                + plane_eq[3]
-            ) / np.sqrt(plane_eq[0] ** 2 + plane_eq[1] ** 2 + plane_eq[2] ** 2)
-            inliers = np.where(np.abs(dist_pts) <= self.thresh)[0].tolist()
-            pts = remove_by_indices(pts, inliers)
-
-        # Generate point cloud data
-        self.pcd_out = o3d.geometry.PointCloud()
-        self.pcd_out.points = o3d.utility.Vector3dVector(pts)
-        self.pcd_out = self._restore_color(cloud, self.pcd_out)
+        with metrics.stage(
+            "plane_removal", points_in=len(pts), planes=len(plane_eqs)
+        ) as record:
+            # Remove the planes from original point cloud
+            keep, self.labels = assign_to_planes(
+                pts, plane_eqs, self.thresh, self.chunk_size, self.with_labels
+            )
+
+            # Gather the remaining points with all their attributes
+            self.pcd_out = select_points(cloud, keep)
+            self.indices = indices[keep]
+            record["points_out"] = len(self.indices)
 
         # Store intermediate point cloud data
         if self.store:
@@ -89,39 +127,15 @@ class PlaneRemovalAll(PlaneRemoval):
         return self.pcd_out
 
     def _load_plane_eqs(self, filename: str) -> List[List[Any]]:
-        """Load plane equations from pickle file
+        """Load plane equations from the plane store
 
         Args:
-            filename (str): filename as blueprint for pickle file
-
-        Returns:
-            List[List[Any]]: list of best
-        """
-        try:
-            eqs = filename.split(".")[0] + "_best_eqs"
-            eqs_path = self.eqs_dir / eqs
-
-            with eqs_path.open("rb") as fp:
-                best_eqs: List[List[Any]] = pickle.load(fp)
-        except Exception as exc:
-            print(exc)
-        return best_eqs
+            filename (str): name of the raw point cloud file
 
-    @staticmethod
-    def _restore_color(color_cloud: PointCloud, raw_cloud: PointCloud) -> PointCloud:
-        """Restores color of raw point cloud
-
-        Args:
-            color_cloud (PointCloud): colorful source point cloud
-            raw_cloud (PointCloud): unicolor target point cloud
+        Raises:
+            KeyError: No planes of the file are stored!
 
         Returns:
-            PointCloud: colorfied target point cloud
+            List[List[Any]]: list of best plane equations
         """
-        try:
-            dists = np.array(color_cloud.compute_point_cloud_distance(raw_cloud))
-            ind = np.where(dists < 0.01)[0]
-            raw_cloud = color_cloud.select_by_index(ind)
-        except Exception as exc:
-            print(exc)
-        return raw_cloud
+        return self.plane_store.load(filename)
@@ -4,22 +4,37 @@ from pathlib import Path
 import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
 
+from utils import background, metrics
+from utils.compactcloud import to_open3d
+from utils.pointwriter import PointWriter
+
 
 class PointCloudProcessor(ABC):
     """Abstract base class for processing point clouds"""
 
+    # Output format of the saved point clouds
+    writer: PointWriter = PointWriter()
+
     def save_pcs(self, filename: str, out_dir: Path, pcd_out: PointCloud) -> None:
-        """Saves point cloud data to a file
+        """Saves point cloud data atomically in the output format, in the
+        background if the writer of the process runs. An existing file of a
+        previous run is replaced.
 
         Args:
-            filename (str): _description_
-            out_dir (Path): _description_
-            pcd_out (PointCloud): _description_
+            filename (str): name of the raw point cloud file
+            out_dir (Path): output directory
+            pcd_out (PointCloud): point cloud to save
         """
         try:
-            data_path = out_dir / filename
-            if not data_path.is_file():
-                o3d.io.write_point_cloud(str(data_path), pcd_out)
+            data_path = out_dir / self.writer.name(filename)
+
+            def write() -> None:
+                with metrics.stage(
+                    "save", file=filename, points_out=len(pcd_out.points)
+                ):
+                    self.writer.write(data_path, pcd_out)
+
+            background.write(data_path, write)
         except Exception as exc:
             print(exc)
 
@@ -36,6 +51,6 @@ class PointCloudProcessor(ABC):
             if not pcd_out:
                 raise ValueError("You try to display an empty point cloud!")
 
-            o3d.visualization.draw_geometries([pcd_out])
+            o3d.visualization.draw_geometries([to_open3d(pcd_out)])
         except Exception as exc:
             print(exc)
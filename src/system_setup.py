@@ -12,6 +12,16 @@ RAW_DATA_DIR = DATA_DIR / "raw"
 TEST_DATA_DIR = DATA_DIR / "test"
 INT_DATA_DIR = DATA_DIR / "intermediate"
 FINAL_DATA_DIR = DATA_DIR / "final"
+# binary columns of raw point cloud files
+POINT_CACHE_DIR = DATA_DIR / "cache" / "points"
+# stage results of the fused pipeline
+RESULT_CACHE_DIR = DATA_DIR / "cache" / "results"
+# spill files of tiled processing
+TILES_DIR = DATA_DIR / "tiles"
+# synthetic scenes and outputs of the benchmark
+BENCHMARK_DIR = DATA_DIR / "benchmark"
+# plane equations of all files, which survive the clean up
+PLANE_STORE = DATA_DIR / "planes.sqlite"
 
 # path to logs
 LOGS_DIR = BASE_DIR / "logs"
@@ -0,0 +1,184 @@
+"""Background threads, which overlap the file I/O of a worker with its computation"""
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Bytes per read, while a file is pulled into the page cache
+READ_BLOCK = 2**22
+
+
+class AsyncWriter:
+    """
+    Writes files on a single background thread in the order of submission. The
+    queue is bounded, so a worker blocks instead of piling up point clouds in
+    memory. Errors are collected and reported, when the writer is flushed.
+    """
+
+    def __init__(self, depth: int = 4):
+
+        self._queue: "queue.Queue[Tuple[str, Callable[[], Any]]]" = queue.Queue(
+            maxsize=depth
+        )
+        self._cond = threading.Condition()
+        # Number of queued writes per path
+        self._pending: Dict[str, int] = {}
+        self._errors: List[Tuple[str, str]] = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, path: Path, write: Callable[[], Any]) -> None:
+        """Queue a write, blocks while the queue is full
+
+        Args:
+            path (Path): path of the written file
+            write (Callable[[], Any]): writes the file
+        """
+        key = str(path)
+        with self._cond:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        self._queue.put((key, write))
+
+    def wait(self, path: Path) -> None:
+        """Block until all queued writes of a file are done, e.g. before reading it
+
+        Args:
+            path (Path): path of the file
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending.get(str(path)))
+
+    def flush(self) -> List[Tuple[str, str]]:
+        """Block until all queued writes are done
+
+        Returns:
+            List[Tuple[str, str]]: path and error message of every failed write
+            since the last flush
+        """
+        self._queue.join()
+        with self._cond:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def _run(self) -> None:
+        """Write the queued files until the process exits"""
+        while True:
+            key, write = self._queue.get()
+            try:
+                write()
+            except Exception as exc:
+                with self._cond:
+                    self._errors.append((key, f"{type(exc).__name__}: {exc}"))
+            finally:
+                with self._cond:
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                    self._cond.notify_all()
+                self._queue.task_done()
+
+
+class Prefetcher:
+    """
+    Loads upcoming files on a background thread, e.g. into the page cache or the
+    point cache, so their later load reads from memory. Hints beyond the depth of
+    the queue are dropped, a failed prefetch is left to the actual load.
+    """
+
+    def __init__(self, depth: int = 1):
+
+        self._queue: "queue.Queue[Callable[[], Any]]" = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def hint(self, load: Callable[[], Any]) -> None:
+        """Queue a prefetch without blocking
+
+        Args:
+            load (Callable[[], Any]): loads an upcoming file
+        """
+        try:
+            self._queue.put_nowait(load)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        """Prefetch the queued files until the process exits"""
+        while True:
+            load = self._queue.get()
+            try:
+                load()
+            except Exception:
+                pass
+
+
+_writer: Optional[AsyncWriter] = None
+_prefetcher: Optional[Prefetcher] = None
+
+
+def start(write_depth: int = 0, prefetch_depth: int = 0) -> None:
+    """Start the background threads of this process, a depth of 0 keeps the
+    synchronous behaviour
+
+    Args:
+        write_depth (int, optional): queued writes. Defaults to 0.
+        prefetch_depth (int, optional): queued prefetches. Defaults to 0.
+    """
+    global _writer, _prefetcher
+    if write_depth and _writer is None:
+        _writer = AsyncWriter(write_depth)
+    if prefetch_depth and _prefetcher is None:
+        _prefetcher = Prefetcher(prefetch_depth)
+
+
+def write(path: Path, write_file: Callable[[], Any]) -> None:
+    """Write a file in the background, if the writer runs, else right away
+
+    Args:
+        path (Path): path of the written file
+        write_file (Callable[[], Any]): writes the file
+    """
+    if _writer is None:
+        write_file()
+    else:
+        _writer.submit(path, write_file)
+
+
+def wait(path: Path) -> None:
+    """Block until the queued writes of a file are done
+
+    Args:
+        path (Path): path of the file
+    """
+    if _writer is not None:
+        _writer.wait(path)
+
+
+def flush() -> List[Tuple[str, str]]:
+    """Block until all queued writes are done
+
+    Returns:
+        List[Tuple[str, str]]: path and error message of every failed write
+    """
+    return _writer.flush() if _writer is not None else []
+
+
+def prefetch(load: Callable[[], Any]) -> None:
+    """Prefetch a file in the background, if the prefetcher runs
+
+    Args:
+        load (Callable[[], Any]): loads an upcoming file
+    """
+    if _prefetcher is not None:
+        _prefetcher.hint(load)
+
+
+def warm(path: Path) -> None:
+    """Read a file once, so it is in the page cache of the operating system
+
+    Args:
+        path (Path): path of the file
+    """
+    with path.open("rb") as fp:
+        while fp.read(READ_BLOCK):
+            pass
@@ -0,0 +1,191 @@
+"""Point cloud of float32 points and uint8 colors, which replaces Open3D's point
+cloud between the stages of the pipeline"""
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import open3d as o3d
+from open3d.cpu.pybind.geometry import PointCloud
+
+from .pointcache import PointCache
+
+
+class CompactCloud:
+    """
+    Point cloud, whose points and normals are contiguous float32 arrays and whose
+    colors are uint8. It needs 15 instead of 48 bytes per colored point and
+    offers the part of the PointCloud interface, which the stages use, so they
+    run on either. Open3D is only called at the edges of the pipeline, e.g. to
+    write a point cloud, and by the Open3D outlier filters on a float64 copy of
+    the points.
+    """
+
+    def __init__(
+        self,
+        points: np.ndarray,
+        rgb: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ):
+
+        self.points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+        self.rgb = None if rgb is None else np.ascontiguousarray(rgb, dtype=np.uint8)
+        self.normals = (
+            None if normals is None else np.ascontiguousarray(normals, dtype=np.float32)
+        )
+
+    @classmethod
+    def from_open3d(cls, cloud: PointCloud) -> "CompactCloud":
+        """Convert an Open3D point cloud
+
+        Args:
+            cloud (PointCloud): Open3D point cloud
+
+        Returns:
+            CompactCloud: compact copy of the point cloud
+        """
+        rgb = None
+        if cloud.has_colors():
+            rgb = np.round(np.clip(np.asarray(cloud.colors), 0.0, 1.0) * 255.0)
+        normals = np.asarray(cloud.normals) if cloud.has_normals() else None
+        return cls(np.asarray(cloud.points), rgb, normals)
+
+    @classmethod
+    def read(cls, path: Path, cache: Optional[PointCache] = None) -> "CompactCloud":
+        """Read a point cloud file. The cache converts its columns chunk by chunk,
+        without it the file is read by Open3D and converted afterwards.
+
+        Args:
+            path (Path): path to the point cloud file
+            cache (Optional[PointCache], optional): binary cache of the raw
+                files. Defaults to None.
+
+        Returns:
+            CompactCloud: point cloud
+        """
+        if cache:
+            return cls(*cache.load_compact(path))
+        return cls.from_open3d(o3d.io.read_point_cloud(str(path)))
+
+    @property
+    def colors(self) -> np.ndarray:
+        """Colors in [0, 1] as in Open3D, empty if there are none"""
+        if self.rgb is None:
+            return np.empty((0, 3))
+        return self.rgb / 255.0
+
+    def has_colors(self) -> bool:
+        """Whether the points have colors"""
+        return self.rgb is not None
+
+    def has_normals(self) -> bool:
+        """Whether the points have normals"""
+        return self.normals is not None
+
+    def get_min_bound(self) -> np.ndarray:
+        """Smallest coordinates of the points as float64"""
+        return self.points.min(axis=0).astype(np.float64)
+
+    def get_max_bound(self) -> np.ndarray:
+        """Largest coordinates of the points as float64"""
+        return self.points.max(axis=0).astype(np.float64)
+
+    def select_by_index(
+        self, indices: Union[List[int], np.ndarray], invert: bool = False
+    ) -> "CompactCloud":
+        """Gather points and their attributes
+
+        Args:
+            indices (Union[List[int], np.ndarray]): indices or boolean mask of
+                the selected points
+            invert (bool, optional): keep the points, which are not selected.
+                Defaults to False.
+
+        Returns:
+            CompactCloud: selected points
+        """
+        indices = np.asarray(indices)
+        if invert:
+            mask = np.ones(len(self.points), dtype=bool)
+            mask[indices] = False
+            indices = mask
+        elif indices.dtype != bool:
+            indices = indices.astype(np.int64, copy=False)
+
+        return CompactCloud(
+            self.points[indices],
+            None if self.rgb is None else self.rgb[indices],
+            None if self.normals is None else self.normals[indices],
+        )
+
+    def remove_statistical_outlier(
+        self, nb_neighbors: int, std_ratio: float
+    ) -> Tuple["CompactCloud", List[int]]:
+        """Statistical outlier removal of Open3D on a float64 copy of the points
+
+        Args:
+            nb_neighbors (int): number of neighbours
+            std_ratio (float): standard deviation ratio
+
+        Returns:
+            Tuple[CompactCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        _, ind = self._points_only().remove_statistical_outlier(
+            nb_neighbors=nb_neighbors, std_ratio=std_ratio
+        )
+        return self.select_by_index(ind), ind
+
+    def remove_radius_outlier(
+        self, nb_points: int, radius: float
+    ) -> Tuple["CompactCloud", List[int]]:
+        """Radius outlier removal of Open3D on a float64 copy of the points
+
+        Args:
+            nb_points (int): minimal number of points within the radius
+            radius (float): radius of the neighbourhood
+
+        Returns:
+            Tuple[CompactCloud, List[int]]: point cloud without outliers and the
+            indices of the remaining points
+        """
+        _, ind = self._points_only().remove_radius_outlier(
+            nb_points=nb_points, radius=radius
+        )
+        return self.select_by_index(ind), ind
+
+    def to_open3d(self) -> PointCloud:
+        """Convert into an Open3D point cloud, e.g. to write or display it
+
+        Returns:
+            PointCloud: float64 copy of the point cloud
+        """
+        pcd = self._points_only()
+        if self.rgb is not None:
+            pcd.colors = o3d.utility.Vector3dVector(self.colors)
+        if self.normals is not None:
+            pcd.normals = o3d.utility.Vector3dVector(self.normals.astype(np.float64))
+        return pcd
+
+    def _points_only(self) -> PointCloud:
+        """Open3D point cloud of the points without their attributes
+
+        Returns:
+            PointCloud: float64 copy of the points
+        """
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(self.points.astype(np.float64))
+        return pcd
+
+
+def to_open3d(cloud: Union[PointCloud, CompactCloud]) -> PointCloud:
+    """Open3D point cloud of either point cloud type
+
+    Args:
+        cloud (Union[PointCloud, CompactCloud]): point cloud
+
+    Returns:
+        PointCloud: the point cloud itself or an Open3D copy of a compact one
+    """
+    if isinstance(cloud, CompactCloud):
+        return cloud.to_open3d()
+    return cloud
@@ -1,25 +1,97 @@
 """Data Loader Interface and two concrete implementations"""
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
+import numpy as np
 import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
 
+from . import background, metrics
+from .compactcloud import CompactCloud, to_open3d
+from .pointcache import PointCache
+from .pointwriter import read_npz
+from .spatialindex import VoxelHashIndex, voxel_keys
+
 
 class DataLoader(ABC):
     """Abstract Class of Data Loader"""
 
+    dir_path: Path
+    cache: Optional[PointCache] = None
+    # Load float32 points and uint8 colors instead of Open3D point clouds
+    compact: bool = False
+
     @abstractmethod
     def load_data(self, filename: str) -> PointCloud:
         """Standard method to load data"""
 
+    def load_data_with_indices(self, filename: str) -> Tuple[PointCloud, np.ndarray]:
+        """Load data together with the index of each point in the original file
+
+        Args:
+            filename (str): file of point cloud data
+
+        Returns:
+            Tuple[PointCloud, np.ndarray]: point cloud and original point indices
+        """
+        pcd = self.load_data(filename)
+        return pcd, np.arange(len(pcd.points))
+
+    def prefetch(self, filename: str) -> None:
+        """Load a file into the point cache and the page cache, so the next load
+        of the file reads from memory
+
+        Args:
+            filename (str): file of point cloud data
+        """
+        file_path = self.dir_path / filename
+        paths = [file_path]
+        if self.cache:
+            paths = self.cache.column_paths(file_path)
+        for path in paths:
+            background.warm(path)
+
+    def _read_point_cloud(self, file_path: Path) -> PointCloud:
+        """Read a point cloud file, through the binary cache if there is one, as a
+        CompactCloud in the compact mode
+
+        Args:
+            file_path (Path): path to the point cloud file
+
+        Returns:
+            PointCloud: point cloud
+        """
+        # The file might still be written in the background
+        background.wait(file_path)
+        with metrics.stage("load", cached=bool(self.cache)) as record:
+            if file_path.suffix == ".npz":
+                pcd = read_npz(file_path, self.compact)
+            elif self.compact:
+                pcd = CompactCloud.read(file_path, self.cache)
+            elif self.cache:
+                pcd = self.cache.load_pointcloud(file_path)
+            else:
+                pcd = o3d.io.read_point_cloud(str(file_path))
+            record["points_out"] = len(pcd.points)
+        return pcd
+
 
 class DataLoaderSTD(DataLoader):
     """Standard Data Loader"""
 
-    def __init__(self, dir_path: Path):
+    def __init__(
+        self,
+        dir_path: Path,
+        cache: Optional[PointCache] = None,
+        compact: bool = False,
+        suffix: Optional[str] = None,
+    ):
         self.dir_path = dir_path
+        self.cache = cache
+        self.compact = compact
+        # Suffix of the files in the directory, if it differs from the raw files
+        self.suffix = suffix
 
     def load_data(self, filename: str) -> PointCloud:
         """Load point cloud data from specified file
@@ -32,7 +104,9 @@ class DataLoaderSTD(DataLoader):
         """
         try:
             file_path = self.dir_path / filename
-            pcd = o3d.io.read_point_cloud(str(file_path))
+            if self.suffix:
+                file_path = file_path.with_suffix(self.suffix)
+            pcd = self._read_point_cloud(file_path)
         except Exception as exc:
             print(exc)
 
@@ -43,14 +117,26 @@ class DataLoaderDS(DataLoader):
     """Data Loader including a downsampling method"""
 
     def __init__(
-        self, dir_path: Path, down_params: Dict[str, float], verbose: bool = False
+        self,
+        dir_path: Path,
+        down_params: Dict[str, float],
+        verbose: bool = False,
+        cache: Optional[PointCache] = None,
+        compact: bool = False,
     ):
 
         self.dir_path = dir_path
+        self.cache = cache
+        self.compact = compact
         self.large_pc = down_params["LARGE_PC"]
+        # Initial guess of the voxel size search, which is never modified
         self.voxel_size = down_params["VOXEL_SIZE"]
-        self.voxel_step = down_params["VOXEL_STEP"]
+        # Accepted relative shortfall below LARGE_PC and maximal search steps
+        self.tolerance = down_params.get("TOLERANCE", 0.05)
+        self.max_search = down_params.get("MAX_SEARCH", 16)
         self.verbose = verbose
+        # Voxel grid of the last downsampled point cloud, one voxel per point
+        self.index: Optional[VoxelHashIndex] = None
 
     def load_data(self, filename: str) -> PointCloud:
         """Load and downsample point cloud into memory
@@ -61,38 +147,135 @@ class DataLoaderDS(DataLoader):
         Returns:
             PointCloud: donwsampled point cloud
         """
-        file_path = self.dir_path / filename
-        pcd = o3d.io.read_point_cloud(str(file_path))
+        pcd_down, _ = self.load_data_with_indices(filename)
+        return pcd_down
+
+    def load_data_with_indices(self, filename: str) -> Tuple[PointCloud, np.ndarray]:
+        """Load and downsample point cloud into memory, tracing every downsampled
+        point back to a point of the raw point cloud
+
+        Args:
+            filename (str): file of raw point cloud data
+
+        Returns:
+            Tuple[PointCloud, np.ndarray]: donwsampled point cloud and the index of
+            one raw point inside the voxel of each downsampled point
+        """
+        pcd = self.read_data(filename)
 
         # Downsample large point clouds into user-defined processing scope
-        pcd_down = self._downsample_data(pcd, filename)
+        pcd_down, indices = self.downsample_data(pcd, filename)
 
         if self.verbose:
-            o3d.visualization.draw_geometries([pcd_down])
+            o3d.visualization.draw_geometries([to_open3d(pcd_down)])
             print(pcd_down)
 
-        return pcd_down
+        return pcd_down, indices
+
+    def read_data(self, filename: str) -> PointCloud:
+        """Read the raw point cloud without downsampling
+
+        Args:
+            filename (str): file of raw point cloud data
 
-    def _downsample_data(self, cloud: PointCloud, filename: str) -> PointCloud:
-        """Down sample point cloud data based on the definition of a large pointcloud
-        and the speed of downsampling in the config file!
+        Returns:
+            PointCloud: raw point cloud
+        """
+        file_path = self.dir_path / filename
+        return self._read_point_cloud(file_path)
+
+    def downsample_data(
+        self, cloud: PointCloud, filename: str
+    ) -> Tuple[PointCloud, np.ndarray]:
+        """Down sample point cloud data in a single pass to at most the number of
+        points, which defines a large point cloud in the config file!
 
         Args:
             cloud (PointCloud): input point cloud
             filename (str): file of raw point cloud data
 
         Returns:
-            PointCloud: donwsampled point cloud
+            Tuple[PointCloud, np.ndarray]: donwsampled point cloud and raw indices
         """
+        indices = np.arange(len(cloud.points))
+        self.index = None
+        if len(cloud.points) <= self.large_pc or not self.voxel_size:
+            return cloud, indices
+
         try:
-            while len(cloud.points) > self.large_pc and self.voxel_size:
-                cloud = cloud.voxel_down_sample(voxel_size=self.voxel_size)
-                self.voxel_size += self.voxel_step
+            with metrics.stage("downsample", points_in=len(indices)) as record:
+                min_bound = cloud.get_min_bound()
+                points = np.asarray(cloud.points)
+                voxel_size = self._target_voxel_size(points, min_bound)
+                # The voxel grid of the downsampling is kept for the later stages
+                self.index = VoxelHashIndex(points, voxel_size, min_bound)
+                cloud = self.index.downsample(cloud)
+                indices = self.index.trace()
+                record["points_out"] = len(indices)
+                record["voxel_size"] = voxel_size
 
-                print(
-                    f"'{filename}' has {len(cloud.points)} points after downsampling!"
-                )
+            print(
+                f"'{filename}' has {len(cloud.points)} points after downsampling "
+                f"with voxel size {voxel_size:.4f}!"
+            )
         except Exception as exc:
             print(exc)
 
-        return cloud
+        return cloud, indices
+
+    def _target_voxel_size(self, points: np.ndarray, min_bound: np.ndarray) -> float:
+        """Search the voxel size, whose voxel count is closest below the size of a
+        large point cloud. The voxel counts are cheap to evaluate and every step
+        assumes, that the count of surface points scales with 1 / voxel_size^2.
+
+        Args:
+            points (np.ndarray): (N, 3) points
+            min_bound (np.ndarray): origin of the voxel grid
+
+        Returns:
+            float: voxel size for a single downsampling pass
+        """
+        target = self.large_pc
+        # Largest known size above the target and smallest known size below it
+        too_fine, fine_enough = 0.0, None
+
+        voxel_size = self.voxel_size
+        for _ in range(self.max_search):
+            count = self._voxel_count(points, min_bound, voxel_size)
+            if count > target:
+                too_fine = voxel_size
+            else:
+                fine_enough = voxel_size
+                if count >= target * (1 - self.tolerance):
+                    break
+
+            estimate = voxel_size * np.sqrt(max(count, 1) / target)
+            # Stay inside the known bracket, bisect if the estimate leaves it
+            if fine_enough is not None and not too_fine < estimate < fine_enough:
+                estimate = (
+                    np.sqrt(too_fine * fine_enough) if too_fine else fine_enough / 2
+                )
+            voxel_size = float(estimate)
+
+        return fine_enough if fine_enough is not None else voxel_size
+
+    @staticmethod
+    def _voxel_count(
+        points: np.ndarray, min_bound: np.ndarray, voxel_size: float
+    ) -> int:
+        """Number of occupied voxels on the padded key grid of VoxelHashIndex, which
+        downsamples the point cloud from the same origin, so the count is its size
+        after downsampling. Open3D's voxel_down_sample offsets its grid by half a
+        voxel and may yield a slightly different count.
+
+        Args:
+            points (np.ndarray): (N, 3) points
+            min_bound (np.ndarray): origin of the voxel grid
+            voxel_size (float): edge length of the voxels
+
+        Returns:
+            int: number of occupied voxels
+        """
+        flat, _ = voxel_keys(points, min_bound, voxel_size)
+        flat.sort()
+        return int(np.count_nonzero(flat[1:] != flat[:-1])) + 1
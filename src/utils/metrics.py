@@ -0,0 +1,376 @@
+"""Structured per-file and per-stage metrics of the pipeline"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# One finished stage: file, stage, pid, tid, start, wall_s, cpu_s, peak_rss_bytes
+# and stage specific fields like points_in, points_out, iterations or inliers.
+# The peak RSS is the peak of the process during the stage.
+Record = Dict[str, Any]
+
+# Fields, which are summed up per stage, and their Prometheus metric names
+SUMMED_FIELDS = {
+    "runs": "runs_total",
+    "wall_s": "wall_seconds_total",
+    "cpu_s": "cpu_seconds_total",
+    "points_in": "points_in_total",
+    "points_out": "points_out_total",
+    "iterations": "ransac_iterations_total",
+    "inliers": "inliers_total",
+}
+
+PREFIX = "plane_removal"
+
+# Linux keeps the peak RSS in VmHWM, writing 5 to clear_refs resets it
+STATUS_PATH = Path("/proc/self/status")
+CLEAR_REFS_PATH = Path("/proc/self/clear_refs")
+
+_records: Deque[Record] = deque()
+_current_file: Optional[str] = None
+
+# Stages, which are profiled with cProfile, the directory of their dumps and the
+# accumulated profile per stage of this process
+_profiled: Set[str] = set()
+_profile_dir: Optional[Path] = None
+_profiles: Dict[str, cProfile.Profile] = {}
+
+# Peak RSS of the running stages of this process before the last reset, which a
+# nested or concurrent stage triggered, None if the peak cannot be reset
+_peaks: Dict[int, int] = {}
+_peaks_lock = threading.Lock()
+_resettable: Optional[bool] = None
+# Peak RSS of the process before the last reset
+_process_peak = 0
+
+
+@contextmanager
+def track_file(filename: str) -> Iterator[None]:
+    """Attribute all stages within the context to a file
+
+    Args:
+        filename (str): name of the raw point cloud file
+    """
+    global _current_file
+    previous, _current_file = _current_file, filename
+    try:
+        yield
+    finally:
+        _current_file = previous
+
+
+@contextmanager
+def stage(name: str, **fields: Any) -> Iterator[Record]:
+    """Measure a stage of the current file. The yielded record takes additional
+    fields, which are only known inside the stage, e.g. the output size.
+
+    Args:
+        name (str): name of the stage
+        fields (Any): stage specific fields known in advance
+
+    Yields:
+        Iterator[Record]: record of the stage
+    """
+    record: Record = {"file": _current_file, "stage": name, **fields}
+    record["pid"] = os.getpid()
+    record["tid"] = threading.get_native_id()
+    record["start"] = time.time()
+    _start_peak(id(record))
+    profile = _enable_profile(name)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.disable()
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        record["peak_rss_bytes"] = _stop_peak(id(record))
+        _records.append(record)
+
+
+def record_event(name: str, **fields: Any) -> None:
+    """Record a stage, which was measured elsewhere, e.g. a job of a worker
+
+    Args:
+        name (str): name of the stage
+        fields (Any): fields of the stage
+    """
+    _records.append({"file": _current_file, "stage": name, **fields})
+
+
+def profile_stages(stages: Set[str], out_dir: Optional[Path]) -> None:
+    """Profile stages with cProfile in this process, e.g. in a pool worker. The
+    calls of a stage are accumulated and dumped per process as
+    <stage>.<pid>.prof, which pstats merges across processes.
+
+    Args:
+        stages (Set[str]): names of the profiled stages, empty to disable
+        out_dir (Optional[Path]): directory of the dumps
+    """
+    global _profiled, _profile_dir
+    _profiled, _profile_dir = set(stages), out_dir
+
+
+def profiled_stages() -> Tuple[Set[str], Optional[Path]]:
+    """Profiled stages of this process, e.g. to pass them to a pool worker
+
+    Returns:
+        Tuple[Set[str], Optional[Path]]: names of the stages and the directory
+        of their dumps
+    """
+    return _profiled, _profile_dir
+
+
+def dump_profiles() -> None:
+    """Write the accumulated profiles of this process"""
+    if _profile_dir is None:
+        return
+    _profile_dir.mkdir(parents=True, exist_ok=True)
+    for name, profile in list(_profiles.items()):
+        profile.dump_stats(str(_profile_dir / f"{name}.{os.getpid()}.prof"))
+
+
+def _enable_profile(name: str) -> Optional[cProfile.Profile]:
+    """Start profiling a stage, unless it is not selected or another profile runs,
+    e.g. of a surrounding stage or another thread
+
+    Args:
+        name (str): name of the stage
+
+    Returns:
+        Optional[cProfile.Profile]: running profile, None if it did not start
+    """
+    if name not in _profiled or sys.getprofile() is not None:
+        return None
+    profile = _profiles.setdefault(name, cProfile.Profile())
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12 allows only one profiler per process
+        return None
+    return profile
+
+
+def _start_peak(key: int) -> None:
+    """Reset the peak RSS of the process at the start of a stage. The peak so far
+    is kept by the running stages.
+
+    Args:
+        key (int): id of the record of the stage
+    """
+    global _resettable, _process_peak
+    with _peaks_lock:
+        if _resettable is False:
+            return
+        current = _high_water_mark()
+        if current is None:
+            _resettable = False
+            return
+        for running in _peaks:
+            _peaks[running] = max(_peaks[running], current)
+        _process_peak = max(_process_peak, current)
+        try:
+            CLEAR_REFS_PATH.write_text("5")
+            _resettable = True
+        except OSError:
+            _resettable = False
+            return
+        _peaks[key] = 0
+
+
+def _stop_peak(key: int) -> Optional[int]:
+    """Peak RSS of the process during a stage
+
+    Args:
+        key (int): id of the record of the stage
+
+    Returns:
+        Optional[int]: peak RSS in bytes, None if it is unknown
+    """
+    with _peaks_lock:
+        peak = _peaks.pop(key, None)
+        current = _high_water_mark()
+        if peak is None or current is None:
+            return None
+        return max(peak, current)
+
+
+def _high_water_mark() -> Optional[int]:
+    """Peak RSS of the process since the last reset
+
+    Returns:
+        Optional[int]: VmHWM in bytes, None if it is unknown
+    """
+    try:
+        with STATUS_PATH.open() as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of the current process since its start, e.g. of a
+    benchmark in a fresh process
+
+    Returns:
+        Optional[int]: peak RSS in bytes, None if it is unknown
+    """
+    if _resettable:
+        # The kernel only keeps the peak since the last reset of a stage
+        with _peaks_lock:
+            return max(_process_peak, _high_water_mark() or 0)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def drain() -> List[Record]:
+    """Take all records of this process, e.g. to send them to the parent process
+
+    Returns:
+        List[Record]: records in the order the stages finished
+    """
+    # Pops one record at a time, so records appended by background threads in
+    # the meantime are never lost
+    return [_records.popleft() for _ in range(len(_records))]
+
+
+def extend(records: List[Record]) -> None:
+    """Add records of another process
+
+    Args:
+        records (List[Record]): records of a worker
+    """
+    _records.extend(records)
+
+
+def write_jsonl(path: Path, records: List[Record]) -> None:
+    """Append records to a JSON-lines log
+
+    Args:
+        path (Path): path to the log file
+        records (List[Record]): records to append
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+
+
+def write_prometheus(path: Path, records: List[Record]) -> None:
+    """Write a summary per stage in the Prometheus textfile format. The file is
+    replaced atomically, so a node exporter never reads a partial file.
+
+    Args:
+        path (Path): path to the .prom file
+        records (List[Record]): records to summarize
+    """
+    totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    peaks: Dict[str, int] = {}
+    for record in records:
+        totals[record["stage"]]["runs"] += 1
+        for field in SUMMED_FIELDS:
+            if record.get(field) is not None:
+                totals[record["stage"]][field] += record[field]
+        if record.get("peak_rss_bytes") is not None:
+            peaks[record["stage"]] = max(
+                peaks.get(record["stage"], 0), record["peak_rss_bytes"]
+            )
+
+    lines = []
+    for field, suffix in SUMMED_FIELDS.items():
+        metric = f"{PREFIX}_stage_{suffix}"
+        stages = [
+            (name, total[field]) for name, total in totals.items() if field in total
+        ]
+        if not stages:
+            continue
+        lines.append(f"# TYPE {metric} counter")
+        for name, total in sorted(stages):
+            lines.append(f'{metric}{{stage="{name}"}} {total:g}')
+
+    metric = f"{PREFIX}_stage_peak_rss_bytes"
+    lines.append(f"# TYPE {metric} gauge")
+    for name, peak in sorted(peaks.items()):
+        lines.append(f'{metric}{{stage="{name}"}} {peak}')
+
+    failed = sum(1 for r in records if r["stage"] == "job" and r.get("error"))
+    lines.append(f"# TYPE {PREFIX}_failed_jobs gauge")
+    lines.append(f"{PREFIX}_failed_jobs {failed}")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    tmp_path.write_text("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def write_chrome_trace(path: Path, records: List[Record]) -> None:
+    """Write the stages of all processes as a timeline in the Chrome trace event
+    format, which chrome://tracing and Perfetto open. Every process has a track
+    per thread, the jobs of the scheduler also show how long each file waited
+    for a worker.
+
+    Args:
+        path (Path): path to the JSON trace
+        records (List[Record]): records of the parent process and its workers
+    """
+    timed = [r for r in records if r.get("start") is not None and "wall_s" in r]
+    origin = min(
+        [r["start"] for r in timed] + [r["queued"] for r in timed if "queued" in r],
+        default=0.0,
+    )
+    parent = os.getpid()
+
+    events: List[Dict[str, Any]] = []
+    for pid in sorted({r["pid"] for r in timed} | {parent}):
+        name = "main" if pid == parent else f"worker {pid}"
+        events.append(
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+        )
+
+    for job, record in enumerate(timed):
+        pid, tid = record["pid"], record.get("tid", record["pid"])
+        start = (record["start"] - origin) * 1e6
+        hidden = ("stage", "pid", "tid", "start", "wall_s", "queued")
+        events.append(
+            {
+                "name": record["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": start,
+                "dur": record["wall_s"] * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {k: v for k, v in record.items() if k not in hidden},
+            }
+        )
+        if "queued" in record:
+            # Waiting time of the file between its submission and its worker
+            wait = {"name": "wait", "cat": "queue", "id": job, "pid": parent}
+            wait["args"] = {"file": record["file"], "attempt": record.get("attempt")}
+            events.append({**wait, "ph": "b", "ts": (record["queued"] - origin) * 1e6})
+            events.append({**wait, "ph": "e", "ts": start})
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    tmp_path.write_text(
+        json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str)
+    )
+    os.replace(tmp_path, path)
@@ -0,0 +1,151 @@
+"""SQLite store of the plane equations of all point cloud files"""
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+# Host parameters per query, below the limit of older SQLite versions
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    points INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    stored REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS planes (
+    file TEXT NOT NULL REFERENCES files(file) ON DELETE CASCADE,
+    plane INTEGER NOT NULL,
+    a REAL NOT NULL,
+    b REAL NOT NULL,
+    c REAL NOT NULL,
+    d REAL NOT NULL,
+    inliers INTEGER NOT NULL,
+    PRIMARY KEY (file, plane)
+) WITHOUT ROWID;
+"""
+
+
+class PlaneStore:
+    """
+    Keeps the plane equations of every file together with their inlier counts
+    and the detection parameters in one SQLite database, keyed by the full
+    filename. The database runs in WAL mode, so pool workers write concurrently,
+    while others read. The planes of a file are replaced in a single
+    transaction, readers never see a partial set. Every call opens its own
+    connection, so the store can be passed to forked workers.
+    """
+
+    def __init__(self, db_path: Path, timeout: float = 60.0):
+
+        self.db_path = db_path
+        # Seconds, which a writer waits for the lock of another writer
+        self.timeout = timeout
+
+    def store(
+        self,
+        filename: str,
+        eqs: List[List[float]],
+        inliers: Optional[List[int]] = None,
+        method: str = "",
+        points: int = 0,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Replace the planes of a file
+
+        Args:
+            filename (str): name of the raw point cloud file
+            eqs (List[List[float]]): plane equations [a, b, c, d]
+            inliers (Optional[List[int]], optional): inlier count of every
+                plane. Defaults to None, which stores 0.
+            method (str, optional): name of the detector. Defaults to "".
+            points (int, optional): number of points, in which the planes were
+                detected. Defaults to 0.
+            params (Optional[Dict[str, Any]], optional): detection parameters.
+                Defaults to None.
+        """
+        inliers = inliers if inliers is not None else [0] * len(eqs)
+        rows = [
+            (filename, plane, *(float(value) for value in eq), int(count))
+            for plane, (eq, count) in enumerate(zip(eqs, inliers))
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM planes WHERE file = ?", (filename,))
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (
+                    filename,
+                    method,
+                    int(points),
+                    json.dumps(params or {}, sort_keys=True, default=str),
+                    time.time(),
+                ),
+            )
+            conn.executemany("INSERT INTO planes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def load(self, filename: str) -> List[List[float]]:
+        """Plane equations of a file
+
+        Args:
+            filename (str): name of the raw point cloud file
+
+        Raises:
+            KeyError: No planes of the file are stored!
+
+        Returns:
+            List[List[float]]: plane equations in the order of detection
+        """
+        eqs = self.load_many([filename])
+        if filename not in eqs:
+            raise KeyError(f"No plane equations of '{filename}' are stored!")
+        return eqs[filename]
+
+    def load_many(self, filenames: Iterable[str]) -> Dict[str, List[List[float]]]:
+        """Plane equations of several files with one query per batch
+
+        Args:
+            filenames (Iterable[str]): names of the raw point cloud files
+
+        Returns:
+            Dict[str, List[List[float]]]: plane equations per stored file, files
+            without planes map to an empty list
+        """
+        filenames = list(dict.fromkeys(filenames))
+        eqs: Dict[str, List[List[float]]] = {}
+        if not self.db_path.is_file():
+            return eqs
+
+        with closing(self._connect()) as conn:
+            for start in range(0, len(filenames), BATCH_SIZE):
+                batch = filenames[start : start + BATCH_SIZE]
+                marks = ", ".join("?" * len(batch))
+                for (filename,) in conn.execute(
+                    f"SELECT file FROM files WHERE file IN ({marks})", batch
+                ):
+                    eqs[filename] = []
+                for filename, a, b, c, d in conn.execute(
+                    f"SELECT file, a, b, c, d FROM planes WHERE file IN ({marks}) "
+                    "ORDER BY file, plane",
+                    batch,
+                ):
+                    eqs[filename].append([a, b, c, d])
+        return eqs
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection in WAL mode and create the tables on first use
+
+        Returns:
+            sqlite3.Connection: connection to the database
+        """
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # A commit only waits for the WAL, checkpoints sync the database
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(SCHEMA)
+        return conn
@@ -0,0 +1,319 @@
+"""Memory-mapped binary cache of raw point cloud files"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import open3d as o3d
+from open3d.cpu.pybind.geometry import PointCloud
+
+from .pointstream import TEXT_FORMATS, iter_chunks, read_ply_header, to_uint8, to_unit
+
+# Layout of the cache entries, older entries are rebuilt
+CACHE_VERSION = 2
+
+
+class PointCache:
+    """
+    Converts every raw point cloud file once into columnar binary files, which are
+    memory-mapped afterwards instead of parsed again. Entries are keyed by the
+    path, modification time and size of the raw file. Colors are kept as uint8,
+    if the file stores 8-bit colors, else as float64 in [0, 1], so reads through
+    the cache return the same colors as Open3D. The cache only saves the
+    parsing, an Open3D point cloud is still a float64 copy of the columns. Only
+    the compact path and the chunked reads avoid the copies of a whole cloud.
+    """
+
+    def __init__(self, cache_dir: Path, chunk_size: int = 2**20):
+
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+
+    def load_pointcloud(self, path: Path) -> PointCloud:
+        """Load a point cloud through the cache. Every column is copied into the
+        float64 vectors of Open3D, so the peak memory is the same as without the
+        cache, only the parsing is saved.
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            PointCloud: point cloud with colors and normals, if available
+        """
+        points, colors, normals = self.load_arrays(path)
+
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(points)
+        if colors is not None:
+            pcd.colors = o3d.utility.Vector3dVector(to_unit(colors))
+        if normals is not None:
+            pcd.normals = o3d.utility.Vector3dVector(normals)
+        return pcd
+
+    def load_arrays(
+        self, path: Path
+    ) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        """Copy-on-write memory maps of the cached columns, the cache entry is built
+        on first use. Open3D only accepts writeable arrays, writes never reach the
+        cache files.
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]: (N, 3)
+            float64 points, (N, 3) colors, uint8 for 8-bit sources, else float64
+            in [0, 1], and (N, 3) float64 normals
+        """
+        entry = self._entry(path)
+        if not entry.is_dir():
+            self._build(path, entry)
+
+        meta = json.loads((entry / "meta.json").read_text())
+        shape = (meta["count"], 3)
+        columns = []
+        for name, dtype in (("xyz", "<f8"), ("rgb", meta["rgb"]), ("normals", "<f8")):
+            column = entry / f"{name}.bin"
+            if not column.is_file():
+                columns.append(None)
+            elif not meta["count"]:
+                columns.append(np.empty(shape, dtype=dtype))
+            else:
+                columns.append(np.memmap(column, dtype=dtype, mode="c", shape=shape))
+        return columns[0], columns[1], columns[2]
+
+    def load_compact(
+        self, path: Path
+    ) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        """Read the cached columns chunk by chunk into float32 points and normals
+        and uint8 colors. Unlike the memory maps, the float64 columns are never
+        resident as a whole.
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]: (N, 3)
+            float32 points, (N, 3) uint8 colors and (N, 3) float32 normals
+        """
+        entry = self._entry(path)
+        if not entry.is_dir():
+            self._build(path, entry)
+
+        meta = json.loads((entry / "meta.json").read_text())
+        count = meta["count"]
+        columns = []
+        for name, dtype, out_dtype in (
+            ("xyz", "<f8", np.float32),
+            ("rgb", meta["rgb"], np.uint8),
+            ("normals", "<f8", np.float32),
+        ):
+            column = entry / f"{name}.bin"
+            if not column.is_file():
+                columns.append(None)
+                continue
+            out = np.empty((count, 3), dtype=out_dtype)
+            with column.open("rb") as fp:
+                for start in range(0, count, self.chunk_size):
+                    stop = min(start + self.chunk_size, count)
+                    block = np.fromfile(fp, dtype=dtype, count=3 * (stop - start))
+                    block = block.reshape(-1, 3)
+                    if name == "rgb":
+                        block = to_uint8(block)
+                    out[start:stop] = block
+            columns.append(out)
+        return columns[0], columns[1], columns[2]
+
+    def column_paths(self, path: Path) -> List[Path]:
+        """Column files of a raw file, the cache entry is built on first use
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            List[Path]: paths to the binary columns
+        """
+        entry = self._entry(path)
+        if not entry.is_dir():
+            self._build(path, entry)
+        return sorted(entry.glob("*.bin"))
+
+    def iter_chunks(
+        self, path: Path, chunk_size: int
+    ) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """Read a cached point cloud chunk by chunk, same output as
+        pointstream.iter_chunks
+
+        Args:
+            path (Path): path to the raw point cloud file
+            chunk_size (int): maximal number of points per chunk
+
+        Yields:
+            Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]: points and colors
+            in [0, 1], if the file has colors
+        """
+        points, colors, _ = self.load_arrays(path)
+        for start in range(0, len(points), chunk_size):
+            stop = start + chunk_size
+            if colors is None:
+                yield points[start:stop], None
+            else:
+                yield points[start:stop], to_unit(colors[start:stop])
+
+    def _entry(self, path: Path) -> Path:
+        """Cache directory of the current state of a raw file
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            Path: cache entry directory
+        """
+        stat = path.stat()
+        path_key = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:16]
+        state_key = hashlib.sha1(
+            f"v{CACHE_VERSION}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+        )
+        return self.cache_dir / f"{path_key}-{state_key.hexdigest()[:16]}"
+
+    def _build(self, path: Path, entry: Path) -> None:
+        """Convert a raw file into a cache entry, which replaces outdated entries
+        of the same file
+
+        Args:
+            path (Path): path to the raw point cloud file
+            entry (Path): cache entry directory
+        """
+        print(f"Caching '{path.name}' as binary columns...")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # Build in a private directory, concurrent workers and their prefetching
+        # threads may cache the same file
+        tmp_dir = (
+            self.cache_dir / f".{entry.name}.{os.getpid()}.{threading.get_ident()}"
+        )
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir()
+
+        rgb_dtype = self._rgb_dtype(path)
+        if self._is_streamable(path):
+            count = self._write_streamed(path, tmp_dir, rgb_dtype)
+        else:
+            count = self._write_loaded(path, tmp_dir, rgb_dtype)
+        meta = {"source": str(path.resolve()), "count": count, "rgb": rgb_dtype}
+        (tmp_dir / "meta.json").write_text(json.dumps(meta))
+
+        for outdated in self.cache_dir.glob(entry.name.split("-")[0] + "-*"):
+            if outdated != entry:
+                shutil.rmtree(outdated, ignore_errors=True)
+        try:
+            tmp_dir.rename(entry)
+        except OSError:
+            # Another worker was faster
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _write_streamed(self, path: Path, tmp_dir: Path, rgb_dtype: str) -> int:
+        """Stream a raw file into the cache without loading it as a whole
+
+        Args:
+            path (Path): path to the raw point cloud file
+            tmp_dir (Path): directory of the new cache entry
+            rgb_dtype (str): dtype of the cached colors
+
+        Returns:
+            int: number of points
+        """
+        count = 0
+        with (tmp_dir / "xyz.bin").open("wb") as xyz_fp:
+            rgb_fp = None
+            for points, colors in iter_chunks(path, self.chunk_size):
+                points.astype("<f8").tofile(xyz_fp)
+                if colors is not None:
+                    if rgb_fp is None:
+                        rgb_fp = (tmp_dir / "rgb.bin").open("wb")
+                    self._rgb_column(colors, rgb_dtype).tofile(rgb_fp)
+                count += len(points)
+            if rgb_fp is not None:
+                rgb_fp.close()
+        return count
+
+    def _write_loaded(self, path: Path, tmp_dir: Path, rgb_dtype: str) -> int:
+        """Load a raw file with Open3D and write its columns into the cache
+
+        Args:
+            path (Path): path to the raw point cloud file
+            tmp_dir (Path): directory of the new cache entry
+            rgb_dtype (str): dtype of the cached colors
+
+        Returns:
+            int: number of points
+        """
+        pcd = o3d.io.read_point_cloud(str(path))
+        np.asarray(pcd.points).astype("<f8").tofile(tmp_dir / "xyz.bin")
+        if pcd.has_colors():
+            colors = self._rgb_column(np.asarray(pcd.colors), rgb_dtype)
+            colors.tofile(tmp_dir / "rgb.bin")
+        if pcd.has_normals():
+            np.asarray(pcd.normals).astype("<f8").tofile(tmp_dir / "normals.bin")
+        return len(pcd.points)
+
+    @staticmethod
+    def _rgb_dtype(path: Path) -> str:
+        """Dtype of the cached colors, uint8 only for files with 8-bit colors, whose
+        colors Open3D scales by 1 / 255
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            str: 'u1' for PTS files and PLY files with uchar colors, else '<f8'
+        """
+        suffix = path.suffix.lower()
+        if suffix == ".pts":
+            return "u1"
+        if suffix == ".ply":
+            try:
+                _, _, props, _ = read_ply_header(path)
+            except ValueError:
+                return "<f8"
+            return "u1" if dict(props).get("red") == "u1" else "<f8"
+        return "<f8"
+
+    @staticmethod
+    def _rgb_column(colors: np.ndarray, rgb_dtype: str) -> np.ndarray:
+        """Colors in [0, 1] in the dtype of the cache entry
+
+        Args:
+            colors (np.ndarray): (N, 3) colors in [0, 1]
+            rgb_dtype (str): dtype of the cached colors
+
+        Returns:
+            np.ndarray: (N, 3) uint8 colors or float64 colors in [0, 1]
+        """
+        if rgb_dtype == "u1":
+            return to_uint8(colors)
+        return np.asarray(colors, dtype=rgb_dtype)
+
+    @staticmethod
+    def _is_streamable(path: Path) -> bool:
+        """Whether the streaming readers cover all attributes of the file
+
+        Args:
+            path (Path): path to the raw point cloud file
+
+        Returns:
+            bool: True, if the file can be cached chunk by chunk
+        """
+        suffix = path.suffix.lower()
+        if suffix == ".ply":
+            try:
+                _, _, props, _ = read_ply_header(path)
+            except ValueError:
+                return False
+            return "nx" not in dict(props)
+        return suffix in TEXT_FORMATS and suffix != ".xyzn"
@@ -0,0 +1,512 @@
+"""Chunked reading and writing of point cloud files, which never hold the whole
+point cloud in memory"""
+import os
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Scalar property types of the PLY format
+PLY_TYPES = {
+    "char": "i1",
+    "int8": "i1",
+    "uchar": "u1",
+    "uint8": "u1",
+    "short": "i2",
+    "int16": "i2",
+    "ushort": "u2",
+    "uint16": "u2",
+    "int": "i4",
+    "int32": "i4",
+    "uint": "u4",
+    "uint32": "u4",
+    "float": "f4",
+    "float32": "f4",
+    "double": "f8",
+    "float64": "f8",
+}
+
+TEXT_FORMATS = (".xyz", ".xyzn", ".xyzrgb", ".pts")
+
+# Placeholder width of the vertex count, which is only known after writing
+COUNT_WIDTH = 20
+
+
+def read_ply_header(path: Path) -> Tuple[str, int, List[Tuple[str, str]], int]:
+    """Parse the header of a PLY file, whose first element are the vertices
+
+    Args:
+        path (Path): path to the PLY file
+
+    Raises:
+        ValueError: The PLY layout is not supported for streaming!
+
+    Returns:
+        Tuple[str, int, List[Tuple[str, str]], int]: format, vertex count, vertex
+        properties as (name, dtype) and the byte length of the header
+    """
+    fmt, count, props = "", 0, []
+    with path.open("rb") as fp:
+        if fp.readline().strip() != b"ply":
+            raise ValueError(f"'{path.name}' is not a PLY file!")
+
+        element = None
+        while True:
+            line = fp.readline()
+            if not line:
+                raise ValueError(f"'{path.name}' has no complete PLY header!")
+
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "end_header":
+                return fmt, count, props, fp.tell()
+
+            if words[0] == "format":
+                fmt = words[1]
+            elif words[0] == "element":
+                if element is None and words[1] != "vertex":
+                    raise ValueError("Vertices must be the first PLY element!")
+                element = words[1]
+                if element == "vertex":
+                    count = int(words[2])
+            elif words[0] == "property" and element == "vertex":
+                if words[1] == "list":
+                    raise ValueError("List properties of vertices are not supported!")
+                props.append((words[2], PLY_TYPES[words[1]]))
+
+
+def iter_chunks(
+    path: Path, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+    """Read a point cloud file chunk by chunk
+
+    Args:
+        path (Path): path to the point cloud file
+        chunk_size (int): maximal number of points per chunk
+
+    Raises:
+        ValueError: The file format does not support streaming!
+
+    Yields:
+        Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]: (N, 3) float64 points
+        and (N, 3) float64 colors in [0, 1], if the file has colors
+    """
+    suffix = path.suffix.lower()
+    if suffix == ".ply":
+        yield from _iter_ply(path, chunk_size)
+    elif suffix in TEXT_FORMATS:
+        yield from _iter_text(path, chunk_size)
+    else:
+        raise ValueError(f"Streaming of '{suffix}' files is not supported!")
+
+
+def _iter_ply(
+    path: Path, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+    """Read the vertices of a PLY file chunk by chunk
+
+    Args:
+        path (Path): path to the PLY file
+        chunk_size (int): maximal number of points per chunk
+
+    Yields:
+        Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]: points and colors
+    """
+    fmt, count, props, offset = read_ply_header(path)
+    names = [name for name, _ in props]
+    color_names = [name for name in ("red", "green", "blue") if name in names]
+
+    if fmt == "ascii":
+        with path.open("rb") as fp:
+            fp.seek(offset)
+            xyz_cols = [names.index(name) for name in "xyz"]
+            rgb_cols = [names.index(name) for name in color_names]
+            # Stop at the vertex count, other elements may follow
+            for start in range(0, count, chunk_size):
+                lines = list(islice(fp, min(chunk_size, count - start)))
+                rows = np.loadtxt(lines, ndmin=2)
+                yield _split(rows[:, xyz_cols], rows[:, rgb_cols], props, color_names)
+        return
+
+    order = "<" if fmt == "binary_little_endian" else ">"
+    dtype = np.dtype([(name, order + typ) for name, typ in props])
+    vertices = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    for start in range(0, count, chunk_size):
+        block = vertices[start : start + chunk_size]
+        points = np.column_stack([block[name] for name in "xyz"]).astype(np.float64)
+        colors = np.column_stack([block[name] for name in color_names])
+        yield _split(points, colors, props, color_names)
+
+
+def _split(
+    points: np.ndarray,
+    colors: np.ndarray,
+    props: List[Tuple[str, str]],
+    color_names: List[str],
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Scale PLY colors into [0, 1]
+
+    Args:
+        points (np.ndarray): (N, 3) points
+        colors (np.ndarray): (N, 3) raw colors, (N, 0) if there are none
+        props (List[Tuple[str, str]]): vertex properties as (name, dtype)
+        color_names (List[str]): names of the color properties
+
+    Returns:
+        Tuple[np.ndarray, Optional[np.ndarray]]: points and scaled colors
+    """
+    if len(color_names) != 3:
+        return points, None
+    colors = colors.astype(np.float64)
+    if dict(props)["red"] == "u1":
+        colors /= 255.0
+    return points, colors
+
+
+def _iter_text(
+    path: Path, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+    """Read a XYZ, XYZN, XYZRGB or PTS file chunk by chunk, following the column
+    layouts of the Open3D readers
+
+    Args:
+        path (Path): path to the text file
+        chunk_size (int): maximal number of points per chunk
+
+    Yields:
+        Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]: points and colors
+    """
+    suffix = path.suffix.lower()
+    with path.open("r") as fp:
+        first = True
+        while True:
+            lines = list(islice(fp, chunk_size))
+            if not lines:
+                return
+            # PTS files may start with the number of points
+            if first and suffix == ".pts" and len(lines[0].split()) == 1:
+                lines = lines[1:]
+            first = False
+            if not lines:
+                continue
+
+            rows = np.loadtxt(lines, ndmin=2)
+            points, colors = rows[:, :3], None
+            if suffix == ".xyzrgb":
+                colors = rows[:, 3:6]
+            elif suffix == ".pts" and rows.shape[1] in (6, 7):
+                colors = rows[:, rows.shape[1] - 3 :] / 255.0
+            yield points, colors
+
+
+def count_points(path: Path, chunk_size: int = 2**20) -> int:
+    """Number of points in a point cloud file, read from the header if possible
+
+    Args:
+        path (Path): path to the point cloud file
+        chunk_size (int, optional): points per chunk. Defaults to 2**20.
+
+    Returns:
+        int: number of points
+    """
+    if path.suffix.lower() == ".ply":
+        return read_ply_header(path)[1]
+    return sum(len(points) for points, _ in iter_chunks(path, chunk_size))
+
+
+class StreamWriter(ABC):
+    """
+    Writer, which appends points chunk by chunk, so a point cloud is written
+    without holding it in memory. The points go into a hidden temporary file next
+    to the output, which replaces the output on close, so readers never see a
+    partial file. Used as a context manager, an error discards the temporary
+    file.
+    """
+
+    def __init__(self, path: Path, with_colors: bool, with_normals: bool = False):
+
+        self.path = path
+        self.with_colors = with_colors
+        self.with_normals = with_normals
+        self.count = 0
+        self.tmp_path = path.with_name(
+            f".{path.stem}.{os.getpid()}.{threading.get_ident()}{path.suffix}"
+        )
+
+    def __enter__(self) -> "StreamWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @abstractmethod
+    def write(
+        self,
+        points: np.ndarray,
+        colors: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ) -> None:
+        """Append a chunk of points
+
+        Args:
+            points (np.ndarray): (N, 3) points
+            colors (Optional[np.ndarray], optional): (N, 3) colors in [0, 1] or
+                uint8. Defaults to None.
+            normals (Optional[np.ndarray], optional): (N, 3) normals. Defaults
+                to None.
+        """
+
+    @abstractmethod
+    def close(self) -> None:
+        """Complete the file and move it to its path"""
+
+    def abort(self) -> None:
+        """Close and delete the temporary files, the path stays untouched"""
+        for path in self._files():
+            if path.exists():
+                path.unlink()
+
+    def _files(self) -> List[Path]:
+        """Temporary files of the writer
+
+        Returns:
+            List[Path]: paths of the files
+        """
+        return [self.tmp_path]
+
+
+class PlyStreamWriter(StreamWriter):
+    """
+    Binary little-endian PLY writer, which writes the final vertex count, when it
+    is closed, so readers never see a vertex count of 0.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        with_colors: bool,
+        with_normals: bool = False,
+        precision: str = "<f8",
+    ):
+
+        super().__init__(path, with_colors, with_normals)
+        # Same property order as Open3D
+        fields = [(name, precision) for name in "xyz"]
+        if with_normals:
+            fields += [(name, precision) for name in ("nx", "ny", "nz")]
+        if with_colors:
+            fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+        self.dtype = np.dtype(fields)
+
+        self._fp = self.tmp_path.open("wb")
+        self._fp.write(self._header(0))
+
+    def write(
+        self,
+        points: np.ndarray,
+        colors: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ) -> None:
+        vertices = np.empty(len(points), dtype=self.dtype)
+        for axis, name in enumerate("xyz"):
+            vertices[name] = points[:, axis]
+        if self.with_normals:
+            for axis, name in enumerate(("nx", "ny", "nz")):
+                vertices[name] = normals[:, axis]
+        if self.with_colors:
+            colors = to_uint8(colors)
+            for axis, name in enumerate(("red", "green", "blue")):
+                vertices[name] = colors[:, axis]
+        vertices.tofile(self._fp)
+        self.count += len(points)
+
+    def close(self) -> None:
+        """Write the final vertex count and move the file to its path"""
+        self._fp.seek(0)
+        self._fp.write(self._header(self.count))
+        self._fp.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._fp.close()
+        super().abort()
+
+    def _header(self, count: int) -> bytes:
+        """PLY header with a fixed width vertex count
+
+        Args:
+            count (int): number of vertices
+
+        Returns:
+            bytes: encoded header
+        """
+        lines = [
+            "ply",
+            "format binary_little_endian 1.0",
+            f"element vertex {count:0{COUNT_WIDTH}d}",
+        ]
+        types = {"f8": "double", "f4": "float", "u1": "uchar"}
+        lines += [
+            f"property {types[self.dtype[name].str[1:]]} {name}"
+            for name in self.dtype.names
+        ]
+        lines.append("end_header")
+        return ("\n".join(lines) + "\n").encode("ascii")
+
+
+class TextStreamWriter(StreamWriter):
+    """
+    XYZ, XYZN, XYZRGB or PTS writer with the column layouts of the Open3D
+    writers. The point count of a PTS file is written, when it is closed.
+    """
+
+    def __init__(self, path: Path, with_colors: bool, with_normals: bool = False):
+
+        super().__init__(path, with_colors, with_normals)
+        self.suffix = path.suffix.lower()
+        if self.suffix not in TEXT_FORMATS:
+            raise ValueError(f"'{self.suffix}' is not a text point cloud format!")
+        if self.suffix == ".xyzn" and not with_normals:
+            raise ValueError("XYZN files need normals!")
+
+        self._fp = self.tmp_path.open("w")
+        if self.suffix == ".pts":
+            self._fp.write(f"{0:0{COUNT_WIDTH}d}\n")
+
+    def write(
+        self,
+        points: np.ndarray,
+        colors: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ) -> None:
+        columns, fmt = [points], ["%.10f"] * 3
+        if self.suffix == ".xyzn":
+            columns.append(normals)
+            fmt += ["%.10f"] * 3
+        elif self.suffix == ".xyzrgb":
+            columns.append(to_unit(colors) if self.with_colors else points * 0.0)
+            fmt += ["%.10f"] * 3
+        elif self.suffix == ".pts" and self.with_colors:
+            # Intensity, which is not kept, and 8 bit colors
+            columns += [np.zeros((len(points), 1)), to_uint8(colors)]
+            fmt += ["%d"] * 4
+        np.savetxt(self._fp, np.hstack(columns), fmt=" ".join(fmt))
+        self.count += len(points)
+
+    def close(self) -> None:
+        """Write the final point count and move the file to its path"""
+        if self.suffix == ".pts":
+            self._fp.seek(0)
+            self._fp.write(f"{self.count:0{COUNT_WIDTH}d}\n")
+        self._fp.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._fp.close()
+        super().abort()
+
+
+class NpzStreamWriter(StreamWriter):
+    """
+    Writer of the compressed NPZ archives of the PointWriter. The columns are
+    appended to raw temporary files and compressed from memory maps, when the
+    writer is closed.
+    """
+
+    def __init__(self, path: Path, with_colors: bool, with_normals: bool = False):
+
+        super().__init__(path, with_colors, with_normals)
+        self.dtypes = {"xyz": np.float64}
+        if with_colors:
+            self.dtypes["rgb"] = np.uint8
+        if with_normals:
+            self.dtypes["normals"] = np.float64
+        self._fps = {name: self._column_path(name).open("wb") for name in self.dtypes}
+
+    def write(
+        self,
+        points: np.ndarray,
+        colors: Optional[np.ndarray] = None,
+        normals: Optional[np.ndarray] = None,
+    ) -> None:
+        columns = {"xyz": points, "rgb": colors, "normals": normals}
+        if self.with_colors:
+            columns["rgb"] = to_uint8(colors)
+        for name, fp in self._fps.items():
+            np.ascontiguousarray(columns[name], dtype=self.dtypes[name]).tofile(fp)
+        self.count += len(points)
+
+    def close(self) -> None:
+        """Compress the columns into the archive and move it to its path"""
+        for fp in self._fps.values():
+            fp.close()
+        try:
+            columns = {
+                name: np.memmap(self._column_path(name), dtype=dtype, mode="r")
+                if self.count
+                else np.empty(0, dtype=dtype)
+                for name, dtype in self.dtypes.items()
+            }
+            with self.tmp_path.open("wb") as fp:
+                np.savez_compressed(
+                    fp,
+                    **{name: column.reshape(-1, 3) for name, column in columns.items()},
+                )
+            del columns
+            os.replace(self.tmp_path, self.path)
+        finally:
+            super().abort()
+
+    def abort(self) -> None:
+        for fp in self._fps.values():
+            fp.close()
+        super().abort()
+
+    def _files(self) -> List[Path]:
+        return [self.tmp_path] + [self._column_path(name) for name in self.dtypes]
+
+    def _column_path(self, name: str) -> Path:
+        """Raw temporary file of a column
+
+        Args:
+            name (str): name of the column
+
+        Returns:
+            Path: path of the file
+        """
+        return self.tmp_path.with_name(f"{self.tmp_path.name}.{name}")
+
+
+def to_uint8(colors: np.ndarray) -> np.ndarray:
+    """Colors as uint8
+
+    Args:
+        colors (np.ndarray): (N, 3) colors in [0, 1] or uint8
+
+    Returns:
+        np.ndarray: (N, 3) uint8 colors
+    """
+    if colors.dtype == np.uint8:
+        return colors
+    return np.round(np.clip(colors, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+def to_unit(colors: np.ndarray) -> np.ndarray:
+    """Colors in [0, 1]
+
+    Args:
+        colors (np.ndarray): (N, 3) colors in [0, 1] or uint8
+
+    Returns:
+        np.ndarray: (N, 3) float64 colors
+    """
+    if colors.dtype == np.uint8:
+        return colors / 255.0
+    return colors
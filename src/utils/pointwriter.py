@@ -0,0 +1,237 @@
+"""Atomic writer of intermediate and final point cloud files"""
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import open3d as o3d
+from open3d.cpu.pybind.geometry import PointCloud
+
+from .compactcloud import CompactCloud, to_open3d
+from .pointstream import (
+    TEXT_FORMATS,
+    NpzStreamWriter,
+    PlyStreamWriter,
+    StreamWriter,
+    TextStreamWriter,
+)
+
+# Output formats: binary little-endian PLY, compressed columns or the raw format
+FORMATS = ("ply", "npz", "input")
+
+# Attributes, which can be dropped from the output
+ATTRIBUTES = ("colors", "normals")
+
+
+class PointWriter:
+    """
+    Writes point clouds as binary little-endian PLY, as compressed columns in a
+    NPZ archive or through Open3D in the format of the raw file. Every file is
+    written into a temporary file next to it and renamed, so readers never see a
+    partial file and an existing file is replaced. Dropped attributes are not
+    written.
+    """
+
+    def __init__(
+        self, fmt: str = "input", drop: Sequence[str] = (), chunk_size: int = 2**20
+    ):
+
+        if fmt not in FORMATS:
+            raise ValueError(f"The output format '{fmt}' does not exist!")
+        unknown = set(drop) - set(ATTRIBUTES)
+        if unknown:
+            raise ValueError(f"The attributes {sorted(unknown)} cannot be dropped!")
+
+        self.fmt = fmt
+        self.drop = set(drop)
+        self.chunk_size = chunk_size
+
+    @property
+    def suffix(self) -> Optional[str]:
+        """Suffix of the written files, None for the suffix of the raw file"""
+        return None if self.fmt == "input" else f".{self.fmt}"
+
+    def name(self, filename: str) -> str:
+        """Name of the output file of a raw file
+
+        Args:
+            filename (str): name of the raw point cloud file
+
+        Returns:
+            str: name of the output file
+        """
+        if self.suffix is None:
+            return filename
+        return Path(filename).with_suffix(self.suffix).name
+
+    def write(self, path: Path, cloud: Union[PointCloud, CompactCloud]) -> None:
+        """Write a point cloud atomically
+
+        Args:
+            path (Path): path of the output file
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+
+        Raises:
+            OSError: Open3D failed to write the point cloud!
+        """
+        if self.fmt == "ply":
+            # The stream writer replaces the file atomically itself
+            self._write_ply(path, cloud)
+            return
+
+        tmp_path = path.with_name(
+            f".{path.stem}.{os.getpid()}.{threading.get_ident()}{path.suffix}"
+        )
+        try:
+            if self.fmt == "npz":
+                self._write_npz(tmp_path, cloud)
+            elif not o3d.io.write_point_cloud(str(tmp_path), self._open3d(cloud)):
+                raise OSError(f"Open3D failed to write '{path.name}'!")
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def stream(
+        self, path: Path, with_colors: bool, with_normals: bool = False
+    ) -> StreamWriter:
+        """Writer, which appends a point cloud chunk by chunk in the format of this
+        writer, e.g. for point clouds, which do not fit into memory
+
+        Args:
+            path (Path): path of the output file
+            with_colors (bool): the point cloud has colors
+            with_normals (bool, optional): the point cloud has normals. Defaults
+                to False.
+
+        Raises:
+            ValueError: The format of the raw file cannot be streamed!
+
+        Returns:
+            StreamWriter: atomic stream writer
+        """
+        with_colors = with_colors and "colors" not in self.drop
+        with_normals = with_normals and "normals" not in self.drop
+        suffix = path.suffix.lower()
+        if self.fmt == "npz":
+            return NpzStreamWriter(path, with_colors, with_normals)
+        if self.fmt == "ply" or suffix == ".ply":
+            return PlyStreamWriter(path, with_colors, with_normals)
+        if suffix in TEXT_FORMATS:
+            return TextStreamWriter(path, with_colors, with_normals)
+        raise ValueError(f"Streaming of '{suffix}' files is not supported!")
+
+    def _columns(
+        self, cloud: Union[PointCloud, CompactCloud]
+    ) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        """Points and the written attributes without copies
+
+        Args:
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+
+        Returns:
+            Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]: (N, 3)
+            points, (N, 3) uint8 or [0, 1] colors and (N, 3) normals
+        """
+        colors = normals = None
+        if cloud.has_colors() and "colors" not in self.drop:
+            colors = cloud.rgb if isinstance(cloud, CompactCloud) else cloud.colors
+        if cloud.has_normals() and "normals" not in self.drop:
+            normals = cloud.normals
+        return (
+            np.asarray(cloud.points),
+            None if colors is None else np.asarray(colors),
+            None if normals is None else np.asarray(normals),
+        )
+
+    def _write_ply(self, path: Path, cloud: Union[PointCloud, CompactCloud]) -> None:
+        """Write a binary little-endian PLY file chunk by chunk, points and normals
+        keep their precision
+
+        Args:
+            path (Path): path of the file
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+        """
+        points, colors, normals = self._columns(cloud)
+        with PlyStreamWriter(
+            path,
+            with_colors=colors is not None,
+            with_normals=normals is not None,
+            precision=points.dtype.str,
+        ) as writer:
+            for start in range(0, len(points), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                writer.write(
+                    points[chunk],
+                    None if colors is None else colors[chunk],
+                    None if normals is None else normals[chunk],
+                )
+
+    def _write_npz(self, path: Path, cloud: Union[PointCloud, CompactCloud]) -> None:
+        """Write the columns into a compressed NPZ archive, colors as uint8
+
+        Args:
+            path (Path): path of the file
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+        """
+        points, colors, normals = self._columns(cloud)
+        columns = {"xyz": points}
+        if colors is not None:
+            if colors.dtype != np.uint8:
+                colors = np.round(np.clip(colors, 0.0, 1.0) * 255.0).astype(np.uint8)
+            columns["rgb"] = colors
+        if normals is not None:
+            columns["normals"] = normals
+        with path.open("wb") as fp:
+            np.savez_compressed(fp, **columns)
+
+    def _open3d(self, cloud: Union[PointCloud, CompactCloud]) -> PointCloud:
+        """Open3D point cloud without the dropped attributes
+
+        Args:
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+
+        Returns:
+            PointCloud: point cloud to write
+        """
+        pcd = to_open3d(cloud)
+        if not (
+            ("colors" in self.drop and pcd.has_colors())
+            or ("normals" in self.drop and pcd.has_normals())
+        ):
+            return pcd
+
+        stripped = o3d.geometry.PointCloud()
+        stripped.points = pcd.points
+        if pcd.has_colors() and "colors" not in self.drop:
+            stripped.colors = pcd.colors
+        if pcd.has_normals() and "normals" not in self.drop:
+            stripped.normals = pcd.normals
+        return stripped
+
+
+def read_npz(path: Path, compact: bool = False) -> Union[PointCloud, CompactCloud]:
+    """Read a point cloud, which was written as NPZ archive
+
+    Args:
+        path (Path): path of the file
+        compact (bool, optional): return a CompactCloud. Defaults to False.
+
+    Returns:
+        Union[PointCloud, CompactCloud]: point cloud
+    """
+    with np.load(path) as archive:
+        points = archive["xyz"]
+        rgb = archive["rgb"] if "rgb" in archive else None
+        normals = archive["normals"] if "normals" in archive else None
+    if compact:
+        return CompactCloud(points, rgb, normals)
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points.astype(np.float64))
+    if rgb is not None:
+        pcd.colors = o3d.utility.Vector3dVector(rgb / 255.0)
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(normals.astype(np.float64))
+    return pcd
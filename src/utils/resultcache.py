@@ -0,0 +1,273 @@
+"""Content-addressed cache of the stage results of the pipeline"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from open3d.cpu.pybind.geometry import PointCloud
+
+from .compactcloud import CompactCloud
+from .pointwriter import PointWriter, read_npz
+
+# Bump to invalidate all entries after changes of the stage outputs
+CACHE_VERSION = 3
+
+# Config sections, which determine the output of each stage. Every stage also
+# depends on the stages before it.
+STAGE_SECTIONS = {
+    "detection": ("DOWN", "PLANE_DETECTION", "RANSAC", "PIPELINE"),
+    "removal": ("PLANE_REMOVAL",),
+    "outliers": ("OUT_REMOVAL", "OUTPUT"),
+}
+
+# Config keys, which do not change the result of a stage, only its speed or memory
+IGNORED_KEYS = (
+    "WORKERS",
+    "BLOCK_MB",
+    "CHUNK_SIZE",
+    "HALO",
+    "VALIDATE",
+    "USE",
+    "FUSED",
+    "STORE_INTERMEDIATE",
+)
+
+# Point clouds are cached as binary columns, whatever the format of the raw file
+CLOUD_NAME = "cloud.npz"
+
+
+class ResultCache:
+    """
+    Stores the plane equations, the point cloud without planes and the final
+    point cloud of every file. Entries are keyed by a hash of the file content
+    and the config sections of the stage and all stages before it, so a change
+    of OUT_REMOVAL only reruns the outlier removal. The least recently used
+    entries are evicted, when the cache exceeds its size cap.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: Optional[int] = None):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.writer = PointWriter("npz")
+
+    def keys(self, path: Path, configs: Dict[str, Any]) -> Dict[str, str]:
+        """Keys of all stages of a file
+
+        Args:
+            path (Path): path to the raw point cloud file
+            configs (Dict[str, Any]): pipeline configs
+
+        Returns:
+            Dict[str, str]: key per stage
+        """
+        keys = {}
+        key = f"v{CACHE_VERSION}:{self.content_hash(path)}"
+        for stage, sections in STAGE_SECTIONS.items():
+            params = {
+                section: {
+                    name: value
+                    for name, value in configs[section].items()
+                    if name not in IGNORED_KEYS
+                }
+                for section in sections
+            }
+            key = hashlib.sha256(
+                (key + json.dumps(params, sort_keys=True)).encode()
+            ).hexdigest()
+            keys[stage] = key
+        return keys
+
+    def content_hash(self, path: Path) -> str:
+        """SHA-256 of a file, which is only recomputed after the file changed
+
+        Args:
+            path (Path): path to the file
+
+        Returns:
+            str: hex digest of the content
+        """
+        stat = path.stat()
+        state = f"{stat.st_mtime_ns}:{stat.st_size}"
+        memo = (
+            self.cache_dir
+            / "hashes"
+            / hashlib.sha1(str(path.resolve()).encode()).hexdigest()
+        )
+        try:
+            known = json.loads(memo.read_text())
+            if known["state"] == state:
+                return known["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.sha256()
+        with path.open("rb") as fp:
+            for block in iter(lambda: fp.read(2**20), b""):
+                digest.update(block)
+
+        memo.parent.mkdir(parents=True, exist_ok=True)
+        tmp_memo = memo.with_name(f".{memo.name}.{os.getpid()}")
+        tmp_memo.write_text(json.dumps({"state": state, "hash": digest.hexdigest()}))
+        os.replace(tmp_memo, memo)
+        return digest.hexdigest()
+
+    def load_eqs(self, key: str) -> Optional[Tuple[List[List[float]], List[int], int]]:
+        """Cached plane equations
+
+        Args:
+            key (str): key of the detection stage
+
+        Returns:
+            Optional[Tuple[List[List[float]], List[int], int]]: plane equations,
+            their inlier counts and the number of points, in which they were
+            detected, None on a cache miss
+        """
+        entry = self._get(key)
+        if entry is None:
+            return None
+        try:
+            planes = json.loads((entry / "eqs.json").read_text())
+            return planes["eqs"], planes["inliers"], planes["points"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store_eqs(
+        self, key: str, eqs: List[List[float]], inliers: List[int], points: int
+    ) -> None:
+        """Cache plane equations
+
+        Args:
+            key (str): key of the detection stage
+            eqs (List[List[float]]): plane equations
+            inliers (List[int]): inlier count of every plane
+            points (int): number of points, in which the planes were detected
+        """
+        planes = {
+            "eqs": [[float(value) for value in eq] for eq in eqs],
+            "inliers": [int(count) for count in inliers],
+            "points": int(points),
+        }
+        self._put(
+            key, lambda entry: (entry / "eqs.json").write_text(json.dumps(planes))
+        )
+
+    def load_cloud(
+        self, key: str, compact: bool = False
+    ) -> Optional[Union[PointCloud, CompactCloud]]:
+        """Cached point cloud
+
+        Args:
+            key (str): key of the stage
+            compact (bool, optional): return a CompactCloud. Defaults to False.
+
+        Returns:
+            Optional[Union[PointCloud, CompactCloud]]: point cloud, None on a
+            cache miss
+        """
+        entry = self._get(key)
+        if entry is None or not (entry / CLOUD_NAME).is_file():
+            return None
+        return read_npz(entry / CLOUD_NAME, compact)
+
+    def store_cloud(self, key: str, cloud: Union[PointCloud, CompactCloud]) -> None:
+        """Cache a point cloud as binary columns with the precision of its points
+
+        Args:
+            key (str): key of the stage
+            cloud (Union[PointCloud, CompactCloud]): point cloud
+        """
+        self._put(key, lambda entry: self.writer.write(entry / CLOUD_NAME, cloud))
+
+    def restore_file(self, key: str, filename: str, out_dir: Path) -> bool:
+        """Copy a cached output file into an output directory
+
+        Args:
+            key (str): key of the stage
+            filename (str): name of the output file
+            out_dir (Path): output directory
+
+        Returns:
+            bool: True on a cache hit
+        """
+        entry = self._get(key)
+        if entry is None:
+            return False
+        try:
+            shutil.copyfile(entry / filename, out_dir / filename)
+        except OSError:
+            return False
+        return True
+
+    def store_file(self, key: str, path: Path) -> None:
+        """Cache an output file
+
+        Args:
+            key (str): key of the stage
+            path (Path): path to the output file
+        """
+        self._put(key, lambda entry: shutil.copyfile(path, entry / path.name))
+
+    def _get(self, key: str) -> Optional[Path]:
+        """Entry of a key, which is marked as recently used
+
+        Args:
+            key (str): key of the stage
+
+        Returns:
+            Optional[Path]: entry directory, None on a cache miss
+        """
+        entry = self.cache_dir / key
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        return entry
+
+    def _put(self, key: str, write: Callable[[Path], Any]) -> None:
+        """Create an entry atomically and evict old entries afterwards
+
+        Args:
+            key (str): key of the stage
+            write (Callable[[Path], Any]): writes the result into a directory
+        """
+        entry = self.cache_dir / key
+        tmp_dir = self.cache_dir / f".{key}.{os.getpid()}"
+        try:
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            write(tmp_dir)
+            tmp_dir.rename(entry)
+        except OSError:
+            # Another worker stored the same result
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries, until the cache fits into its
+        size cap"""
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if (
+                not entry.is_dir()
+                or entry.name.startswith(".")
+                or entry.name == "hashes"
+            ):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -1,6 +1,14 @@
-from typing import Dict, Any
+from functools import partial
+from typing import Dict, Any, List, Optional, Tuple
+from multiprocessing import Pool
+from pathlib import Path
 import os
+import shutil
 
+import numpy as np
+import open3d as o3d
+
+import system_setup as setup
 from processors.plane_detection import PlaneDetection
 from processors.plane_removal import PlaneRemoval
 from processors.outlier_removal import (
@@ -8,7 +16,13 @@ from processors.outlier_removal import (
     StatisticalOutlierRemoval,
     RadiusOutlierRemoval,
 )
+from . import background, metrics
+from .dataloader import DataLoaderDS
 from .enums import PCFormats
+from .pointstream import iter_chunks
+from .resultcache import ResultCache
+from .tiling import TileGrid, load_tile, merge_planes, spill_tiles, stream_bounds
+from .utils import assign_to_planes
 
 
 class Runner:
@@ -21,12 +35,28 @@ class Runner:
         out_remover: Context,
         pc_formats: PCFormats,
         configs: Dict[str, float],
+        dataloader: Optional[DataLoaderDS] = None,
+        result_cache: Optional[ResultCache] = None,
     ):
         self.plane_detector = plane_detector
         self.plane_remover = plane_remover
         self.out_remover = out_remover
         self.pc_formats = pc_formats
         self.configs = configs
+        # Only needed for the fused and tiled pipelines
+        self.dataloader = dataloader
+        # Only used by the fused pipeline
+        self.result_cache = result_cache
+
+    def prefetch(self, file: Any):
+        """Load a raw point cloud file ahead of its job
+
+        Args:
+            file (Any): file in raw directory
+        """
+        filename = os.fsdecode(file)
+        if filename.endswith(tuple([enum.name.lower() for enum in self.pc_formats])):
+            self.plane_remover.dataloader.prefetch(filename)
 
     def detect_plane(self, file: Any):
         """Detect planes in a single point cloud
@@ -44,6 +74,7 @@ class Runner:
                     self.plane_detector.display_pointcloud(cloud)
         except Exception as exc:
             print(exc)
+            raise
 
     def remove_plane(self, file: Any):
         """Remove planes from a single point cloud
@@ -66,3 +97,314 @@ class Runner:
                     self.plane_remover.display_pointcloud(cloud)
         except Exception as exc:
             print(exc)
+            raise
+
+    def process_file_staged(self, file: Any):
+        """Run the stages of the unfused pipeline on a single point cloud one
+        after another, each stage stores its results for the next one
+
+        Args:
+            file (Any): file in raw directory
+        """
+        self.detect_plane(file)
+        if self.configs["PLANE_REMOVAL"]["USE"]:
+            self.remove_plane(file)
+
+    def process_file(self, file: Any):
+        """Run plane detection, plane removal and outlier removal on a single point
+        cloud, which is loaded once and kept in memory between the stages. Stages,
+        whose results are in the result cache, are skipped.
+
+        Args:
+            file (Any): file in raw directory
+        """
+        try:
+            filename = os.fsdecode(file)
+            if not filename.endswith(
+                tuple([enum.name.lower() for enum in self.pc_formats])
+            ):
+                return
+
+            cache = self.result_cache
+            keys = {}
+            if cache:
+                keys = cache.keys(self.dataloader.dir_path / filename, self.configs)
+            use_removal = self.configs["PLANE_REMOVAL"]["USE"]
+            use_outliers = use_removal and self.configs["OUT_REMOVAL"]["USE"]
+            out_dir = self.out_remover.strategy.out_dir
+            out_name = self.out_remover.strategy.writer.name(filename)
+
+            # Cached planes are stored like detected ones, later stages are only
+            # reused together with them
+            planes = cache.load_eqs(keys["detection"]) if keys else None
+            if planes is not None:
+                self.plane_detector.store_planes(filename, *planes)
+            if use_outliers and planes is not None:
+                if cache.restore_file(keys["outliers"], out_name, out_dir):
+                    print(f"Reused the cached result of '{filename}'")
+                    return
+
+            cloud = None
+            if use_removal and planes is not None:
+                compact = self.configs["PIPELINE"].get("COMPACT", False)
+                cloud = cache.load_cloud(keys["removal"], compact)
+
+            if cloud is None:
+                raw_cloud = self.dataloader.read_data(filename)
+
+                if planes is None:
+                    cloud, indices = raw_cloud, None
+                    if not self.plane_detector.full_resolution:
+                        cloud, indices = self.dataloader.downsample_data(
+                            raw_cloud, filename
+                        )
+                    cloud = self.plane_detector.detect_planes_in_cloud(
+                        filename, cloud, indices
+                    )
+                    if self.configs["VERBOSE"]:
+                        self.plane_detector.display_pointcloud(cloud)
+                    planes = self.plane_detector.detected_planes()
+                    self.plane_detector.store_planes(filename, *planes)
+                    if keys:
+                        cache.store_eqs(keys["detection"], *planes)
+
+                if not use_removal:
+                    return
+
+                cloud = self.plane_remover.remove_planes_from_cloud(
+                    filename, raw_cloud, planes[0]
+                )
+                # Free the raw points before the outlier removal
+                del raw_cloud
+                if keys:
+                    background.write(
+                        cache.cache_dir / keys["removal"],
+                        partial(cache.store_cloud, keys["removal"], cloud),
+                    )
+
+            if use_outliers:
+                if self.configs["VERBOSE"]:
+                    self.plane_remover.display_pointcloud(cloud)
+                self.out_remover.run_on_cloud(filename, cloud)
+                if keys:
+                    # Queued after the final point cloud, which is copied
+                    background.write(
+                        cache.cache_dir / keys["outliers"],
+                        partial(cache.store_file, keys["outliers"], out_dir / out_name),
+                    )
+            else:
+                self.plane_remover.display_pointcloud(cloud)
+        except Exception as exc:
+            print(exc)
+            raise
+
+    def process_file_tiled(self, file: Any):
+        """Run plane detection, plane removal and outlier removal tile by tile on a
+        single point cloud, which does not need to fit into memory
+
+        Args:
+            file (Any): file in raw directory
+        """
+        tile_dir = None
+        try:
+            filename = os.fsdecode(file)
+            if not filename.endswith(
+                tuple([enum.name.lower() for enum in self.pc_formats])
+            ):
+                return
+
+            params = self.configs["TILING"]
+            file_path = self.dataloader.dir_path / filename
+            tile_dir = setup.TILES_DIR / filename
+
+            cache = self.dataloader.cache
+            reader = cache.iter_chunks if cache else iter_chunks
+
+            # Two streaming passes: bounds of the cloud, then spilling into tiles
+            with metrics.stage("spill") as record:
+                min_bound, max_bound, has_colors, file_points = stream_bounds(
+                    file_path, params["CHUNK_SIZE"], reader
+                )
+                grid = TileGrid(
+                    min_bound, max_bound, params["TILE_SIZE"], params["OVERLAP"]
+                )
+                tile_paths = spill_tiles(
+                    file_path, grid, tile_dir, params["CHUNK_SIZE"], reader
+                )
+                record["tiles"] = len(tile_paths)
+            print(f"Split '{filename}' into {len(tile_paths)} tile(s)")
+
+            # The runner is installed once per worker instead of pickled per task
+            with Pool(
+                params["WORKERS"], initializer=_init_tile_worker, initargs=(self,)
+            ) as pool:
+                with metrics.stage("tile_detection") as record:
+                    tile_planes, total_points = [], 0
+                    for planes, points, records in pool.starmap(
+                        _detect_tile, [(path, file_points) for path in tile_paths]
+                    ):
+                        tile_planes += planes
+                        total_points += points
+                        metrics.extend(records)
+                    plane_eqs, inliers = merge_planes(
+                        tile_planes,
+                        params["MERGE_ANGLE"],
+                        params["MERGE_DIST"],
+                    )
+                    record["planes"] = len(plane_eqs)
+                print(f"Identified {len(plane_eqs)} plane(s) in '{filename}'")
+                # The tiles store nothing, the merged planes are stored once
+                self.plane_detector.store_planes(
+                    filename, plane_eqs, inliers, total_points
+                )
+
+                if not self.configs["PLANE_REMOVAL"]["USE"]:
+                    return
+
+                with metrics.stage("tile_cleaning", planes=len(plane_eqs)):
+                    part_paths = []
+                    for part_path, records in pool.starmap(
+                        _clean_tile, [(path, plane_eqs) for path in tile_paths]
+                    ):
+                        part_paths.append(part_path)
+                        metrics.extend(records)
+
+            # Concatenate the core points of all tiles into the output file
+            if self.configs["OUT_REMOVAL"]["USE"]:
+                strategy = self.out_remover.strategy
+                out_dir, writer = strategy.out_dir, strategy.writer
+            else:
+                out_dir, writer = self.plane_remover.out_dir, self.plane_remover.writer
+            with metrics.stage("save") as record:
+                with writer.stream(out_dir / writer.name(filename), has_colors) as out:
+                    for part_path in part_paths:
+                        records = load_tile(part_path)
+                        out.write(records["xyz"], records["rgb"])
+                record["points_out"] = out.count
+            print(f"Wrote {out.count} points of '{filename}' to {out.path}")
+        except Exception as exc:
+            print(exc)
+            raise
+        finally:
+            if tile_dir is not None:
+                shutil.rmtree(tile_dir, ignore_errors=True)
+
+    def _detect_tile(
+        self, tile_path: Path, file_points: int
+    ) -> Tuple[List[Tuple[List[float], int]], int, List[metrics.Record]]:
+        """Detect planes in a single tile. PLANE_SIZE refers to the whole point
+        cloud at the size of a large point cloud, it is scaled by the share of the
+        tile, so the pieces of planes, which cross tiles, are still found.
+
+        Args:
+            tile_path (Path): spill file of the tile
+            file_points (int): number of points of the whole point cloud
+
+        Returns:
+            Tuple[List[Tuple[List[float], int]], int, List[metrics.Record]]: plane
+            equations with their inlier counts, the number of points, in which
+            they were detected, and the metrics records of the tile
+        """
+        records = load_tile(tile_path)
+        cloud = o3d.geometry.PointCloud()
+        cloud.points = o3d.utility.Vector3dVector(records["xyz"])
+
+        large_pc = self.dataloader.large_pc
+        plane_size = self.plane_detector.plane_size * min(len(records), large_pc)
+        plane_size = max(3, int(plane_size / max(min(file_points, large_pc), 1)))
+
+        indices = None
+        if not self.plane_detector.full_resolution:
+            cloud, indices = self.dataloader.downsample_data(cloud, tile_path.name)
+        self.plane_detector.detect_planes_in_cloud(
+            tile_path.name, cloud, indices, plane_size
+        )
+
+        eqs, inliers, points = self.plane_detector.detected_planes()
+        return list(zip(eqs, inliers)), points, metrics.drain()
+
+    def _clean_tile(
+        self, tile_path: Path, plane_eqs: List[List[float]]
+    ) -> Tuple[Path, List[metrics.Record]]:
+        """Remove the global planes and outliers from a single tile and keep its
+        core points
+
+        Args:
+            tile_path (Path): spill file of the tile
+            plane_eqs (List[List[float]]): global plane equations
+
+        Returns:
+            Tuple[Path, List[metrics.Record]]: file with the remaining core points
+            of the tile and the metrics records of the tile
+        """
+        records = load_tile(tile_path)
+        with metrics.stage("clean_tile", points_in=len(records)) as record:
+            keep, _ = assign_to_planes(
+                records["xyz"],
+                plane_eqs,
+                self.plane_remover.thresh,
+                self.plane_remover.chunk_size,
+            )
+            records = records[keep]
+
+            # The overlap gives points at the tile border their full neighbourhood
+            if self.configs["OUT_REMOVAL"]["USE"] and len(records):
+                cloud = o3d.geometry.PointCloud()
+                cloud.points = o3d.utility.Vector3dVector(records["xyz"])
+                _, ind = self.out_remover.strategy.filter_outliers(cloud)
+                inliers = np.zeros(len(records), dtype=bool)
+                inliers[np.asarray(ind, dtype=np.int64)] = True
+                records = records[inliers]
+
+            part_path = tile_path.with_suffix(".part")
+            records = records[records["core"]]
+            records.tofile(part_path)
+            record["points_out"] = len(records)
+        return part_path, metrics.drain()
+
+
+# Runner of the tile workers, installed once per worker by _init_tile_worker
+_TILE_RUNNER: Optional[Runner] = None
+
+
+def _init_tile_worker(runner: Runner) -> None:
+    """Install the runner in a tile worker. Forked workers inherit the records
+    of the parent, which it already keeps, so they are dropped.
+
+    Args:
+        runner (Runner): runner of the tiled pipeline
+    """
+    global _TILE_RUNNER
+    _TILE_RUNNER = runner
+    metrics.drain()
+
+
+def _detect_tile(
+    tile_path: Path, file_points: int
+) -> Tuple[List[Tuple[List[float], int]], int, List[metrics.Record]]:
+    """Detect planes in a single tile with the runner of the worker
+
+    Args:
+        tile_path (Path): spill file of the tile
+        file_points (int): number of points of the whole point cloud
+
+    Returns:
+        Tuple[List[Tuple[List[float], int]], int, List[metrics.Record]]: see
+        Runner._detect_tile
+    """
+    return _TILE_RUNNER._detect_tile(tile_path, file_points)
+
+
+def _clean_tile(
+    tile_path: Path, plane_eqs: List[List[float]]
+) -> Tuple[Path, List[metrics.Record]]:
+    """Clean a single tile with the runner of the worker
+
+    Args:
+        tile_path (Path): spill file of the tile
+        plane_eqs (List[List[float]]): global plane equations
+
+    Returns:
+        Tuple[Path, List[metrics.Record]]: see Runner._clean_tile
+    """
+    return _TILE_RUNNER._clean_tile(tile_path, plane_eqs)
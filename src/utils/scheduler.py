@@ -0,0 +1,700 @@
+"""Size-aware scheduling of per-file jobs on a process pool"""
+import bisect
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from . import background, metrics
+
+# Share of the physical memory, which all running files use by default
+MEMORY_SHARE = 0.8
+
+# Seconds between two checks of a timed out job, whose worker is not known yet
+TIMEOUT_POLL = 0.05
+
+# Job sent to a worker: function, file, attempt, prefetch function and the files
+# to prefetch
+Task = Tuple[Callable, str, int, Optional[Callable], List[str]]
+
+# Result of a job: file, attempt, error message or None, elapsed seconds and the
+# metrics records of the job
+Outcome = Tuple[str, int, Optional[str], float, List[metrics.Record]]
+
+# Submitted job: pool, file, attempt and submission time
+Submitted = Tuple["_WorkerPool", str, int, float]
+
+# Queue, on which the workers announce the jobs they start, set by the initializer
+_started: Any = None
+
+
+class JobScheduler:
+    """
+    Runs one job per file on a process pool. Jobs start largest-first, so a huge
+    file does not end up at the tail of the run, and are only admitted while the
+    estimated memory of all running jobs fits into the memory budget. Failed or
+    timed out jobs are retried and reported at the end of the run. Every job
+    prefetches the next jobs in the background and writes its files on a
+    background thread, which overlaps the writes with its later stages. A job
+    only finishes, once its writes are done. A service keeps the pool warm
+    instead and runs the files, which are submitted while it serves.
+
+    Timeouts are enforced by the parent, which kills the worker of a job, so
+    native code like Open3D or BLAS cannot block it. A killed or crashed worker,
+    e.g. by the OOM killer, breaks the pool. Its running jobs fail and retry
+    alone, as any of them may be the cause, the jobs, which were only killed
+    along with a timed out job, are queued again, and the next jobs start on a
+    new pool. Finished jobs are not affected, their writes are done.
+    """
+
+    def __init__(self, sched_params: Dict[str, Any]):
+
+        self.workers = sched_params.get("WORKERS") or os.cpu_count() or 1
+        memory_mb = sched_params.get("MEMORY_MB")
+        if memory_mb is None:
+            memory_mb = default_memory_mb()
+        self.memory_budget = memory_mb * 2**20 if memory_mb else None
+        self.memory_factor = sched_params.get("MEMORY_FACTOR", 6.0)
+        worker_mb = sched_params.get("WORKER_MEMORY_MB")
+        if worker_mb is None:
+            worker_mb = memory_mb
+        self.worker_limit = int(worker_mb * 2**20) if worker_mb else None
+        self.timeout = sched_params.get("TIMEOUT")
+        self.retries = sched_params.get("RETRIES", 0)
+        # Prefetched files per job and queued writes per worker, 0 to disable
+        self.prefetch = sched_params.get("PREFETCH", 0)
+        self.write_queue = sched_params.get("WRITE_QUEUE", 0)
+
+        self._cond = threading.Condition()
+        # Pending jobs as (size, file), sorted by ascending size
+        self._pending: List[Tuple[int, str]] = []
+        self._attempts: Dict[str, int] = {}
+        self._sizes: Dict[str, int] = {}
+        self._hinted: Set[str] = set()
+        # Time, when each pending file was queued
+        self._queued: Dict[str, float] = {}
+        self._running = 0
+        self._reserved = 0.0
+        # Files, which ran on a pool, whose worker died, and whether one of them
+        # runs alone, so its retry cannot take other jobs down with it
+        self._isolated: Set[str] = set()
+        self._alone = False
+        # Keeps the pool waiting for submitted files, while it is idle
+        self._serving = False
+
+    def run(
+        self,
+        function: Callable,
+        files: List[Any],
+        dir_path: Path,
+        prefetch: Optional[Callable] = None,
+    ) -> List[str]:
+        """Run a function on every file and stream the results as they finish
+
+        Args:
+            function (Callable): picklable function, called with a single file
+            files (List[Any]): files in the directory
+            dir_path (Path): directory of the files, used to size the jobs
+            prefetch (Optional[Callable], optional): picklable function, which
+                loads a file ahead of its job. Defaults to None.
+
+        Returns:
+            List[str]: files, whose jobs failed in every attempt
+        """
+        files = [os.fsdecode(file) for file in files]
+        with self._cond:
+            self._sizes = {file: self._file_size(dir_path / file) for file in files}
+            self._pending = sorted((size, file) for file, size in self._sizes.items())
+            self._attempts = {file: 0 for file in files}
+            self._queued = dict.fromkeys(files, time())
+            self._hinted = set()
+            self._running = 0
+            self._reserved = 0.0
+            self._isolated = set()
+            self._alone = False
+
+        failed: Dict[str, str] = {}
+        pool = self._drive(function, prefetch, self.write_queue, failed)
+        if pool is not None:
+            pool.shutdown()
+
+        if failed:
+            print(f"{len(failed)} of {len(files)} job(s) failed:")
+            for file, error in failed.items():
+                print(f"  {file}: {error}")
+        return list(failed)
+
+    def serve(
+        self,
+        function: Callable,
+        prefetch: Optional[Callable] = None,
+        on_finish: Optional[Callable[[str, Optional[str], float], None]] = None,
+    ) -> None:
+        """Run the submitted files on a persistent pool until the service is
+        stopped. The outputs of a file exist, when its job finishes.
+
+        Args:
+            function (Callable): picklable function, called with a single file
+            prefetch (Optional[Callable], optional): picklable function, which
+                loads a file ahead of its job. Defaults to None.
+            on_finish (Optional[Callable[[str, Optional[str], float], None]],
+                optional): called with the file, the error message or None and
+                the elapsed seconds of every job, which is not retried. Defaults
+                to None.
+        """
+        with self._cond:
+            self._hinted = set()
+            self._running = 0
+            self._reserved = 0.0
+            self._isolated = set()
+            self._alone = False
+            self._serving = True
+
+        try:
+            pool = self._drive(function, prefetch, self.write_queue, {}, on_finish)
+        finally:
+            with self._cond:
+                self._serving = False
+        if pool is not None:
+            pool.shutdown()
+
+    def submit(self, file: str, dir_path: Path) -> None:
+        """Queue a file of a running service. A file must not be submitted again,
+        before its job finished.
+
+        Args:
+            file (str): file in the directory
+            dir_path (Path): directory of the file, used to size the job
+        """
+        size = self._file_size(dir_path / file)
+        with self._cond:
+            self._sizes[file] = size
+            self._attempts[file] = 0
+            self._queued[file] = time()
+            bisect.insort(self._pending, (size, file))
+            self._cond.notify_all()
+
+    def stop(self) -> None:
+        """Let a service finish its queued and running jobs and return"""
+        with self._cond:
+            self._serving = False
+            self._cond.notify_all()
+
+    def depth(self) -> Tuple[int, int]:
+        """Queue depth of a service
+
+        Returns:
+            Tuple[int, int]: number of pending and running jobs
+        """
+        with self._cond:
+            return len(self._pending), self._running
+
+    def _drive(
+        self,
+        function: Callable,
+        prefetch: Optional[Callable],
+        write_queue: int,
+        failed: Dict[str, str],
+        on_finish: Optional[Callable[[str, Optional[str], float], None]] = None,
+    ) -> Optional["_WorkerPool"]:
+        """Submit the admitted jobs, collect their outcomes and kill the workers
+        of timed out jobs, until no job is pending or running and the scheduler
+        does not serve
+
+        Args:
+            function (Callable): function of the jobs
+            prefetch (Optional[Callable]): prefetch function of the jobs
+            write_queue (int): queued writes per worker, 0 for synchronous writes
+            failed (Dict[str, str]): error messages of finally failed jobs
+            on_finish (Optional[Callable[[str, Optional[str], float], None]],
+                optional): called for every job, which is not retried. Defaults
+                to None.
+
+        Returns:
+            Optional[_WorkerPool]: pool of the last jobs, which the caller shuts
+            down, None if no job ran
+        """
+        pool: Optional[_WorkerPool] = None
+        # Submitted jobs: future, pool, file, attempt and submission time
+        running: Dict[Future, Submitted] = {}
+        try:
+            while True:
+                with self._cond:
+                    jobs = self._admit(prefetch is not None)
+                    if not (jobs or running or self._pending or self._serving):
+                        break
+
+                if jobs and (pool is None or pool.broken):
+                    if pool is not None:
+                        pool.shutdown()
+                    pool = _WorkerPool(
+                        self.workers,
+                        self.worker_limit,
+                        write_queue,
+                        self.prefetch and prefetch is not None,
+                    )
+                for file, attempt, upcoming in jobs:
+                    future = pool.submit(function, file, attempt, prefetch, upcoming)
+                    running[future] = (pool, file, attempt, time())
+                    future.add_done_callback(self._wake)
+
+                for future in [future for future in running if future.done()]:
+                    job_pool, file, attempt, submitted = running.pop(future)
+                    outcome = self._outcome(future, job_pool, file, attempt, submitted)
+                    if outcome is None:
+                        continue
+                    self._collect(file, outcome[4])
+                    error, elapsed = outcome[2], outcome[3]
+                    retried = self._finish(file, attempt, error, elapsed, failed)
+                    if on_finish is not None and not retried:
+                        on_finish(file, failed.pop(file, None), elapsed)
+
+                deadline = self._kill_timed_out(running)
+                with self._cond:
+                    if (
+                        self._next_job() is None
+                        and (running or self._serving)
+                        and not any(future.done() for future in running)
+                    ):
+                        self._cond.wait(deadline)
+        except BaseException:
+            if pool is not None:
+                pool.shutdown()
+            raise
+        return pool
+
+    def _outcome(
+        self,
+        future: Future,
+        pool: "_WorkerPool",
+        file: str,
+        attempt: int,
+        submitted: float,
+    ) -> Optional[Outcome]:
+        """Outcome of a finished future. Jobs, which only died with a killed
+        worker of another job, are queued again.
+
+        Args:
+            future (Future): finished future of the job
+            pool (_WorkerPool): pool of the job
+            file (str): file of the job
+            attempt (int): attempt of the job
+            submitted (float): time, when the job was submitted
+
+        Returns:
+            Optional[Outcome]: outcome of the job, None if it is queued again
+        """
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            pass
+        except Exception as exc:
+            # The job or its outcome could not be pickled
+            error = f"{type(exc).__name__}: {exc}"
+            return file, attempt, error, time() - submitted, []
+
+        pool.broken = True
+        if (file, attempt) in pool.killed:
+            error = "TimeoutError: The job exceeded its time limit!"
+        elif pool.killed:
+            self._requeue(file)
+            return None
+        else:
+            error = "BrokenProcessPool: A worker died, e.g. by the OOM killer!"
+            # Any of the running jobs may have killed the worker
+            with self._cond:
+                self._isolated.add(file)
+
+        # The records of the job died with its worker
+        record: metrics.Record = {"file": file, "stage": "job", "attempt": attempt}
+        record["pid"] = pool.pid(file, attempt) or os.getpid()
+        record["start"] = submitted
+        record["wall_s"] = time() - submitted
+        record["error"] = error
+        return file, attempt, error, record["wall_s"], [record]
+
+    def _kill_timed_out(self, running: Dict[Future, Submitted]) -> Optional[float]:
+        """Kill the workers of the running jobs, which exceeded the timeout
+
+        Args:
+            running (Dict[Future, Submitted]): running jobs
+
+        Returns:
+            Optional[float]: seconds until the next timeout, None for none
+        """
+        if not self.timeout:
+            return None
+
+        deadline = None
+        now = time()
+        for future, (pool, file, attempt, submitted) in running.items():
+            if future.done() or (file, attempt) in pool.killed:
+                continue
+            remaining = submitted + self.timeout - now
+            # The worker may not have announced the job yet
+            if remaining <= 0 and not pool.kill(file, attempt):
+                remaining = TIMEOUT_POLL
+            if remaining > 0:
+                deadline = remaining if deadline is None else min(deadline, remaining)
+        return deadline
+
+    def _wake(self, _: Future) -> None:
+        """Wake up the scheduling loop, when a job finished"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _admit(self, prefetch: bool) -> List[Tuple[str, int, List[str]]]:
+        """Admit the pending jobs, which can start now, while a worker and enough
+        memory are available. The caller holds the lock.
+
+        Args:
+            prefetch (bool): choose the files, which the jobs prefetch
+
+        Returns:
+            List[Tuple[str, int, List[str]]]: file, attempt and the files to
+            prefetch of every admitted job
+        """
+        jobs = []
+        while True:
+            index = self._next_job()
+            if index is None:
+                return jobs
+
+            size, file = self._pending.pop(index)
+            self._running += 1
+            self._reserved += self._estimate(size)
+            self._attempts[file] += 1
+            self._alone = file in self._isolated
+            upcoming = self._upcoming() if prefetch else []
+            jobs.append((file, self._attempts[file], upcoming))
+
+    def _upcoming(self) -> List[str]:
+        """Largest pending files, which no earlier job prefetches yet
+
+        Returns:
+            List[str]: files to prefetch
+        """
+        upcoming = []
+        for _, file in reversed(self._pending):
+            if len(upcoming) >= self.prefetch:
+                break
+            if file not in self._hinted:
+                self._hinted.add(file)
+                upcoming.append(file)
+        return upcoming
+
+    def _next_job(self) -> Optional[int]:
+        """Largest pending job, which can start now
+
+        Returns:
+            Optional[int]: index into the pending jobs or None, if none can start
+        """
+        if not self._pending or self._running >= self.workers or self._alone:
+            return None
+        if not self._running:
+            # A job larger than the budget or an isolated job runs alone
+            return len(self._pending) - 1
+
+        # Smaller jobs fill up the remaining budget
+        limit = float("inf")
+        if self.memory_budget is not None:
+            limit = (self.memory_budget - self._reserved) / self.memory_factor
+        for index in range(len(self._pending) - 1, -1, -1):
+            size, file = self._pending[index]
+            if size <= limit and file not in self._isolated:
+                return index
+        return None
+
+    def _finish(
+        self,
+        file: str,
+        attempt: int,
+        error: Optional[str],
+        elapsed: float,
+        failed: Dict[str, str],
+    ) -> bool:
+        """Release the resources of a finished job and retry it, if it failed
+
+        Args:
+            file (str): file of the job
+            attempt (int): attempt of the job, starting at 1
+            error (Optional[str]): error message, None on success
+            elapsed (float): elapsed seconds of the job
+            failed (Dict[str, str]): error messages of finally failed jobs
+
+        Returns:
+            bool: True, if the job is retried
+        """
+        with self._cond:
+            size = self._sizes[file]
+            self._running -= 1
+            self._reserved -= self._estimate(size)
+            self._alone = self._alone and file not in self._isolated
+            self._cond.notify_all()
+
+            if error is not None and attempt <= self.retries:
+                print(f"Attempt {attempt} of '{file}' failed ({error}), retrying...")
+                self._queued[file] = time()
+                bisect.insort(self._pending, (size, file))
+                return True
+
+            if error is None:
+                print(f"Finished '{file}' in {elapsed:.2f} seconds")
+            else:
+                failed[file] = error
+            self._isolated.discard(file)
+            # A service sees an unbounded number of files
+            if self._serving:
+                del self._sizes[file], self._attempts[file], self._queued[file]
+                self._hinted.discard(file)
+            return False
+
+    def _requeue(self, file: str) -> None:
+        """Queue a job again without counting its attempt, e.g. after its worker
+        was killed together with the worker of another job
+
+        Args:
+            file (str): file of the job
+        """
+        with self._cond:
+            size = self._sizes[file]
+            self._running -= 1
+            self._reserved -= self._estimate(size)
+            self._alone = self._alone and file not in self._isolated
+            self._attempts[file] -= 1
+            self._queued[file] = time()
+            bisect.insort(self._pending, (size, file))
+            self._cond.notify_all()
+
+    def _collect(self, file: str, records: List[metrics.Record]) -> None:
+        """Keep the records of a job, its job record gets the time, when the file
+        was queued, so a trace shows how long it waited for a worker
+
+        Args:
+            file (str): file of the job
+            records (List[metrics.Record]): records of the job
+        """
+        with self._cond:
+            queued = self._queued.get(file)
+        for record in records:
+            if record["stage"] == "job" and queued is not None:
+                record["queued"] = queued
+        metrics.extend(records)
+
+    def _estimate(self, size: int) -> float:
+        """Estimated peak memory of a job
+
+        Args:
+            size (int): file size in bytes
+
+        Returns:
+            float: memory in bytes
+        """
+        return size * self.memory_factor
+
+    @staticmethod
+    def _file_size(path: Path) -> int:
+        """Size of a file, 0 if it does not exist
+
+        Args:
+            path (Path): path to the file
+
+        Returns:
+            int: size in bytes
+        """
+        try:
+            return path.stat().st_size
+        except OSError:
+            return 0
+
+
+class _WorkerPool:
+    """
+    Process pool of the jobs of a scheduler together with the workers, which run
+    them. The workers announce every job they start, so a timed out job kills
+    its own worker. A pool, whose worker died, is broken and replaced.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        worker_limit: Optional[int],
+        write_queue: int,
+        prefetch: bool,
+    ):
+
+        context = multiprocessing.get_context()
+        self.broken = False
+        # Jobs, whose workers were killed
+        self.killed: Set[Tuple[str, int]] = set()
+        self._started = context.SimpleQueue()
+        self._pids: Dict[Tuple[str, int], int] = {}
+        self.executor = ProcessPoolExecutor(
+            workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(
+                worker_limit,
+                write_queue,
+                prefetch,
+                self._started,
+                metrics.profiled_stages(),
+            ),
+        )
+
+    def submit(
+        self,
+        function: Callable,
+        file: str,
+        attempt: int,
+        prefetch: Optional[Callable],
+        upcoming: List[str],
+    ) -> Future:
+        """Submit a job, a broken pool fails it right away
+
+        Args:
+            function (Callable): function of the job
+            file (str): file of the job
+            attempt (int): attempt of the job
+            prefetch (Optional[Callable]): prefetch function of the job
+            upcoming (List[str]): files, which the job prefetches
+
+        Returns:
+            Future: future of the outcome of the job
+        """
+        try:
+            task = (function, file, attempt, prefetch, upcoming)
+            return self.executor.submit(_run_job, task)
+        except BrokenProcessPool as exc:
+            future: Future = Future()
+            future.set_exception(exc)
+            return future
+
+    def pid(self, file: str, attempt: int) -> Optional[int]:
+        """Worker of a job
+
+        Args:
+            file (str): file of the job
+            attempt (int): attempt of the job
+
+        Returns:
+            Optional[int]: process id, None if the job did not start yet
+        """
+        while not self._started.empty():
+            started_file, started_attempt, pid = self._started.get()
+            self._pids[(started_file, started_attempt)] = pid
+        return self._pids.get((file, attempt))
+
+    def kill(self, file: str, attempt: int) -> bool:
+        """Kill the worker of a job, which breaks the pool
+
+        Args:
+            file (str): file of the job
+            attempt (int): attempt of the job
+
+        Returns:
+            bool: True, if the worker was killed
+        """
+        pid = self.pid(file, attempt)
+        if pid is None:
+            return False
+        print(f"'{file}' exceeded its time limit, killing its worker...")
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.killed.add((file, attempt))
+        return True
+
+    def shutdown(self) -> None:
+        """Wait for the running jobs and stop the workers"""
+        self.executor.shutdown()
+
+
+def default_memory_mb() -> Optional[int]:
+    """Default memory budget of all running files
+
+    Returns:
+        Optional[int]: share of the physical memory in MB, None if it is unknown
+    """
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return int(total * MEMORY_SHARE) // 2**20
+
+
+def _init_worker(
+    worker_limit: Optional[int],
+    write_queue: int,
+    prefetch: bool,
+    started: Any = None,
+    profile: Tuple[Set[str], Optional[Path]] = (set(), None),
+) -> None:
+    """Start the background threads of a worker process and limit its memory, a
+    job exceeding it raises a MemoryError instead of invoking the OOM killer
+
+    Args:
+        worker_limit (Optional[int]): memory limit in bytes, None for no limit
+        write_queue (int): queued writes, 0 for synchronous writes
+        prefetch (bool): prefetch the upcoming files of every job
+        started (Any, optional): queue, on which every job is announced with
+            its worker. Defaults to None.
+        profile (Tuple[Set[str], Optional[Path]], optional): stages, which are
+            profiled with cProfile, and the directory of their dumps. Defaults
+            to no profiling.
+    """
+    global _started
+    _started = started
+    # Forked workers inherit the records of the parent, which it already keeps
+    metrics.drain()
+    metrics.profile_stages(*profile)
+    background.start(write_queue, 1 if prefetch else 0)
+    if worker_limit is None:
+        return
+    try:
+        import resource
+
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        resource.setrlimit(resource.RLIMIT_DATA, (worker_limit, hard))
+    except (ImportError, ValueError, OSError) as exc:
+        print(exc)
+
+
+def _run_job(task: Task) -> Outcome:
+    """Run a single job in a worker process, its queued writes are done, when it
+    returns, so a worker, which is killed later, cannot lose them
+
+    Args:
+        task (Task): function, file, attempt, prefetch function and the files to
+            prefetch
+
+    Returns:
+        Outcome: file, attempt, error message or None, elapsed seconds and the
+        metrics records of the job
+    """
+    function, file, attempt, prefetch, upcoming = task
+    if _started is not None:
+        _started.put((file, attempt, os.getpid()))
+    for upcoming_file in upcoming:
+        background.prefetch(partial(prefetch, upcoming_file))
+
+    start = perf_counter()
+    error = None
+    with metrics.track_file(file), metrics.stage("job", attempt=attempt) as record:
+        try:
+            function(file)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+        for path, write_error in background.flush():
+            error = error or f"Writing '{path}' failed: {write_error}"
+        record["error"] = error
+
+    metrics.dump_profiles()
+    return file, attempt, error, perf_counter() - start, metrics.drain()
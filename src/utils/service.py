@@ -0,0 +1,242 @@
+"""Long-running service, which processes raw files as they land"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from . import metrics
+from .scheduler import JobScheduler
+
+# Failed files, which the status reports
+LAST_ERRORS = 20
+
+
+class WatchService:
+    """
+    Watches the raw directory and runs every new or changed file on the warm
+    pool of a scheduler, so interpreter start, imports and pool creation are
+    paid once instead of per batch. A file is submitted, once its size and
+    modification time are unchanged for one poll, so files, which are still
+    being copied, are skipped. Hidden files are ignored, as they are the
+    temporary files of atomic copies.
+
+    An HTTP endpoint on localhost reports the queue depth and the latencies of
+    the last jobs at GET /status and queues a file of the raw directory again at
+    POST /jobs with the body {"file": "<name>"}.
+    """
+
+    def __init__(
+        self,
+        scheduler: JobScheduler,
+        function: Callable,
+        dir_path: Path,
+        service_params: Dict[str, Any],
+        suffixes: Tuple[str, ...],
+        prefetch: Optional[Callable] = None,
+        metrics_path: Optional[Path] = None,
+    ):
+
+        self.scheduler = scheduler
+        self.function = function
+        self.dir_path = dir_path
+        self.poll = service_params.get("POLL", 1.0)
+        self.port = service_params.get("PORT")
+        self.suffixes = suffixes
+        self.prefetch = prefetch
+        # Records of the finished jobs are appended, None to discard them
+        self.metrics_path = metrics_path
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = time.time()
+        # (modification time, size) per file at the last poll and at submission
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        self._submitted: Dict[str, Tuple[int, int]] = {}
+        # Submission time of every queued or running file
+        self._queued: Dict[str, float] = {}
+        # Queue, job and total seconds of the last finished jobs
+        self._latencies: Deque[Tuple[float, float, float]] = deque(
+            maxlen=service_params.get("WINDOW", 1000)
+        )
+        self._errors: Deque[Tuple[str, str]] = deque(maxlen=LAST_ERRORS)
+        self._processed = 0
+        self._failed = 0
+
+    def run(self) -> None:
+        """Serve until the process is interrupted"""
+        watcher = threading.Thread(target=self._watch, daemon=True)
+        watcher.start()
+
+        server = None
+        if self.port is not None:
+            server = ThreadingHTTPServer(("127.0.0.1", self.port), _Handler)
+            server.service = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print(f"Status on http://127.0.0.1:{server.server_port}/status")
+
+        print(f"Watching '{self.dir_path}' for new point clouds...")
+        try:
+            self.scheduler.serve(self.function, self.prefetch, self._finished)
+        except KeyboardInterrupt:
+            print("Stopping the service...")
+        finally:
+            self._stop.set()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    def submit(self, filename: str) -> bool:
+        """Queue a file of the raw directory, unless it is queued or running
+
+        Args:
+            filename (str): name of the raw point cloud file
+
+        Returns:
+            bool: True, if the file was queued
+        """
+        try:
+            stat = (self.dir_path / filename).stat()
+        except OSError:
+            return False
+
+        with self._lock:
+            if filename in self._queued:
+                return False
+            self._queued[filename] = time.time()
+            self._submitted[filename] = (stat.st_mtime_ns, stat.st_size)
+        self.scheduler.submit(filename, self.dir_path)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        """Queue depth, counts and latency percentiles of the service
+
+        Returns:
+            Dict[str, Any]: JSON-serializable status
+        """
+        pending, running = self.scheduler.depth()
+        with self._lock:
+            latencies = np.array(self._latencies, dtype=np.float64).reshape(-1, 3)
+            status = {
+                "pending": pending,
+                "running": running,
+                "processed": self._processed,
+                "failed": self._failed,
+                "uptime_s": time.time() - self._started,
+                "errors": [
+                    {"file": file, "error": error} for file, error in self._errors
+                ],
+            }
+
+        for column, name in enumerate(("queue_s", "job_s", "latency_s")):
+            values = latencies[:, column]
+            status[name] = {
+                "p50": float(np.percentile(values, 50)) if len(values) else None,
+                "p95": float(np.percentile(values, 95)) if len(values) else None,
+                "max": float(values.max()) if len(values) else None,
+            }
+        return status
+
+    def _watch(self) -> None:
+        """Poll the raw directory and submit the files, which settled since the
+        last poll"""
+        while not self._stop.is_set():
+            current = {}
+            try:
+                with os.scandir(self.dir_path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or not entry.is_file():
+                            continue
+                        if not entry.name.endswith(self.suffixes):
+                            continue
+                        stat = entry.stat()
+                        current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+            except OSError as exc:
+                print(exc)
+
+            for filename, state in current.items():
+                settled = self._seen.get(filename) == state
+                if settled and self._submitted.get(filename) != state:
+                    self.submit(filename)
+            self._seen = current
+            self._stop.wait(self.poll)
+
+    def _finished(self, filename: str, error: Optional[str], elapsed: float) -> None:
+        """Record the latency of a finished job, runs on the serving thread
+
+        Args:
+            filename (str): name of the raw point cloud file
+            error (Optional[str]): error message, None on success
+            elapsed (float): seconds of the job in its worker
+        """
+        with self._lock:
+            total = time.time() - self._queued.pop(filename)
+            self._latencies.append((max(total - elapsed, 0.0), elapsed, total))
+            if error is None:
+                self._processed += 1
+            else:
+                self._failed += 1
+                self._errors.append((filename, error))
+                print(f"'{filename}' failed: {error}")
+
+        records = metrics.drain()
+        if self.metrics_path is not None:
+            metrics.write_jsonl(self.metrics_path, records)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Status and job endpoint of a WatchService, which is set on the server"""
+
+    def do_GET(self) -> None:
+        """Report the status of the service"""
+        if self.path.rstrip("/") != "/status":
+            self._reply(404, {"error": f"Unknown path '{self.path}'!"})
+            return
+        self._reply(200, self.server.service.status())
+
+    def do_POST(self) -> None:
+        """Queue a file of the raw directory"""
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": f"Unknown path '{self.path}'!"})
+            return
+
+        service = self.server.service
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            filename = json.loads(self.rfile.read(length))["file"]
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {"error": 'The body must be {"file": "<name>"}!'})
+            return
+
+        # Only plain names of point clouds in the raw directory
+        if (
+            not isinstance(filename, str)
+            or Path(filename).name != filename
+            or not filename.endswith(service.suffixes)
+            or not (service.dir_path / filename).is_file()
+        ):
+            self._reply(404, {"error": f"No point cloud '{filename}' to process!"})
+            return
+        self._reply(202, {"file": filename, "queued": service.submit(filename)})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Keep the requests out of the output of the pipeline"""
+
+    def _reply(self, code: int, body: Dict[str, Any]) -> None:
+        """Send a JSON response
+
+        Args:
+            code (int): HTTP status code
+            body (Dict[str, Any]): JSON-serializable body
+        """
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
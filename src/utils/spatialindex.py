@@ -0,0 +1,221 @@
+"""Voxel hash of a point cloud, which is shared by the stages of a file"""
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import open3d as o3d
+from open3d.cpu.pybind.geometry import PointCloud
+
+from .compactcloud import CompactCloud
+
+# Offsets of the 3x3x3 voxel neighbourhood, the voxel itself in the middle
+OFFSETS = np.array(
+    [(d_x, d_y, d_z) for d_x in (-1, 0, 1) for d_y in (-1, 0, 1) for d_z in (-1, 0, 1)]
+)
+
+
+def voxel_keys(
+    points: np.ndarray,
+    origin: np.ndarray,
+    voxel_size: float,
+    chunk_size: int = 2**18,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Flat voxel key of every point on a grid, which is padded by one voxel. The
+    keys are computed chunk by chunk, so the temporaries stay at the size of a
+    chunk instead of several times the size of the points.
+
+    Args:
+        points (np.ndarray): (N, 3) points
+        origin (np.ndarray): (3,) origin of the grid
+        voxel_size (float): edge length of the voxels
+        chunk_size (int, optional): points per chunk. Defaults to 2**18.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (N,) flat keys and the (3,) dimensions of
+        the padded grid
+    """
+    if not len(points):
+        return np.empty(0, dtype=np.int64), np.ones(3, dtype=np.int64)
+
+    # The largest key of every axis belongs to the largest coordinate
+    dims = np.floor((points.max(axis=0) - origin) / voxel_size).astype(np.int64) + 3
+    flat = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), chunk_size):
+        scaled = points[start : start + chunk_size] - origin
+        scaled /= voxel_size
+        keys = np.floor(scaled, out=scaled).astype(np.int64)
+        keys += 1
+        keys[:, 0] *= dims[1]
+        keys[:, 0] += keys[:, 1]
+        keys[:, 0] *= dims[2]
+        keys[:, 0] += keys[:, 2]
+        flat[start : start + chunk_size] = keys[:, 0]
+    return flat, dims
+
+
+class VoxelHashIndex:
+    """
+    Points sorted once by their voxel on a regular grid. The occupied voxels are
+    kept as sorted flat keys, so neighbouring voxels are found by binary search
+    and per-voxel reductions are contiguous slices of the sorted points. The grid
+    is padded by one voxel, so neighbour keys never leave it.
+    """
+
+    def __init__(
+        self,
+        points: np.ndarray,
+        voxel_size: float,
+        origin: Optional[np.ndarray] = None,
+    ):
+
+        self.voxel_size = voxel_size
+        self.origin = np.asarray(
+            points.min(axis=0) if origin is None else origin, dtype=np.float64
+        )
+        self.n_points = len(points)
+
+        flat, self.dims = voxel_keys(points, self.origin, voxel_size)
+
+        # Points of a voxel are a contiguous slice of the order, the keys are
+        # sorted in place and their buffer is reused, which saves two copies
+        self.order = np.argsort(flat, kind="stable")
+        flat.sort()
+        first = np.ones(len(flat), dtype=bool)
+        first[1:] = flat[1:] != flat[:-1]
+        self.starts = np.flatnonzero(first)
+        self.voxels = flat[self.starts]
+        self.counts = np.diff(np.append(self.starts, len(flat)))
+        # Voxel of every point
+        sorted_voxels = np.cumsum(first, out=flat)
+        sorted_voxels -= 1
+        self.inverse = np.empty(len(flat), dtype=np.int64)
+        self.inverse[self.order] = sorted_voxels
+
+    def __len__(self) -> int:
+        """Number of occupied voxels"""
+        return len(self.voxels)
+
+    def neighbours(self) -> np.ndarray:
+        """Occupied voxels in the 3x3x3 neighbourhood of every occupied voxel
+
+        Returns:
+            np.ndarray: (M, 27) voxel indices, -1 for empty voxels, the voxel
+            itself is in column 13
+        """
+        return np.stack([self._shifted(offset) for offset in OFFSETS], axis=1)
+
+    def neighbourhood_counts(self, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Number of points in the 3x3x3 voxels around the voxel of each point
+
+        Args:
+            mask (Optional[np.ndarray], optional): points to count. Defaults to
+            None, which counts all points.
+
+        Returns:
+            np.ndarray: (N,) neighbourhood counts, including the point itself
+        """
+        counts = self.counts
+        if mask is not None:
+            counts = np.bincount(self.inverse[mask], minlength=len(self.voxels))
+
+        # One offset at a time keeps the memory at O(M)
+        density = np.zeros(len(self.voxels), dtype=np.int64)
+        for offset in OFFSETS:
+            neighbour = self._shifted(offset)
+            occupied = neighbour >= 0
+            density[occupied] += counts[neighbour[occupied]]
+        return density[self.inverse]
+
+    def trace(self) -> np.ndarray:
+        """Largest point index inside every voxel, as Open3D traces voxels
+
+        Returns:
+            np.ndarray: (M,) point indices
+        """
+        if not len(self.voxels):
+            return np.empty(0, dtype=np.int64)
+        return np.maximum.reduceat(self.order, self.starts)
+
+    def mean(self, values: np.ndarray) -> np.ndarray:
+        """Mean of per-point values inside every voxel
+
+        Args:
+            values (np.ndarray): (N, D) values of the points
+
+        Returns:
+            np.ndarray: (M, D) mean per voxel
+        """
+        if not len(self.voxels):
+            return np.empty((0, values.shape[1]))
+        # Sums in float64 column by column, in the order of the points as Open3D,
+        # which neither overflows colors nor copies all values
+        sums = np.column_stack(
+            [
+                np.bincount(self.inverse, weights=values[:, dim], minlength=len(self))
+                for dim in range(values.shape[1])
+            ]
+        )
+        return sums / self.counts[:, None]
+
+    def downsample(
+        self, cloud: Union[PointCloud, CompactCloud]
+    ) -> Union[PointCloud, CompactCloud]:
+        """Voxel downsampling of the indexed point cloud, which averages the
+        points, colors and normals of every voxel as Open3D does. The i-th point
+        belongs to the i-th voxel of the index.
+
+        Args:
+            cloud (Union[PointCloud, CompactCloud]): indexed point cloud
+
+        Returns:
+            Union[PointCloud, CompactCloud]: one point per occupied voxel, of the
+            same type as the indexed point cloud
+        """
+        if isinstance(cloud, CompactCloud):
+            rgb = normals = None
+            if cloud.has_colors():
+                rgb = np.round(self.mean(cloud.rgb))
+            if cloud.has_normals():
+                normals = self._unit(self.mean(cloud.normals))
+            return CompactCloud(self.mean(cloud.points), rgb, normals)
+
+        pcd_down = o3d.geometry.PointCloud()
+        pcd_down.points = o3d.utility.Vector3dVector(
+            self.mean(np.asarray(cloud.points))
+        )
+        if cloud.has_colors():
+            pcd_down.colors = o3d.utility.Vector3dVector(
+                self.mean(np.asarray(cloud.colors))
+            )
+        if cloud.has_normals():
+            pcd_down.normals = o3d.utility.Vector3dVector(
+                self._unit(self.mean(np.asarray(cloud.normals)))
+            )
+        return pcd_down
+
+    def _shifted(self, offset: np.ndarray) -> np.ndarray:
+        """Occupied voxel at an offset from every occupied voxel
+
+        Args:
+            offset (np.ndarray): (3,) offset in voxels
+
+        Returns:
+            np.ndarray: (M,) voxel indices, -1 for empty voxels
+        """
+        keys = self.voxels + (offset[0] * self.dims[1] + offset[1]) * self.dims[2]
+        keys += offset[2]
+        pos = np.searchsorted(self.voxels, keys)
+        pos[pos == len(self.voxels)] = 0
+        return np.where(self.voxels[pos] == keys, pos, -1)
+
+    @staticmethod
+    def _unit(normals: np.ndarray) -> np.ndarray:
+        """Normalize averaged normals, zero normals stay zero
+
+        Args:
+            normals (np.ndarray): (M, 3) normals
+
+        Returns:
+            np.ndarray: (M, 3) unit normals
+        """
+        norms = np.linalg.norm(normals, axis=1, keepdims=True)
+        return normals / np.maximum(norms, np.finfo(np.float64).tiny)
@@ -0,0 +1,203 @@
+"""Deterministic synthetic room scans with known planes"""
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from .pointstream import PlyStreamWriter
+
+
+class SyntheticRoom:
+    """
+    Rectangular room with floor, walls, ceiling and tables as planes, spheres as
+    clutter objects and uniform outliers. The scene and every chunk of points are
+    derived from the seed, so the same parameters always give the same file.
+    """
+
+    def __init__(self, n_points: int, scene_params: Dict[str, Any]):
+
+        self.n_points = int(n_points)
+        self.n_planes = scene_params.get("PLANES", 8)
+        self.n_objects = scene_params.get("OBJECTS", 10)
+        self.noise = scene_params.get("NOISE", 0.005)
+        # Points per square meter on the planes, which overrides the room size
+        self.density = scene_params.get("DENSITY")
+        self.clutter = scene_params.get("CLUTTER", 0.1)
+        self.outliers = scene_params.get("OUTLIERS", 0.01)
+        self.height = scene_params.get("HEIGHT", 3.0)
+        self.seed = scene_params.get("SEED", 0)
+
+        if not self.n_objects:
+            self.clutter = 0.0
+        self.size = scene_params.get("SIZE", 8.0)
+        if self.density:
+            plane_points = self.n_points * (1 - self.clutter - self.outliers)
+            self.size = self._room_size(plane_points / self.density)
+        self.planes = self._planes(self.size)
+        self.spheres = self._spheres(self.size)
+
+        # Probability of every component: planes by area, spheres by surface
+        areas = np.array([np.linalg.norm(np.cross(u, v)) for _, u, v in self.planes])
+        surfaces = self.spheres[:, 3] ** 2
+        self.probs = np.concatenate(
+            [
+                (1 - self.clutter - self.outliers) * areas / max(areas.sum(), 1e-12),
+                self.clutter * surfaces / max(surfaces.sum(), 1e-12),
+                [self.outliers],
+            ]
+        )
+        self.probs /= self.probs.sum()
+
+    @property
+    def name(self) -> str:
+        """Filename, which encodes the parameters of the scene"""
+        return (
+            f"room_{self.n_points}_p{self.n_planes}_o{self.n_objects}"
+            f"_n{self.noise:g}_l{self.size:g}_c{self.clutter:g}"
+            f"_x{self.outliers:g}_s{self.seed}.ply"
+        )
+
+    def iter_chunks(
+        self, chunk_size: int = 2**20
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Generate the scan chunk by chunk
+
+        Args:
+            chunk_size (int, optional): points per chunk. Defaults to 2**20.
+
+        Yields:
+            Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]: (N, 3) points,
+            (N, 3) uint8 colors and the plane index per point, -1 for clutter and
+            outliers
+        """
+        n_planes = len(self.planes)
+        palette = np.random.default_rng(self.seed).integers(
+            40, 216, size=(len(self.probs), 3)
+        )
+        for index, start in enumerate(range(0, self.n_points, chunk_size)):
+            rng = np.random.default_rng([self.seed, index])
+            count = min(chunk_size, self.n_points - start)
+            component = rng.choice(len(self.probs), size=count, p=self.probs)
+
+            points = np.empty((count, 3))
+            labels = np.where(component < n_planes, component, -1).astype(np.int32)
+            for comp in np.unique(component):
+                mask = component == comp
+                points[mask] = self._sample(rng, comp, int(mask.sum()))
+
+            jitter = rng.integers(-15, 16, size=(count, 3))
+            colors = np.clip(palette[component] + jitter, 0, 255).astype(np.uint8)
+            yield points, colors, labels
+
+    def write(self, path: Path, chunk_size: int = 2**20) -> Path:
+        """Write the scan into a binary PLY file without holding it in memory
+
+        Args:
+            path (Path): path to the PLY file
+            chunk_size (int, optional): points per chunk. Defaults to 2**20.
+
+        Returns:
+            Path: path to the PLY file
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with PlyStreamWriter(path, with_colors=True) as writer:
+            for points, colors, _ in self.iter_chunks(chunk_size):
+                writer.write(points, colors)
+        return path
+
+    def _sample(
+        self, rng: np.random.Generator, component: int, count: int
+    ) -> np.ndarray:
+        """Sample points of a single component
+
+        Args:
+            rng (np.random.Generator): random number generator of the chunk
+            component (int): index of a plane, sphere or the outliers
+            count (int): number of points
+
+        Returns:
+            np.ndarray: (count, 3) points
+        """
+        n_planes = len(self.planes)
+        if component < n_planes:
+            origin, u, v = self.planes[component]
+            normal = np.cross(u, v)
+            normal /= np.linalg.norm(normal)
+            a, b = rng.random((2, count, 1))
+            offset = rng.normal(0.0, self.noise, size=(count, 1))
+            return origin + a * u + b * v + offset * normal
+
+        if component < n_planes + len(self.spheres):
+            center, radius = np.split(self.spheres[component - n_planes], [3])
+            directions = rng.normal(size=(count, 3))
+            directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+            radii = radius + rng.normal(0.0, self.noise, size=(count, 1))
+            return center + radii * directions
+
+        extent = np.array([self.size, self.size, self.height])
+        return rng.random((count, 3)) * extent
+
+    def _room_size(self, plane_area: float) -> float:
+        """Edge length of the square floor, whose planes have the given area
+
+        Args:
+            plane_area (float): total area of all planes
+
+        Returns:
+            float: edge length of the room
+        """
+        low, high = 1e-3, 1e5
+        for _ in range(100):
+            size = np.sqrt(low * high)
+            area = sum(np.linalg.norm(np.cross(u, v)) for _, u, v in self._planes(size))
+            if area < plane_area:
+                low = size
+            else:
+                high = size
+        return float(np.sqrt(low * high))
+
+    def _planes(self, size: float) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Rectangles of the room as origin and two edge vectors: floor, four walls,
+        ceiling and tables for all further planes
+
+        Args:
+            size (float): edge length of the room
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray, np.ndarray]]: rectangles
+        """
+        h = self.height
+        x, y, z = np.eye(3)
+        rooms = [
+            (np.zeros(3), size * x, size * y),
+            (np.zeros(3), size * x, h * z),
+            (np.zeros(3), h * z, size * y),
+            (size * x, size * y, h * z),
+            (size * y, h * z, size * x),
+            (h * z, size * y, size * x),
+        ]
+        planes = rooms[: self.n_planes]
+
+        rng = np.random.default_rng([self.seed, 2**31])
+        for _ in range(max(self.n_planes - len(rooms), 0)):
+            width, depth = size / 4, size / 6
+            corner = rng.uniform(0.05, 0.95, size=2) * (size - np.array([width, depth]))
+            origin = np.array([*corner, rng.uniform(0.7, 1.2)])
+            planes.append((origin, width * x, depth * y))
+        return planes
+
+    def _spheres(self, size: float) -> np.ndarray:
+        """Clutter objects inside the room
+
+        Args:
+            size (float): edge length of the room
+
+        Returns:
+            np.ndarray: (K, 4) centers and radii
+        """
+        rng = np.random.default_rng([self.seed, 2**31 + 1])
+        radii = rng.uniform(0.15, 0.5, size=self.n_objects)
+        low = np.array([0.1 * size, 0.1 * size, 0.0]) + radii[:, None]
+        high = np.array([0.9 * size, 0.9 * size, self.height]) - radii[:, None]
+        centers = rng.uniform(low, np.maximum(high, low))
+        return np.column_stack([centers, radii])
@@ -0,0 +1,212 @@
+"""Spatial tiling of point clouds, which are larger than the available memory"""
+import shutil
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .pointstream import iter_chunks
+
+# Chunked reader of a point cloud file, yielding points and optional colors
+ChunkReader = Callable[[Path, int], Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]]
+
+# Record layout of the points, which are spilled into the tile files
+SPILL_DTYPE = np.dtype([("xyz", "<f8", (3,)), ("rgb", "u1", (3,)), ("core", "?")])
+
+
+class TileGrid:
+    """
+    Regular grid of square tiles in the xy-plane. Every point belongs to the core
+    of exactly one tile and to the overlap margin of its neighbouring tiles.
+    """
+
+    def __init__(
+        self,
+        min_bound: np.ndarray,
+        max_bound: np.ndarray,
+        tile_size: float,
+        overlap: float,
+    ):
+
+        if not 0 <= overlap < tile_size:
+            raise ValueError("The tile overlap must be smaller than the tile size!")
+
+        self.origin = np.asarray(min_bound[:2], dtype=np.float64)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        extent = np.asarray(max_bound[:2], dtype=np.float64) - self.origin
+        shape = np.maximum(np.ceil(extent / tile_size), 1).astype(int)
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    def __len__(self) -> int:
+        return int(self.shape[0] * self.shape[1])
+
+    def assign(self, points: np.ndarray) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        """Assign points to the tiles, which contain them in their core or overlap
+
+        Args:
+            points (np.ndarray): (N, 3) points
+
+        Returns:
+            List[Tuple[int, np.ndarray, np.ndarray]]: tile id, indices of the
+            points in the tile and whether they are core points of the tile
+        """
+        rel = (points[:, :2] - self.origin) / self.tile_size
+        cell = np.clip(np.floor(rel).astype(np.int64), 0, np.array(self.shape) - 1)
+        frac = (rel - cell) * self.tile_size
+
+        tiles: Dict[int, List[Tuple[np.ndarray, bool]]] = {}
+        for d_x in (-1, 0, 1):
+            for d_y in (-1, 0, 1):
+                target = cell + (d_x, d_y)
+                inside = np.all((target >= 0) & (target < self.shape), axis=1)
+                # Neighbours only receive points within the overlap margin
+                for axis, delta in enumerate((d_x, d_y)):
+                    if delta < 0:
+                        inside &= frac[:, axis] < self.overlap
+                    elif delta > 0:
+                        inside &= frac[:, axis] >= self.tile_size - self.overlap
+
+                idx = np.flatnonzero(inside)
+                tile_ids = target[idx, 0] * self.shape[1] + target[idx, 1]
+                order = np.argsort(tile_ids, kind="stable")
+                ids, starts = np.unique(tile_ids[order], return_index=True)
+                for tile_id, part in zip(ids, np.split(idx[order], starts[1:])):
+                    tiles.setdefault(int(tile_id), []).append(
+                        (part, d_x == 0 and d_y == 0)
+                    )
+
+        assigned = []
+        for tile_id, parts in tiles.items():
+            idx = np.concatenate([part for part, _ in parts])
+            core = np.concatenate(
+                [np.full(len(part), is_core) for part, is_core in parts]
+            )
+            assigned.append((tile_id, idx, core))
+        return assigned
+
+
+def stream_bounds(
+    path: Path, chunk_size: int, reader: ChunkReader = iter_chunks
+) -> Tuple[np.ndarray, np.ndarray, bool, int]:
+    """Bounds of a point cloud file, computed chunk by chunk
+
+    Args:
+        path (Path): path to the point cloud file
+        chunk_size (int): points per chunk
+        reader (ChunkReader, optional): chunked reader. Defaults to iter_chunks.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, bool, int]: minimal and maximal bound,
+        whether the points have colors and the number of points
+    """
+    min_bound = np.full(3, np.inf)
+    max_bound = np.full(3, -np.inf)
+    has_colors = False
+    count = 0
+    for points, colors in reader(path, chunk_size):
+        if len(points):
+            min_bound = np.minimum(min_bound, points.min(axis=0))
+            max_bound = np.maximum(max_bound, points.max(axis=0))
+        has_colors = colors is not None
+        count += len(points)
+    return min_bound, max_bound, has_colors, count
+
+
+def spill_tiles(
+    path: Path,
+    grid: TileGrid,
+    tile_dir: Path,
+    chunk_size: int,
+    reader: ChunkReader = iter_chunks,
+) -> List[Path]:
+    """Stream a point cloud file into one spill file per tile
+
+    Args:
+        path (Path): path to the point cloud file
+        grid (TileGrid): tile grid covering the point cloud
+        tile_dir (Path): directory of the spill files
+        chunk_size (int): points per chunk
+        reader (ChunkReader, optional): chunked reader. Defaults to iter_chunks.
+
+    Returns:
+        List[Path]: spill files of all non-empty tiles
+    """
+    if tile_dir.exists():
+        shutil.rmtree(tile_dir)
+    tile_dir.mkdir(parents=True)
+
+    tile_paths: Dict[int, Path] = {}
+    for points, colors in reader(path, chunk_size):
+        records = np.zeros(len(points), dtype=SPILL_DTYPE)
+        records["xyz"] = points
+        if colors is not None:
+            records["rgb"] = np.round(np.clip(colors, 0.0, 1.0) * 255.0)
+
+        for tile_id, idx, core in grid.assign(points):
+            tile = records[idx]
+            tile["core"] = core
+            tile_path = tile_paths.setdefault(tile_id, tile_dir / f"tile_{tile_id}.bin")
+            with tile_path.open("ab") as fp:
+                tile.tofile(fp)
+
+    return [tile_paths[tile_id] for tile_id in sorted(tile_paths)]
+
+
+def load_tile(tile_path: Path) -> np.ndarray:
+    """Load the spilled points of a single tile
+
+    Args:
+        tile_path (Path): spill file of the tile
+
+    Returns:
+        np.ndarray: structured array of SPILL_DTYPE records
+    """
+    return np.fromfile(tile_path, dtype=SPILL_DTYPE)
+
+
+def merge_planes(
+    planes: List[Tuple[List[float], int]], max_angle: float, max_dist: float
+) -> Tuple[List[List[float]], List[int]]:
+    """Merge plane equations of different tiles, which describe the same plane,
+    into global plane equations weighted by their inlier counts
+
+    Args:
+        planes (List[Tuple[List[float], int]]): plane equations and inlier counts
+        max_angle (float): maximal angle between normals in degrees
+        max_dist (float): maximal offset between merged planes
+
+    Returns:
+        Tuple[List[List[float]], List[int]]: global plane equations and the summed
+        inlier counts of their merged planes
+    """
+    if not planes:
+        return [], []
+
+    eqs = np.array([eq for eq, _ in planes], dtype=np.float64)
+    weights = np.array([count for _, count in planes], dtype=np.float64)
+    eqs /= np.linalg.norm(eqs[:, :3], axis=1, keepdims=True)
+
+    # Orient the normals consistently, the largest component is positive
+    dominant = np.abs(eqs[:, :3]).argmax(axis=1)
+    eqs *= np.sign(eqs[np.arange(len(eqs)), dominant])[:, None]
+
+    min_cos = np.cos(np.deg2rad(max_angle))
+    merged, inliers = [], []
+    unassigned = np.ones(len(eqs), dtype=bool)
+    # Larger planes seed the clusters
+    for seed in np.argsort(-weights, kind="stable"):
+        if not unassigned[seed]:
+            continue
+        members = (
+            unassigned
+            & (eqs[:, :3] @ eqs[seed, :3] >= min_cos)
+            & (np.abs(eqs[:, 3] - eqs[seed, 3]) <= max_dist)
+        )
+        unassigned &= ~members
+
+        plane = np.average(eqs[members], axis=0, weights=weights[members])
+        merged.append((plane / np.linalg.norm(plane[:3])).tolist())
+        inliers.append(int(weights[members].sum()))
+
+    return merged, inliers
@@ -1,14 +1,16 @@
 from time import perf_counter
 import functools
-from typing import Callable, Any, List, Dict
-from multiprocessing import Pool
+from typing import Any, List, Dict, Optional, Tuple
 
+from argparse import ArgumentTypeError
 from pathlib import Path
 import yaml
 import numpy as np
 import open3d as o3d
 from open3d.cpu.pybind.geometry import PointCloud
 
+from .compactcloud import CompactCloud
+
 
 def load_dict_from_yaml(filename: Path) -> Dict[str, Any]:
     """Loads yaml file into python dictionary
@@ -24,6 +26,27 @@ def load_dict_from_yaml(filename: Path) -> Dict[str, Any]:
     return configs
 
 
+def str_to_bool(value: Any) -> bool:
+    """Parse a boolean command line argument
+
+    Args:
+        value (Any): e.g. 'True', 'false', 'yes', '0'
+
+    Raises:
+        ArgumentTypeError: The value is not a boolean!
+
+    Returns:
+        bool: parsed value
+    """
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("true", "yes", "y", "1"):
+        return True
+    if value.lower() in ("false", "no", "n", "0"):
+        return False
+    raise ArgumentTypeError(f"'{value}' is not a boolean!")
+
+
 def folder_cleanup(folders: List[Path]) -> None:
     """Clean up multiple folders
 
@@ -40,40 +63,71 @@ def folder_cleanup(folders: List[Path]) -> None:
         print(exc)
 
 
-def multi_processing(function: Callable, files: Any) -> None:
-    """Utility function for multi-processing
+def assign_to_planes(
+    points: np.ndarray,
+    plane_eqs: List[List[float]],
+    thresh: float,
+    chunk_size: int = 2**18,
+    labels: bool = False,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Evaluate the distances of all points to all planes in a single product per
+    chunk of points, which bounds the (chunk, planes) distance matrix in memory
 
     Args:
-        function (Callable): Any function
-        files (Any): files on which to call the function
+        points (np.ndarray): (N, 3) array of points
+        plane_eqs (List[List[float]]): plane equations [a, b, c, d]
+        thresh (float): maximal distance of a point to belong to a plane
+        chunk_size (int, optional): points per chunk. Defaults to 2**18.
+        labels (bool, optional): also return the nearest plane per point.
+            Defaults to False.
+
+    Returns:
+        Tuple[np.ndarray, Optional[np.ndarray]]: mask of points on no plane and,
+        if requested, the index of the nearest plane per point, -1 for no plane
     """
-    try:
-        pool = Pool()
-        pool.map(function, files)
-        pool.close()
-        pool.join()
-    except Exception as exc:
-        print(exc)
+    keep = np.ones(len(points), dtype=bool)
+    nearest = np.full(len(points), -1, dtype=np.int32) if labels else None
+    if not len(plane_eqs):
+        return keep, nearest
+
+    # Homogeneous (4, P) plane matrix with unit normals
+    eqs = np.asarray(plane_eqs, dtype=np.float64).T
+    eqs = eqs / np.linalg.norm(eqs[:3], axis=0)
 
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        dists = chunk @ eqs[:3].astype(chunk.dtype) + eqs[3].astype(chunk.dtype)
+        np.abs(dists, out=dists)
+        closest = dists.argmin(axis=1)
+        on_plane = dists[np.arange(len(chunk)), closest] <= thresh
+        keep[start : start + chunk_size] = ~on_plane
+        if labels:
+            nearest[start : start + chunk_size][on_plane] = closest[on_plane]
 
-def remove_by_indices(points: np.ndarray, indices: List[int]) -> np.ndarray:
-    """Remove sub-lists in nested lists by index
+    return keep, nearest
+
+
+def select_points(cloud: PointCloud, indices: np.ndarray) -> PointCloud:
+    """Gather points, colors and normals of a point cloud by index
 
     Args:
-        points (np.ndarray): Input point cloud
-        indices (List[int]): Indices of points to remove
+        cloud (PointCloud): source point cloud, Open3D or compact
+        indices (np.ndarray): indices or boolean mask of the points to keep
 
     Returns:
-        _type_: np.ndarray
+        PointCloud: point cloud with the selected points and their attributes, of
+        the same type as the source
     """
-    final_points = []
-    index_set = set(indices)
-    for idx, point in enumerate(points):
-        if index_set and idx in index_set:
-            index_set.remove(idx)
-            continue
-        final_points.append(point.tolist())
-    return np.asarray(final_points)
+    if isinstance(cloud, CompactCloud):
+        return cloud.select_by_index(indices)
+
+    pcd_out = o3d.geometry.PointCloud()
+    pcd_out.points = o3d.utility.Vector3dVector(np.asarray(cloud.points)[indices])
+    if cloud.has_colors():
+        pcd_out.colors = o3d.utility.Vector3dVector(np.asarray(cloud.colors)[indices])
+    if cloud.has_normals():
+        pcd_out.normals = o3d.utility.Vector3dVector(np.asarray(cloud.normals)[indices])
+    return pcd_out
 
 
 def display_pointcloud_from_array(points: np.ndarray) -> None:
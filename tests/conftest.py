@@ -0,0 +1,5 @@
+"""The modules import each other relative to src, as in main.py"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,124 @@
+"""Timeouts, retries, memory limits and crashed workers of the JobScheduler"""
+import os
+import signal
+import time
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+from utils import background, metrics
+from utils.scheduler import JobScheduler
+
+
+def _job(run_dir: Path, file: str) -> None:
+    """Job, whose behaviour is chosen by the name of its file. Every attempt is
+    counted in <file>.runs of the run directory.
+
+    Args:
+        run_dir (Path): directory of the run counts and outputs
+        file (str): file of the job
+    """
+    with (run_dir / f"{file}.runs").open("a") as fp:
+        fp.write("run\n")
+
+    if file.startswith("sleep"):
+        time.sleep(60)
+    elif file.startswith("alloc"):
+        # Far above the memory limit of the worker
+        bytearray(2**30)
+    elif file.startswith("crash"):
+        # Like the OOM killer
+        os.kill(os.getpid(), signal.SIGKILL)
+    elif file.startswith("flaky") and _runs(run_dir, file) == 1:
+        raise RuntimeError("first attempt")
+    elif file.startswith("write"):
+        out_path = run_dir / f"{file}.out"
+        background.write(out_path, partial(_slow_write, out_path))
+
+
+def _slow_write(path: Path) -> None:
+    """Queued write, which is still running, when its job returns"""
+    time.sleep(0.3)
+    path.write_text("done")
+
+
+def _runs(run_dir: Path, file: str) -> int:
+    """Number of attempts of a file"""
+    runs_path = run_dir / f"{file}.runs"
+    return len(runs_path.read_text().splitlines()) if runs_path.is_file() else 0
+
+
+def _scheduler(**params: Any) -> JobScheduler:
+    """Scheduler without admission control and background threads"""
+    sched_params: Dict[str, Any] = {
+        "WORKERS": 2,
+        "MEMORY_MB": 0,
+        "WORKER_MEMORY_MB": 0,
+        "TIMEOUT": None,
+        "RETRIES": 0,
+        "PREFETCH": 0,
+        "WRITE_QUEUE": 0,
+    }
+    sched_params.update(params)
+    return JobScheduler(sched_params)
+
+
+@pytest.fixture(autouse=True)
+def _drain_metrics():
+    """Drop the records of the jobs after each test"""
+    yield
+    metrics.drain()
+
+
+def test_timeout_kills_only_the_timed_out_job(tmp_path, capsys):
+    scheduler = _scheduler(TIMEOUT=1, RETRIES=1, WRITE_QUEUE=4)
+    failed = scheduler.run(partial(_job, tmp_path), ["sleep", "write"], tmp_path)
+
+    assert failed == ["sleep"]
+    assert _runs(tmp_path, "sleep") == 2
+    # The finished job and its queued write survive the killed workers
+    assert _runs(tmp_path, "write") == 1
+    assert (tmp_path / "write.out").read_text() == "done"
+    assert "sleep: TimeoutError" in capsys.readouterr().out
+
+
+def test_failed_job_is_retried(tmp_path):
+    scheduler = _scheduler(RETRIES=1)
+    assert scheduler.run(partial(_job, tmp_path), ["flaky"], tmp_path) == []
+    assert _runs(tmp_path, "flaky") == 2
+
+
+def test_failed_job_is_reported_without_retries(tmp_path, capsys):
+    scheduler = _scheduler(RETRIES=0)
+    failed = scheduler.run(partial(_job, tmp_path), ["flaky", "ok"], tmp_path)
+
+    assert failed == ["flaky"]
+    assert _runs(tmp_path, "flaky") == 1
+    assert _runs(tmp_path, "ok") == 1
+    out = capsys.readouterr().out
+    assert "1 of 2 job(s) failed:" in out
+    assert "flaky: RuntimeError: first attempt" in out
+
+
+def test_memory_limit_fails_only_the_allocating_job(tmp_path, capsys):
+    scheduler = _scheduler(WORKER_MEMORY_MB=512)
+    failed = scheduler.run(partial(_job, tmp_path), ["alloc", "ok"], tmp_path)
+
+    assert failed == ["alloc"]
+    assert _runs(tmp_path, "ok") == 1
+    assert "alloc: MemoryError" in capsys.readouterr().out
+
+
+def test_crashed_worker_is_isolated(tmp_path, capsys):
+    scheduler = _scheduler(RETRIES=1)
+    files = ["crash", "ok_a", "ok_b"]
+    failed = scheduler.run(partial(_job, tmp_path), files, tmp_path)
+
+    # The crashing job retries alone, so it cannot take the others down again
+    assert failed == ["crash"]
+    assert _runs(tmp_path, "crash") == 2
+    assert 1 <= _runs(tmp_path, "ok_a") <= 2
+    assert 1 <= _runs(tmp_path, "ok_b") <= 2
+    assert "crash: BrokenProcessPool" in capsys.readouterr().out